@@ -0,0 +1,80 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+class AnswerCache:
+    def __init__(self, max_entries=256, ttl_seconds=3600):
+        """
+        LRU + TTL cache for generated answers.
+
+        Args:
+            max_entries: Maximum number of cached answers (least recently used are evicted)
+            ttl_seconds: Entry lifetime in seconds (None or 0 disables expiry)
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_query(query):
+        query = unicodedata.normalize("NFKC", query or "")
+        query = re.sub(r"\s+", " ", query).strip().lower()
+        return query.rstrip("?？!！。.，, ")
+
+    @classmethod
+    def make_key(cls, query, index_version, evidence_ids, gen_params=None):
+        """Key = (normalized query, index version, ordered evidence ids, generation params)"""
+        payload = json.dumps(
+            [cls.normalize_query(query), index_version, list(evidence_ids), gen_params or {}],
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _expired(self, created):
+        return bool(self.ttl_seconds) and time.time() - created > self.ttl_seconds
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            created, value = entry
+            if self._expired(created):
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,289 @@
+import argparse
+import os
+import time
+from typing import List, Optional
+
+import anyio
+import anyio.to_thread
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
+from pydantic import BaseModel
+
+from services import AppServices, init_services, answer_query, list_videos, remove_video, shard_branches
+from ingest_jobs import IngestJobQueue
+from index_bundle import export_bundle, import_bundle
+from tracing import tracer
+
+
+class IngestRequest(BaseModel):
+    video_path: str
+    session_id: Optional[str] = None
+    priority: int = 0
+    append: bool = False
+    # 录制中的文件或 .m3u8 分段列表：边录边建索引，可在录制结束前查询
+    live: bool = False
+
+
+class QueryRequest(BaseModel):
+    query: str
+    session_id: Optional[str] = None
+    k: int = 6
+    time_range: Optional[List[Optional[float]]] = None
+    video_ids: Optional[List[int]] = None
+
+
+class SearchRequest(BaseModel):
+    queries: List[str]
+    session_id: Optional[str] = None
+    k: int = 6
+    time_range: Optional[List[Optional[float]]] = None
+    video_ids: Optional[List[int]] = None
+
+
+class BundleRequest(BaseModel):
+    # 索引包目录（VRAG_BUNDLE_DIR）内的相对路径：目录或 .tar
+    path: str
+    session_id: Optional[str] = None
+    verify: bool = True
+
+
+def create_api(services: AppServices, jobs: IngestJobQueue):
+    app = FastAPI(title="Video-RAG Ultra API")
+    started_at = time.time()
+
+    @app.get("/health")
+    def health():
+        return {
+            "status": "ok",
+            "uptime": time.time() - started_at,
+            "vlm_loaded": getattr(services.vlm, "model", None) is not None,
+            "sessions": len(services.indexes),
+        }
+
+    def stats():
+        stats = {
+            "scheduler": services.vlm.scheduler.metrics(),
+            "answer_cache": services.answer_cache.stats(),
+            "conversations": services.vlm.sessions.stats(),
+            "ingest_jobs": jobs.counts(),
+        }
+        if services.shards is not None:
+            stats["shards"] = services.shards.metrics()
+        # 默认库的索引代数、仍被查询持有的旧代数与后台压缩
+        stats["index"] = dict(
+            {f"visual_{name}": value for name, value in services.retriever.handle.generations().items()},
+            **{f"audio_{name}": value for name, value in services.audio_retriever.handle.generations().items()},
+            **{f"compactor_{name}": value for name, value in services.compactor.stats().items()},
+        )
+        return stats
+
+    def flat_stats():
+        # Prometheus 导出只接受数值：{"scheduler": {"queue_depth": 1}} -> scheduler_queue_depth
+        return {
+            f"{group}_{name}": value
+            for group, values in stats().items()
+            for name, value in values.items()
+        }
+
+    tracer.register_collector(flat_stats)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return tracer.export_prometheus()
+
+    @app.get("/stats")
+    def stats_json():
+        return stats()
+
+    @app.get("/traces")
+    def traces():
+        return tracer.recent_traces()
+
+    @app.get("/shards")
+    def shards():
+        if services.shards is None:
+            raise HTTPException(status_code=404, detail="sharding is not enabled (--shards)")
+        return services.shards.stats()
+
+    @app.post("/ingest")
+    def submit_ingest(request: IngestRequest):
+        if not request.live and not os.path.exists(request.video_path):
+            raise HTTPException(status_code=404, detail=f"video not found: {request.video_path}")
+        return {"job_id": jobs.submit(
+            request.video_path, request.session_id, priority=request.priority, append=request.append,
+            live=request.live,
+        )}
+
+    @app.get("/ingest")
+    def list_ingest(status: Optional[str] = None, limit: int = 100):
+        return jobs.list(status=status, limit=limit)
+
+    @app.get("/ingest/{job_id}")
+    def ingest_status(job_id: str):
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="unknown job")
+        return job
+
+    @app.post("/ingest/{job_id}/cancel")
+    def cancel_ingest(job_id: str):
+        if jobs.get(job_id) is None:
+            raise HTTPException(status_code=404, detail="unknown job")
+        return {"job_id": job_id, "cancelled": jobs.cancel(job_id)}
+
+    @app.post("/query")
+    def query(request: QueryRequest):
+        if request.time_range is not None and len(request.time_range) != 2:
+            raise HTTPException(status_code=422, detail="time_range must be [start_sec, end_sec]")
+        result = answer_query(
+            request.query, services, session_id=request.session_id, k=request.k,
+            time_range=tuple(request.time_range) if request.time_range is not None else None,
+            video_ids=request.video_ids,
+        )
+        if result["answer"] is None:
+            raise HTTPException(status_code=409, detail="no index for this session; ingest a video first")
+        return result
+
+    @app.post("/search")
+    def search(request: SearchRequest):
+        """Retrieval only (no VLM) for many queries; results align with request.queries"""
+        if request.time_range is not None and len(request.time_range) != 2:
+            raise HTTPException(status_code=422, detail="time_range must be [start_sec, end_sec]")
+        time_range = tuple(request.time_range) if request.time_range is not None else None
+        if request.session_id is None and services.shards is not None:
+            branches = services.retrieval.run(
+                shard_branches(services, request.queries, request.k, time_range, request.video_ids)
+            )
+            evidence_id = services.shards.evidence_id
+        else:
+            visual_snapshot, audio_snapshot = services.indexes.lookup(request.session_id).snapshots()
+            branches = services.retrieval.run({
+                "visual": lambda: services.retriever.search_many(
+                    request.queries, k=request.k, snapshot=visual_snapshot,
+                    time_range=time_range, video_ids=request.video_ids,
+                ),
+                "audio": lambda: services.audio_retriever.search_many(
+                    request.queries, k=request.k, snapshot=audio_snapshot,
+                    time_range=time_range, video_ids=request.video_ids,
+                ),
+            })
+            evidence_id = lambda path: f"{visual_snapshot.snapshot_id}/{os.path.basename(path)}"
+        visual = branches["visual"].results or [[] for _ in request.queries]
+        audio = branches["audio"].results or [[] for _ in request.queries]
+        return [
+            {
+                "query": query,
+                "visual": [
+                    {"timestamp": float(ts), "score": float(score), "evidence_id": evidence_id(path)}
+                    for ts, score, path in v
+                ],
+                "audio": [{"start": float(start), "text": text, "score": float(score)} for start, text, score in a],
+            }
+            for query, v, a in zip(request.queries, visual, audio)
+        ]
+
+    @app.get("/videos")
+    def videos(session_id: Optional[str] = None):
+        return list_videos(services, session_id)
+
+    @app.delete("/videos/{video_id}")
+    def delete_video(video_id: int, session_id: Optional[str] = None):
+        try:
+            removed = remove_video(services, video_id, session_id=session_id)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"unknown video: {video_id}")
+        return {"video_id": video_id, "source": removed["source"], "removed": True}
+
+    @app.post("/bundles/export")
+    def bundle_export(request: BundleRequest):
+        try:
+            return export_bundle(services, request.path, session_id=request.session_id)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        except FileExistsError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+    @app.post("/bundles/import")
+    def bundle_import(request: BundleRequest):
+        try:
+            manifest = import_bundle(services, request.path, session_id=request.session_id, verify=request.verify)
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        return {"bundle_id": manifest["bundle_id"], "libraries": manifest["libraries"]}
+
+    @app.get("/evidence/{snapshot_id}/{filename}")
+    def evidence(snapshot_id: str, filename: str, session_id: Optional[str] = None):
+        library = services.indexes.lookup(session_id).visual.current()
+        shard_root = services.shards.evidence_root(snapshot_id) if services.shards and session_id is None else None
+        if shard_root:
+            # 分片库的关键帧
+            root = os.path.abspath(shard_root)
+            path = os.path.abspath(os.path.join(root, filename))
+        elif library.storage_dir and library.snapshot_id == snapshot_id:
+            # 从磁盘库 / bundle 加载的关键帧
+            root = os.path.abspath(os.path.join(library.storage_dir, "assets"))
+            path = os.path.abspath(os.path.join(root, filename))
+        elif library.assets_dir and library.snapshot_id == snapshot_id:
+            # 追加构建的库沿用最初快照的关键帧目录
+            root = os.path.abspath(library.assets_dir)
+            path = os.path.abspath(os.path.join(root, filename))
+        else:
+            root = os.path.abspath(services.retriever.keyframe_dir)
+            path = os.path.abspath(os.path.join(root, snapshot_id, filename))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="evidence not found")
+        return FileResponse(path, media_type="image/jpeg")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Video-RAG Ultra headless API server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--threads", type=int, default=32, help="max concurrently handled requests")
+    parser.add_argument("--ingest-workers", type=int, default=1, help="ingestions running at once")
+    parser.add_argument("--jobs-db", default="../data/embeddings/ingest_jobs.sqlite3")
+    parser.add_argument("--index-dir", help="persisted library directory (same as VRAG_INDEX_DIR)")
+    parser.add_argument("--bundle", help="index bundle (directory or .tar, inside the bundle directory) "
+                                         "to serve as the default library")
+    parser.add_argument("--bundle-dir", help="directory bundles are exported to / imported from "
+                                             "(same as VRAG_BUNDLE_DIR; default <index-dir>/bundles)")
+    parser.add_argument("--shards", type=int, help="partition the default library across N worker processes "
+                                                   "(same as VRAG_SHARDS)")
+    parser.add_argument("--shard-timeout", type=float, help="seconds per shard before it is left out of a query")
+    args = parser.parse_args()
+    if args.index_dir:
+        os.environ["VRAG_INDEX_DIR"] = args.index_dir
+    if args.bundle_dir:
+        os.environ["VRAG_BUNDLE_DIR"] = args.bundle_dir
+    if args.shards:
+        os.environ["VRAG_SHARDS"] = str(args.shards)
+    if args.shard_timeout:
+        os.environ["VRAG_SHARD_TIMEOUT"] = str(args.shard_timeout)
+
+    services = init_services()
+    if args.bundle:
+        import_bundle(services, args.bundle)
+    jobs = IngestJobQueue(services, db_path=args.jobs_db, num_workers=args.ingest_workers).start()
+    app = create_api(services, jobs)
+    config = uvicorn.Config(app, host=args.host, port=args.port)
+    server = uvicorn.Server(config)
+
+    async def serve():
+        # 同步路由在 AnyIO 线程池中执行，线程数即最大并发请求数
+        anyio.to_thread.current_default_thread_limiter().total_tokens = args.threads
+        await server.serve()
+
+    try:
+        anyio.run(serve)
+    finally:
+        if services.shards is not None:
+            services.shards.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,98 +1,89 @@
 import gradio as gr
 import os
-import traceback
-from dataclasses import dataclass
 
-from video_processor import VideoRetriever
-from vlm_handler import VLMHandler
-from audio_processor import AudioRetriever
+from services import AppServices, init_services, answer_query
+from ingest_jobs import IngestJobQueue
+from profiling import profiled
 
-@dataclass
-class AppServices:
-    vlm: VLMHandler
-    retriever: VideoRetriever
-    audio_retriever: AudioRetriever
+BRANCH_LABELS = {"visual": "👁️ 视觉关键帧", "audio": "👂 音频转录"}
 
 
-def init_services():
-    print("正在初始化 Web 系统 (这可能需要加载多个模型)...")
-    try:
-        return AppServices(
-            vlm=VLMHandler(),
-            retriever=VideoRetriever(),
-            audio_retriever=AudioRetriever(),
-        )
-    except Exception as e:
-        print(f"模型加载出错: {e}")
-        raise
-
-
-def process_upload_impl(video_path, services: AppServices):
-    """Process video: visual and audio indexing"""
+def process_upload_impl(video_path, jobs: IngestJobQueue, session_id=None):
+    """Submit the video to the background ingestion queue; returns (status_html, job_id)"""
     if video_path is None:
-        yield "请上传视频", None
-        return
+        return "请上传视频", None
+    job_id = jobs.submit(video_path, session_id=session_id)
+    return job_status_html(jobs.get(job_id)), job_id
 
-    loading_html = (
-        f"<div class='loading-pane'>"
-        f"<div class='spinner'></div>"
-        f"<div class='loading-text'>正在处理 <b>{os.path.basename(video_path)}</b>...</div>"
-        f"<div class='loading-subtext'>提取视觉关键帧中，请稍候</div>"
-        f"</div>"
-    )
-    yield loading_html, None
 
-    try:
-        services.retriever.process_video(video_path, max_duration_minutes=None)
-        loading_html = (
+def job_status_html(job):
+    """Render one ingestion job (queued / running / done / failed / cancelled) as status HTML"""
+    if job is None:
+        return "<div style='text-align: center; padding: 1rem; color: #64748b;'>⏸️ 等待视频上传...</div>"
+    name = os.path.basename(job["video_path"])
+    status = job["status"]
+
+    if status in ("queued", "running"):
+        branches = job.get("branches") or {}
+        rows = "".join(
+            f"<div class='loading-subtext'>{BRANCH_LABELS[b]}: {st['fraction'] * 100:.0f}% · {st['message']}</div>"
+            for b, st in branches.items()
+        )
+        headline = "排队中，等待空闲的处理进程" if status == "queued" else f"正在处理 ({job['progress'] * 100:.0f}%)"
+        return (
             f"<div class='loading-pane'>"
             f"<div class='spinner'></div>"
-            f"<div class='loading-text'>正在进行音频转录</div>"
-            f"<div class='loading-subtext'>使用 Whisper Large-v3 模型处理中...</div>"
-            f"</div>"
-        )
-        yield loading_html, None
-        services.audio_retriever.process_audio(video_path)
-        stats = (
-            f"<div class='success-pane'>"
-            f"<div class='success-header'>"
-            f"<div class='check-icon'></div>"
-            f"<span class='success-title'>索引构建完成！</span>"
-            f"</div>"
-            f"<div class='stats-grid'>"
-            f"<div class='stat-item'><span class='stat-label'>视觉关键帧</span><span class='stat-value'>{services.retriever.index.ntotal}</span><span class='stat-unit'>帧</span></div>"
-            f"<div class='stat-item'><span class='stat-label'>音频片段</span><span class='stat-value'>{services.audio_retriever.index.ntotal}</span><span class='stat-unit'>条</span></div>"
-            f"</div>"
-            f"<div class='ready-badge'><span class='ready-icon'>✨</span> Ready to Chat!</div>"
+            f"<div class='loading-text'>{headline}: <b>{name}</b></div>"
+            f"{rows}"
             f"</div>"
         )
-        yield stats, None
-    except Exception as e:
-        traceback.print_exc()
-        yield f"<div class='error-pane'><span class='error-icon'>❌</span> 处理失败: <code>{str(e)}</code></div>", None
+    if status == "cancelled":
+        return f"<div class='warn-pane'>⚠️ 已取消: <b>{name}</b></div>"
+
+    result = job.get("result") or {}
+    if status == "failed":
+        return f"<div class='error-pane'><span class='error-icon'>❌</span> 处理失败: <code>{job.get('error')}</code></div>"
+
+    warning = "".join(
+        f"<div class='warn-pane'>⚠️ {BRANCH_LABELS[b]} 失败，仅使用另一模态: <code>{st['message']}</code></div>"
+        for b, st in result.items()
+        if st["status"] == "error"
+    )
+    return (
+        f"<div class='success-pane'>"
+        f"<div class='success-header'>"
+        f"<div class='check-icon'></div>"
+        f"<span class='success-title'>索引构建完成！</span>"
+        f"</div>"
+        f"{warning}"
+        f"<div class='stats-grid'>"
+        f"<div class='stat-item'><span class='stat-label'>视觉关键帧</span><span class='stat-value'>{result.get('visual', {}).get('ntotal', 0)}</span><span class='stat-unit'>帧</span></div>"
+        f"<div class='stat-item'><span class='stat-label'>音频片段</span><span class='stat-value'>{result.get('audio', {}).get('ntotal', 0)}</span><span class='stat-unit'>条</span></div>"
+        f"</div>"
+        f"<div class='ready-badge'><span class='ready-icon'>✨</span> Ready to Chat!</div>"
+        f"</div>"
+    )
 
 
-def chat_engine_impl(query, services: AppServices):
+@profiled("chat_engine")
+def chat_engine_impl(query, services: AppServices, session_id=None):
     """Core Q&A logic with multimodal retrieval"""
-    if services.retriever.index.ntotal == 0:
+    result = answer_query(query, services, session_id=session_id, k=6)
+    if result["answer"] is None:
         return "<div class='warn-pane'>⚠️ 请先在左侧上传视频并点击 [构建索引]</div>", []
-    print("[App] Visual Search...")
-    visual_results = services.retriever.search(query, k=6)
-    print("[App] Audio Search...")
-    audio_results = services.audio_retriever.search(query, k=6)
 
-    gallery_data, images_info = [], []
+    gallery_data = []
     rag_evidence = (
         "<div class='rag-evidence-container'>"
         "<div class='rag-evidence-title'>🔍 RAG 多模态证据</div>"
         "<div class='evidence-block'>"
         "<div class='evidence-header'><span class='icon-eye'>👁️</span> <b>视觉证据</b> <span class='evidence-count'>({})</span></div>"
         "<ul class='evidence-list'>"
-    ).format(len(visual_results))
-    for ts, score, path in visual_results:
+    ).format(len(result["visual"]))
+    for item in result["visual"]:
+        ts, score, path = item["timestamp"], item["score"], item["path"]
         time_str = f"{int(ts)//60:02d}:{int(ts)%60:02d}"
         gallery_data.append((path, f"Time: {time_str}"))
-        images_info.append((ts, score, path))
         rag_evidence += (
             f"<li class='evidence-item'>"
             f"<span class='timestamp'>{time_str}</span>"
@@ -104,8 +95,9 @@ def chat_engine_impl(query, services: AppServices):
         "<div class='evidence-block'>"
         "<div class='evidence-header'><span class='icon-ear'>👂</span> <b>音频证据</b> <span class='evidence-count'>({})</span></div>"
         "<ul class='evidence-list'>"
-    ).format(len(audio_results))
-    for start, text, score in audio_results:
+    ).format(len(result["audio"]))
+    for item in result["audio"]:
+        start, text = item["start"], item["text"]
         time_str = f"{int(start)//60:02d}:{int(start)%60:02d}"
         rag_evidence += (
             f"<li class='evidence-item'>"
@@ -113,12 +105,19 @@ def chat_engine_impl(query, services: AppServices):
             f"<span class='aud-text'>{text[:80]}{'...' if len(text) > 80 else ''}</span>"
             f"</li>"
         )
-    rag_evidence += "</ul></div></div>"
-    answer = services.vlm.chat(query, images_info, audio_results)
+    budget = result["budget"]
+    rag_evidence += (
+        "</ul></div>"
+        f"<div class='evidence-block'><span class='budget-info'>🧮 Token 预算: "
+        f"{budget['tokens_used']}/{budget['token_budget']}"
+        f"（舍弃 {budget['dropped_images']} 帧 / {budget['dropped_audio']} 段）</span></div>"
+        "</div>"
+    )
+    cache_badge = "<span class='cache-badge'>⚡ 缓存命中</span>" if result["cache_hit"] else ""
     final_response = (
         f"{rag_evidence}<div class='divider'></div>"
-        f"<div class='ai-answer-title'>🤖 AI 分析结果</div>"
-        f"<div class='ai-answer-block'>{answer}</div>"
+        f"<div class='ai-answer-title'>🤖 AI 分析结果 {cache_badge}</div>"
+        f"<div class='ai-answer-block'>{result['answer']}</div>"
     )
     return final_response, gallery_data
 
@@ -659,6 +658,11 @@ input:focus, textarea:focus, .gradio-textbox textarea:focus {
     border-radius: 8px;
     white-space: nowrap;
 }
+.budget-info {
+    color: #64748b;
+    font-size: 0.9em;
+    font-weight: 600;
+}
 .aud-text {
     color: #4c1d95;
     font-weight: 500;
@@ -700,6 +704,17 @@ input:focus, textarea:focus, .gradio-textbox textarea:focus {
     margin-bottom: 0.75rem;
     font-family: 'Montserrat', sans-serif;
 }
+.cache-badge {
+    display: inline-block;
+    margin-left: 0.5rem;
+    padding: 0.2rem 0.6rem;
+    border-radius: 8px;
+    font-size: 0.7em;
+    color: #15803d;
+    -webkit-text-fill-color: #15803d;
+    background: rgba(34, 197, 94, 0.12);
+    border: 1px solid rgba(34, 197, 94, 0.3);
+}
 .ai-answer-block {
     background: linear-gradient(135deg, rgba(236, 233, 254, 0.85), rgba(243, 244, 255, 0.85));
     border-radius: 14px;
@@ -806,16 +821,40 @@ def extract_query(history):
     return raw_query
 
 
-def build_ui(services: AppServices):
-    def _process_upload(video_path):
-        yield from process_upload_impl(video_path, services)
+def build_ui(services: AppServices, jobs: IngestJobQueue):
+    def _process_upload(video_path, request: gr.Request):
+        session_id = getattr(request, "session_hash", None)
+        return process_upload_impl(video_path, jobs, session_id=session_id)
+
+    def _poll_job(job_id):
+        if job_id is None:
+            return gr.update()
+        return job_status_html(jobs.get(job_id))
+
+    def _cancel_job(job_id):
+        if job_id is not None:
+            jobs.cancel(job_id)
+        return job_status_html(jobs.get(job_id)) if job_id else gr.update()
 
-    def _bot_msg(history):
+    def _on_unload(request: gr.Request):
+        # 关闭页面时取消该会话仍在排队/运行的索引任务
+        session_id = getattr(request, "session_hash", None)
+        if session_id is not None:
+            jobs.cancel_session(session_id)
+
+    def _bot_msg(history, request: gr.Request):
         query = extract_query(history)
-        response, images = chat_engine_impl(query, services)
+        session_id = getattr(request, "session_hash", None)
+        response, images = chat_engine_impl(query, services, session_id=session_id)
         history.append({"role": "assistant", "content": response})
         return history, images
 
+    def _clear_history(request: gr.Request):
+        session_id = getattr(request, "session_hash", None)
+        if session_id is not None:
+            services.vlm.sessions.reset(session_id)
+        return []
+
     def _user_msg(user_message, history):
         return "", history + [{"role": "user", "content": user_message}]
 
@@ -845,12 +884,18 @@ def build_ui(services: AppServices):
                         height=260,
                         interactive=True
                     )
-                    btn_process = gr.Button(
-                        "🚀 构建索引",
-                        variant="primary",
-                        elem_classes="primary-btn",
-                        scale=1
-                    )
+                    with gr.Row():
+                        btn_process = gr.Button(
+                            "🚀 构建索引",
+                            variant="primary",
+                            elem_classes="primary-btn",
+                            scale=3
+                        )
+                        btn_cancel = gr.Button(
+                            "⏹️ 取消",
+                            variant="secondary",
+                            scale=1
+                        )
                     gr.Markdown("---")
                     gr.Markdown(
                         "#### 📊 系统状态",
@@ -861,6 +906,8 @@ def build_ui(services: AppServices):
                         "⏸️ 等待视频上传...</div>",
                         elem_id="status-markdown"
                     )
+                    job_state = gr.State(None)
+                    job_timer = gr.Timer(1.0)
                     with gr.Accordion(
                         "🖼️ 检索关键帧画廊",
                         open=False,
@@ -909,20 +956,24 @@ def build_ui(services: AppServices):
                             "</span></div>",
                             elem_classes="footer-text",
                         )
-        btn_process.click(_process_upload, [video_in], [status_display, gallery])
+        btn_process.click(_process_upload, [video_in], [status_display, job_state], queue=False)
+        btn_cancel.click(_cancel_job, [job_state], [status_display], queue=False)
+        job_timer.tick(_poll_job, [job_state], [status_display], queue=False)
+        demo.unload(_on_unload)
         msg.submit(_user_msg, [msg, chatbot], [msg, chatbot], queue=False).then(
             _bot_msg, [chatbot], [chatbot, gallery]
         )
         btn_send.click(_user_msg, [msg, chatbot], [msg, chatbot], queue=False).then(
             _bot_msg, [chatbot], [chatbot, gallery]
         )
-        btn_clear.click(lambda: [], None, chatbot, queue=False)
+        btn_clear.click(_clear_history, None, chatbot, queue=False)
 
     return demo
 
 if __name__ == "__main__":
     services = init_services()
-    demo = build_ui(services)
+    jobs = IngestJobQueue(services, num_workers=int(os.environ.get("VRAG_INGEST_WORKERS", "1"))).start()
+    demo = build_ui(services, jobs)
     demo.queue().launch(
         server_name="0.0.0.0",
         server_port=7860,
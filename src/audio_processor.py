@@ -6,8 +6,21 @@ import json
 import hashlib
 import torch
 import subprocess
+import time
 from sentence_transformers import SentenceTransformer
 
+from index_state import IndexHandle, IndexSnapshot
+from metadata_store import MetadataStore, AUDIO_SCHEMA, gather_results
+from index_filters import allocate_video_id, candidate_ranges, copy_library, search_ranges
+from live_source import LiveSource
+from tracing import tracer
+from profiling import profiled
+
+
+class AudioExtractionError(RuntimeError):
+    """The audio track could not be extracted; the video was registered without speech"""
+
+
 class AudioRetriever:
     def __init__(
         self,
@@ -16,6 +29,10 @@ class AudioRetriever:
         use_fast_index=False,
         chunk_seconds=300,
         cache_dir="../data/embeddings/audio_cache",
+        segment_window=1,
+        whisper_model=None,
+        text_encoder=None,
+        text_model_name="all-MiniLM-L6-v2",
     ):
         """
         Args:
@@ -25,6 +42,10 @@ class AudioRetriever:
                 - large-v3: 最准确但最慢
             use_fp16: 使用半精度加速
             use_fast_index: 使用 HNSW 索引（大数据量时更快）
+            segment_window: 将连续 N 个转录片段合并为一条索引（1 = 不合并）
+            whisper_model / text_encoder: Already loaded models (skip loading; share across
+                retrievers, or pass stub encoders for offline evaluation)
+            text_model_name: Sentence-Transformer used for transcript / query embeddings
         """
         # GPU分配策略：
         # - 3+ GPU: 使用独立的GPU 2
@@ -40,27 +61,49 @@ class AudioRetriever:
         self.whisper_model_size = whisper_model_size
         
         # 1. 加载 Whisper（可选择更小的模型）
-        print(f"[Audio Init] Loading Whisper {whisper_model_size}...")
-        self.whisper_model = whisper.load_model(whisper_model_size, device=self.device)
+        if whisper_model is None:
+            print(f"[Audio Init] Loading Whisper {whisper_model_size}...")
+            whisper_model = whisper.load_model(whisper_model_size, device=self.device)
+        self.whisper_model = whisper_model
         self.use_fp16 = use_fp16 and torch.cuda.is_available()
         self.chunk_seconds = chunk_seconds
+        self.segment_window = max(1, int(segment_window))
         self.cache_dir = cache_dir
         os.makedirs(self.cache_dir, exist_ok=True)
         
         # 2. 加载文本向量模型
-        print("[Audio Init] Loading Sentence-Transformer...")
-        self.text_encoder = SentenceTransformer('all-MiniLM-L6-v2', device=self.device)
+        self.text_model_name = text_model_name
+        if text_encoder is None:
+            print("[Audio Init] Loading Sentence-Transformer...")
+            text_encoder = SentenceTransformer(text_model_name, device=self.device)
+        self.text_encoder = text_encoder
         
         # 3. 初始化 FAISS
         self.dimension = 384
-        if use_fast_index:
+        self.use_fast_index = use_fast_index
+        self.handle = IndexHandle(self.new_snapshot())
+
+    def new_snapshot(self):
+        """Empty, unpublished index state for one ingestion run"""
+        if self.use_fast_index:
             # HNSW 索引，检索更快（适合 >1000 条数据）
-            self.index = faiss.IndexHNSWFlat(self.dimension, 32)
+            index = faiss.IndexHNSWFlat(self.dimension, 32)
         else:
             # 简单索引，构建快（适合 <1000 条数据）
-            self.index = faiss.IndexFlatL2(self.dimension)
-        
-        self.metadata = {}
+            index = faiss.IndexFlatL2(self.dimension)
+        return IndexSnapshot(index, MetadataStore(AUDIO_SCHEMA))
+
+    @property
+    def index(self):
+        return self.handle.current().index
+
+    @property
+    def metadata(self):
+        return self.handle.current().metadata
+
+    @property
+    def index_version(self):
+        return self.handle.version
     
     def _extract_audio(self, video_path):
         audio_path = os.path.splitext(video_path)[0] + ".wav"
@@ -179,7 +222,8 @@ class AudioRetriever:
             for seg in segments
         ]
 
-    def _transcribe_chunked(self, audio_path, transcribe_options):
+    @profiled("transcribe_chunked")
+    def _transcribe_chunked(self, audio_path, transcribe_options, progress_callback=None):
         if not self.chunk_seconds:
             return self._transcribe_full(audio_path, transcribe_options)
 
@@ -194,6 +238,8 @@ class AudioRetriever:
         try:
             for i, chunk_path in enumerate(chunk_files):
                 print(f"[Audio] Transcribing chunk {i+1}/{len(chunk_files)}...")
+                if progress_callback:
+                    progress_callback(0.1 + 0.8 * i / len(chunk_files), f"转录分段 {i+1}/{len(chunk_files)}")
                 result = self.whisper_model.transcribe(chunk_path, **transcribe_options)
                 for seg in result.get("segments", []):
                     segments.append(
@@ -212,15 +258,31 @@ class AudioRetriever:
 
         return segments
 
-    def process_audio(self, video_path, language=None):
+    def process_audio(self, video_path, language=None, progress_callback=None, target=None, append=False):
+        """
+        Args:
+            video_path: Path to video file
+            language: Whisper language code (None for auto-detect)
+            progress_callback: Optional fn(fraction, message) for stage/chunk progress
+            target: IndexHandle to publish into (default: self.handle); the new index
+                replaces the previous one atomically once fully built
+            append: Add the video to the current library instead of replacing it
+
+        Raises AudioExtractionError when the audio track cannot be extracted; the video
+        is still registered (without segments) before the error is raised.
+        """
         print(f"[Audio Processing] Start processing: {os.path.basename(video_path)}")
         
         # 1. 提取音频
+        if progress_callback:
+            progress_callback(0.0, "提取音频")
         try:
             audio_path = self._extract_audio(video_path)
         except Exception as e:
             print(f"[Audio Error] Extraction failed: {e}")
-            return
+            # 仍登记该视频（空片段），保持与视觉库的 video_id 一致；再把失败报给调用方，而不是当作“无语音”
+            self.index_segments([], video_path, progress_callback=progress_callback, target=target, append=append)
+            raise AudioExtractionError(f"音频提取失败: {e}") from e
         
         # 2. Whisper 转录（优化参数）
         print("[Audio] Running Whisper transcription...")
@@ -236,13 +298,28 @@ class AudioRetriever:
         cache_path = self._make_cache_path(video_path, language)
         segments = self._load_cached_segments(cache_path)
         if segments is None:
-            segments = self._transcribe_chunked(audio_path, transcribe_options)
+            segments = self._transcribe_chunked(audio_path, transcribe_options, progress_callback)
             self._save_cached_segments(cache_path, segments)
         print(f"[Audio] Transcribed {len(segments)} segments.")
-        
-        if not segments:
-            print("[Audio Warning] No speech detected.")
-            return
+        return self.index_segments(segments, video_path, progress_callback=progress_callback, target=target,
+                                   append=append)
+
+    def _window_segments(self, segments):
+        if self.segment_window <= 1:
+            return segments
+        windows = []
+        for i in range(0, len(segments), self.segment_window):
+            group = segments[i:i + self.segment_window]
+            windows.append({
+                "start": group[0]["start"],
+                "end": group[-1]["end"],
+                "text": " ".join(seg["text"].strip() for seg in group),
+            })
+        return windows
+
+    def _add_segments(self, snapshot, segments, video_id):
+        """Window, embed and append transcript segments to an unpublished snapshot"""
+        segments = self._window_segments(segments)
         
         # 3. 批量编码文本向量（优化）
         texts = [seg["text"] for seg in segments]
@@ -257,39 +334,196 @@ class AudioRetriever:
         )
         embeddings = embeddings.cpu().numpy().astype('float32')
         
-        # 4. 存入索引
-        self.index.reset()
-        self.index.add(embeddings)
+        # 4. 存入新索引（未发布，查询仍使用旧索引）
+        snapshot.index.add(embeddings)
         
         # 5. 保存元数据
-        self.metadata = {}
-        for i, seg in enumerate(segments):
-            self.metadata[i] = {
-                "start": seg["start"],
-                "end": seg["end"],
-                "text": seg["text"].strip()
-            }
+        snapshot.metadata.append(
+            start=[seg["start"] for seg in segments],
+            end=[seg["end"] for seg in segments],
+            video_id=[video_id] * len(segments),
+            text=[seg["text"].strip() for seg in segments],
+        )
+
+    def index_segments(self, segments, source=None, progress_callback=None, target=None, append=False):
+        """
+        Embed transcript segments ({"start", "end", "text"}) and publish them as a new index
+
+        Used by process_audio after transcription; also takes ready-made transcripts directly.
+        A video without speech is still registered (empty id range) so video ids stay
+        aligned with the visual library.
+        """
+        handle = target or self.handle
+        snapshot = self.new_snapshot()
+        base = handle.current() if append else None
+        if base is not None:
+            copy_library(base, snapshot)
+        snapshot.source = source
+        video_id = allocate_video_id(snapshot)
+        start_id = snapshot.index.ntotal
+
+        if not segments:
+            print("[Audio Warning] No speech detected.")
+        else:
+            if progress_callback:
+                progress_callback(0.9, "编码文本向量")
+            self._add_segments(snapshot, segments, video_id)
+        snapshot.videos.append({
+            "video_id": video_id,
+            "source": source,
+            "start_id": start_id,
+            "end_id": snapshot.index.ntotal,
+        })
         
-        print(f"[Audio Index] Built index with {self.index.ntotal} text segments.")
+        # 6. 原子替换
+        handle.publish(snapshot)
+        print(f"[Audio Index] Built index with {snapshot.index.ntotal} text segments.")
+        if progress_callback:
+            progress_callback(1.0, f"{snapshot.index.ntotal} 条片段")
+        return snapshot
     
-    def search(self, query, k=5):
+    def _extract_window(self, window):
+        """Cut one live window's audio to a 16 kHz mono WAV"""
+        audio_path = os.path.join(self.cache_dir, f"live_{os.getpid()}_{time.time_ns()}.wav")
+        cmd = ["ffmpeg", "-ss", str(window.start), "-i", window.path]
+        if window.end is not None:
+            cmd += ["-t", str(window.end - window.start)]
+        cmd += [
+            "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
+            audio_path, "-y", "-hide_banner", "-loglevel", "error",
+        ]
+        subprocess.run(cmd, check=True)
+        return audio_path
+
+    def process_live(self, source, language=None, progress_callback=None, target=None, append=False,
+                     window_seconds=30.0, publish_interval=30.0, poll_interval=5.0, idle_timeout=120.0):
+        """
+        Transcribe and index a recording while it is still being written (see VideoRetriever.process_live)
+
+        Args:
+            source: Growing media file or .m3u8 segment playlist
+            window_seconds: Growing files: audio transcribed per Whisper call (longer windows
+                give Whisper more context; a sentence crossing a window edge is split)
+            publish_interval: Min seconds between partial snapshots
+        """
+        handle = target or self.handle
+        working = self.new_snapshot()
+        base = handle.current() if append else None
+        if base is not None:
+            copy_library(base, working)
+        video_id = allocate_video_id(working)
+        start_id = working.index.ntotal
+        transcribe_options = {"beam_size": 1, "fp16": self.use_fp16, "task": "transcribe", "temperature": 0}
+        if language:
+            transcribe_options["language"] = language
+
+        def heartbeat(recorded):
+            if progress_callback:
+                progress_callback(0.0, f"直播中：已转录 {recorded/60:.1f} min, {working.index.ntotal - start_id} 条片段")
+
+        print(f"[Audio Live] Following {os.path.basename(source)}")
+        recorded = 0.0
+        last_publish = time.time()
+        live = True
+        try:
+            for window in LiveSource(source, min_window_seconds=window_seconds, poll_interval=poll_interval,
+                                     idle_timeout=idle_timeout, heartbeat=heartbeat).windows():
+                try:
+                    audio_path = self._extract_window(window)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    print(f"[Audio Live Warning] 窗口音频提取失败，跳过: {e}")
+                    continue
+                try:
+                    result = self.whisper_model.transcribe(audio_path, **transcribe_options)
+                    window_duration = self._get_audio_duration(audio_path) or 0.0
+                finally:
+                    os.remove(audio_path)
+                offset = window.offset + window.start
+                segments = [
+                    {"start": seg["start"] + offset, "end": seg["end"] + offset, "text": seg["text"]}
+                    for seg in result.get("segments", [])
+                ]
+                if segments:
+                    self._add_segments(working, segments, video_id)
+                recorded = offset + (window.end - window.start if window.end is not None else window_duration)
+                if time.time() - last_publish >= publish_interval:
+                    self._publish_live(handle, working, start_id, video_id, source, recorded, True)
+                    last_publish = time.time()
+                    heartbeat(recorded)
+            live = False
+        finally:
+            # 取消或出错时也发布已转录的部分
+            if working.index.ntotal > start_id or not live:
+                self._publish_live(handle, working, start_id, video_id, source, recorded, False)
+        if progress_callback:
+            progress_callback(1.0, f"{working.index.ntotal} 条片段")
+        return handle.current()
+
+    def _publish_live(self, handle, working, start_id, video_id, source, recorded, live):
+        """Publish a copy of the live working snapshot (published snapshots are never mutated)"""
+        snapshot = self.new_snapshot()
+        copy_library(working, snapshot)
+        snapshot.source = source
+        snapshot.videos.append({
+            "video_id": video_id,
+            "source": source,
+            "start_id": start_id,
+            "end_id": snapshot.index.ntotal,
+            "duration": recorded,
+            "live": live,
+        })
+        handle.publish(snapshot)
+        print(f"[Audio Live] Published snapshot: {snapshot.index.ntotal - start_id} segments, {recorded/60:.1f} min")
+
+    def encode_queries(self, queries, batch_size=64):
+        """Encode text queries with MiniLM in batched forward passes -> normalised (n, 384) float32"""
+        with tracer.span("minilm.encode", queries=len(queries)):
+            query_vec = self.text_encoder.encode(
+                queries,
+                convert_to_tensor=True,
+                batch_size=batch_size,
+                show_progress_bar=False,
+                normalize_embeddings=True,
+                device=self.device
+            )
+            return np.ascontiguousarray(query_vec.cpu().numpy().astype('float32'))
+
+    def search(self, query, k=5, snapshot=None, time_range=None, video_ids=None, with_ids=False):
+        """
+        Search transcript segments (against snapshot, default: current)
+
+        Args:
+            time_range: Optional (start_sec, end_sec); segments overlapping it match
+            video_ids: Optional video ids (snapshot.videos) to search in
+            with_ids: Also return the index ids of the hits (see search_many)
+        """
         print(f"[Audio Search] Query: '{query}'")
+        return self.search_many([query], k, snapshot, time_range, video_ids, with_ids)[0]
+
+    def search_many(self, queries, k=5, snapshot=None, time_range=None, video_ids=None, with_ids=False):
+        """
+        Search several queries at once: one batched MiniLM pass, one multi-row FAISS search
+
+        Returns:
+            One [(start, text, distance), ...] list per query, in input order;
+            with with_ids=True one (hits, ids) pair per query
+        """
+        if not queries:
+            return []
+        snapshot = snapshot or self.handle.current()
+        query_vec = self.encode_queries(list(queries))
         
-        query_vec = self.text_encoder.encode(
-            [query],
-            convert_to_tensor=True,
-            normalize_embeddings=True,
-            device=self.device
-        )
-        query_vec = query_vec.cpu().numpy().astype('float32')
-        
-        distances, indices = self.index.search(query_vec, k)
+        ranges = candidate_ranges(snapshot, time_range, video_ids, start_field="start", end_field="end")
+        with tracer.span("faiss.search", index="audio", k=k, ntotal=snapshot.index.ntotal,
+                         queries=len(queries)) as span:
+            if ranges is None:
+                distances, indices = snapshot.index.search(query_vec, k)
+            else:
+                span.set(candidates=sum(hi - lo for lo, hi in ranges))
+                distances, indices = search_ranges(snapshot.index, query_vec, k, ranges)
         
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx != -1 and idx in self.metadata:
-                data = self.metadata[idx]
-                score = distances[0][i]
-                results.append((data['start'], data['text'], score))
-        
+        for columns, dists, ids in gather_results(snapshot.metadata, distances, indices, ("start", "text")):
+            hits = list(zip(columns["start"].tolist(), columns["text"], dists.tolist()))
+            results.append((hits, ids.tolist()) if with_ids else hits)
         return results
@@ -0,0 +1,151 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class ConversationSession:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        # 每轮: {"full": 模型实际看到的 query, "text": 去掉图片的 query, "response": 回答}
+        self.turns = []
+        self.evidence_images = []
+        self.evidence_turn = None
+        self.past_key_values = None
+        self.cached_tokens = []
+        self.kv_bytes = 0
+        self.last_used = time.time()
+
+    def history(self):
+        """Qwen-VL history: the current evidence turn keeps its images, older turns are text-only"""
+        return [
+            (turn["full"] if i == self.evidence_turn else turn["text"], turn["response"])
+            for i, turn in enumerate(self.turns)
+        ]
+
+    def history_key(self):
+        digest = hashlib.sha1()
+        for query, response in self.history():
+            digest.update(query.encode("utf-8"))
+            digest.update(b"\0")
+            digest.update(response.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def drop_cache(self):
+        self.past_key_values = None
+        self.cached_tokens = []
+        self.kv_bytes = 0
+
+
+class ConversationStore:
+    def __init__(self, max_sessions=64, max_kv_bytes=4 * 1024 ** 3, idle_seconds=1800, max_turns=6):
+        """
+        Per-session conversation state with a memory-bounded KV cache.
+
+        Args:
+            max_sessions: Max live sessions (least recently used are dropped)
+            max_kv_bytes: Total bytes of cached KV tensors across sessions
+            idle_seconds: Sessions idle longer than this are dropped
+            max_turns: Turns of history kept per session
+        """
+        self.max_sessions = max_sessions
+        self.max_kv_bytes = max_kv_bytes
+        self.idle_seconds = idle_seconds
+        self.max_turns = max_turns
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, session_id):
+        with self._lock:
+            self.evict_idle()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ConversationSession(session_id)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            session.last_used = time.time()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def history_key(self, session_id):
+        if session_id is None:
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session.history_key() if session else ""
+
+    def record_turn(self, session_id, full_query, text_query, response, evidence_images=None):
+        """Append a turn; evidence_images set means this turn attached a new evidence set"""
+        with self._lock:
+            session = self.get(session_id)
+            session.turns.append({"full": full_query, "text": text_query, "response": response})
+            if evidence_images is not None:
+                session.evidence_images = list(evidence_images)
+                session.evidence_turn = len(session.turns) - 1
+            overflow = len(session.turns) - self.max_turns
+            if overflow > 0:
+                session.turns = session.turns[overflow:]
+                if session.evidence_turn is not None:
+                    session.evidence_turn -= overflow
+                    if session.evidence_turn < 0:
+                        session.evidence_turn = None
+                        session.evidence_images = []
+            return session
+
+    def store_cache(self, session_id, past_key_values, cached_tokens):
+        with self._lock:
+            session = self.get(session_id)
+            session.past_key_values = past_key_values
+            session.cached_tokens = list(cached_tokens)
+            session.kv_bytes = self._cache_bytes(past_key_values)
+            self._enforce_memory(keep=session_id)
+
+    def reset(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def evict_idle(self):
+        with self._lock:
+            now = time.time()
+            for session_id in [
+                sid for sid, s in self._sessions.items() if now - s.last_used > self.idle_seconds
+            ]:
+                del self._sessions[session_id]
+
+    def kv_bytes(self):
+        with self._lock:
+            return sum(s.kv_bytes for s in self._sessions.values())
+
+    def _enforce_memory(self, keep=None):
+        # 超出显存预算时，从最久未使用的会话开始丢弃 KV（保留对话文本）
+        for session in list(self._sessions.values()):
+            if self.kv_bytes() <= self.max_kv_bytes:
+                break
+            if session.session_id != keep:
+                session.drop_cache()
+        if self.kv_bytes() > self.max_kv_bytes and keep in self._sessions:
+            self._sessions[keep].drop_cache()
+
+    @staticmethod
+    def _cache_bytes(past_key_values):
+        total = 0
+        stack = [past_key_values]
+        while stack:
+            item = stack.pop()
+            if item is None:
+                continue
+            if isinstance(item, (tuple, list)):
+                stack.extend(item)
+            elif hasattr(item, "element_size"):
+                total += item.numel() * item.element_size()
+        return total
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "cached_sessions": sum(1 for s in self._sessions.values() if s.past_key_values is not None),
+                "kv_bytes": self.kv_bytes(),
+            }
@@ -0,0 +1,402 @@
+import argparse
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import re
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from index_state import IndexHandle
+
+# 检索器（torch / clip / whisper）在 make_retriever_factory 等用到时才导入，
+# 指标与 stub 编码器在没有这些库的环境里也能导入
+
+
+def _tensor(array):
+    import torch
+
+    return torch.from_numpy(array)
+
+
+# ---------------------------------------------------------------------------
+# 离线 stub 编码器：不下载任何模型，保证 CI 环境可跑通整个流程
+# ---------------------------------------------------------------------------
+
+def _token_vector(token, dim):
+    seed = int(hashlib.md5(token.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype("float32")
+
+
+class HashingTextEncoder:
+    """Bag-of-words feature hashing with the SentenceTransformer.encode interface"""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts, convert_to_tensor=False, normalize_embeddings=True, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype="float32")
+        for i, text in enumerate(texts):
+            for token in re.findall(r"\w+", text.lower()):
+                vectors[i] += _token_vector(token, self.dim)
+        if normalize_embeddings:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-6)
+        return _tensor(vectors) if convert_to_tensor else vectors
+
+
+class StubClip:
+    """
+    CLIP stand-in: images embed by colour statistics, texts by token hashing.
+
+    Scores are not semantically meaningful; it exercises keyframe extraction,
+    indexing, search and the metrics so latency/index size can be compared offline.
+    """
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self._projection = np.random.default_rng(0).standard_normal((3 * 16 * 16, dim)).astype("float32")
+
+    @staticmethod
+    def preprocess(image):
+        # PIL -> 3x16x16 float tensor，与 clip preprocess 一样返回单张图片张量
+        small = np.asarray(image.convert("RGB").resize((16, 16)), dtype="float32") / 255.0
+        return _tensor(small.transpose(2, 0, 1).copy())
+
+    def encode_image(self, batch):
+        flat = batch.reshape(batch.shape[0], -1).cpu().numpy()
+        return _tensor(flat @ self._projection)
+
+    def encode_text(self, tokens):
+        vectors = np.zeros((tokens.shape[0], self.dim), dtype="float32")
+        for i, row in enumerate(tokens.cpu().numpy()):
+            for token_id in row[row > 0]:
+                vectors[i] += _token_vector(str(int(token_id)), self.dim)
+        return _tensor(vectors)
+
+
+class StubWhisper:
+    """Whisper stand-in; offline runs index the dataset's reference transcript instead"""
+
+    def transcribe(self, audio_path, **kwargs):
+        return {"segments": []}
+
+
+# ---------------------------------------------------------------------------
+# 数据集与指标
+# ---------------------------------------------------------------------------
+
+def load_dataset(path):
+    """
+    Labelled dataset (JSON):
+
+        {
+          "videos": [{"id": "lec1", "path": "videos/lec1.mp4",
+                      "transcript": [{"start": 0.0, "end": 4.2, "text": "..."}]}],
+          "queries": [{"video": "lec1", "query": "...", "relevant": [[12.0, 30.0]],
+                       "modality": "visual" | "audio" | "both"}]
+        }
+
+    "transcript" is optional (or a path to such a list); it is required for audio in stub mode.
+    Relative paths are resolved against the dataset file.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    for video in data["videos"]:
+        if not os.path.isabs(video["path"]):
+            video["path"] = os.path.join(root, video["path"])
+        transcript = video.get("transcript")
+        if isinstance(transcript, str):
+            with open(os.path.join(root, transcript), "r", encoding="utf-8") as f:
+                video["transcript"] = json.load(f)
+    for query in data["queries"]:
+        query.setdefault("modality", "both")
+    return data
+
+
+def _overlap(a, b):
+    return max(0.0, min(a[1], b[1]) - max(a[0], b[0]))
+
+
+def _iou(a, b):
+    inter = _overlap(a, b)
+    union = max(a[1], b[1]) - min(a[0], b[0])
+    return inter / union if union > 0 else 0.0
+
+
+def _hits(interval, relevant):
+    # 零长度区间（单帧）落在相关区间内也算命中
+    return [i for i, r in enumerate(relevant) if _overlap(interval, r) > 0 or r[0] <= interval[0] <= r[1]]
+
+
+def score_ranking(intervals, relevant, ks):
+    """
+    Args:
+        intervals: Retrieved (start, end) in rank order
+        relevant: Ground-truth (start, end) ranges
+
+    Returns:
+        recall@k (fraction of relevant ranges covered by the top k), reciprocal rank
+        of the first hit, and temporal IoU of the top-1 result with its best range
+    """
+    scores = {}
+    for k in ks:
+        covered = set()
+        for interval in intervals[:k]:
+            covered.update(_hits(interval, relevant))
+        scores[f"recall@{k}"] = len(covered) / len(relevant) if relevant else 0.0
+    scores["mrr"] = next((1.0 / (rank + 1) for rank, iv in enumerate(intervals) if _hits(iv, relevant)), 0.0)
+    scores["tiou"] = max((_iou(intervals[0], r) for r in relevant), default=0.0) if intervals else 0.0
+    return scores
+
+
+def _frame_intervals(snapshot):
+    """Map keyframe timestamp -> (timestamp, next keyframe timestamp): the span a keyframe stands for"""
+    times = sorted(snapshot.metadata.column("timestamp").tolist())
+    ends = times[1:] + [times[-1] + 1.0] if times else []
+    return dict(zip(times, zip(times, ends)))
+
+
+def _index_bytes(index):
+    return int(faiss.serialize_index(index).nbytes) if index.ntotal else 0
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+# ---------------------------------------------------------------------------
+# 评测与参数扫描
+# ---------------------------------------------------------------------------
+
+def evaluate(dataset, video_retriever, audio_retriever, ks=(1, 5, 10), visual_params=None, audio_params=None,
+             use_reference_transcript=False):
+    """
+    Index every dataset video, run its queries and aggregate metrics.
+
+    Args:
+        visual_params: Extra kwargs for process_video (sample_rate, diff_threshold, ...)
+        audio_params: Extra kwargs for process_audio (language, ...)
+        use_reference_transcript: Index the dataset transcript instead of running Whisper
+
+    Returns:
+        {"visual": {...}, "audio": {...}} with mean metrics, query latency p50/p95 (ms),
+        ingest seconds, ntotal and index + metadata bytes per modality
+    """
+    from audio_processor import AudioExtractionError
+
+    visual_params, audio_params = visual_params or {}, audio_params or {}
+    k_max = max(ks)
+    per_modality = {m: {"scores": [], "latency": [], "ingest": 0.0, "ntotal": 0, "bytes": 0}
+                    for m in ("visual", "audio")}
+
+    for video in dataset["videos"]:
+        queries = [q for q in dataset["queries"] if q["video"] == video["id"]]
+        if not queries:
+            continue
+
+        t0 = time.perf_counter()
+        visual = video_retriever.process_video(
+            video["path"], target=IndexHandle(video_retriever.new_snapshot()), **visual_params
+        )
+        per_modality["visual"]["ingest"] += time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        audio_target = IndexHandle(audio_retriever.new_snapshot())
+        if use_reference_transcript:
+            audio = audio_retriever.index_segments(video.get("transcript") or [], video["path"], target=audio_target)
+        else:
+            try:
+                audio = audio_retriever.process_audio(video["path"], target=audio_target, **audio_params)
+            except AudioExtractionError as e:
+                print(f"[Eval Warning] {video['id']}: {e}")
+                audio = audio_target.current()
+        per_modality["audio"]["ingest"] += time.perf_counter() - t0
+
+        frame_spans = _frame_intervals(visual)
+        for name, snapshot in (("visual", visual), ("audio", audio)):
+            if snapshot is not None:
+                per_modality[name]["ntotal"] += snapshot.ntotal
+                per_modality[name]["bytes"] += _index_bytes(snapshot.index) + snapshot.metadata.nbytes()
+
+        for query in queries:
+            relevant = [tuple(r) for r in query["relevant"]]
+            if query["modality"] in ("visual", "both"):
+                t0 = time.perf_counter()
+                results = video_retriever.search(query["query"], k=k_max, snapshot=visual)
+                per_modality["visual"]["latency"].append((time.perf_counter() - t0) * 1000)
+                intervals = [frame_spans.get(ts, (ts, ts)) for ts, _, _ in results]
+                per_modality["visual"]["scores"].append(score_ranking(intervals, relevant, ks))
+            if query["modality"] in ("audio", "both") and audio is not None:
+                t0 = time.perf_counter()
+                results = audio_retriever.search(query["query"], k=k_max, snapshot=audio)
+                per_modality["audio"]["latency"].append((time.perf_counter() - t0) * 1000)
+                segments = dict(zip(audio.metadata.column("start").tolist(), audio.metadata.column("end").tolist()))
+                intervals = [(start, segments.get(start, start)) for start, _, _ in results]
+                per_modality["audio"]["scores"].append(score_ranking(intervals, relevant, ks))
+
+    report = {}
+    for name, acc in per_modality.items():
+        metrics = {}
+        if acc["scores"]:
+            for key in acc["scores"][0]:
+                metrics[key] = float(np.mean([s[key] for s in acc["scores"]]))
+        metrics.update(
+            queries=len(acc["scores"]),
+            latency_p50_ms=_percentile(acc["latency"], 50),
+            latency_p95_ms=_percentile(acc["latency"], 95),
+            ingest_seconds=acc["ingest"],
+            ntotal=acc["ntotal"],
+            index_bytes=acc["bytes"],
+        )
+        report[name] = metrics
+    return report
+
+
+def _split_params(params):
+    """{"visual.diff_threshold": 0.2, "audio.chunk_seconds": 120} -> constructor / process kwargs per modality"""
+    from audio_processor import AudioRetriever
+    from video_processor import VideoRetriever
+
+    ctor_args = {
+        "visual": set(inspect.signature(VideoRetriever.__init__).parameters),
+        "audio": set(inspect.signature(AudioRetriever.__init__).parameters),
+    }
+    split = {"visual": ({}, {}), "audio": ({}, {})}
+    for key, value in params.items():
+        modality, name = key.split(".", 1)
+        ctor, process = split[modality]
+        (ctor if name in ctor_args[modality] else process)[name] = value
+    return split
+
+
+def make_retriever_factory(stub=False, workdir=None):
+    """
+    Returns fn(visual_ctor_kwargs, audio_ctor_kwargs) -> (VideoRetriever, AudioRetriever).
+
+    Models are loaded once and injected into every configuration of the sweep.
+    """
+    from audio_processor import AudioRetriever
+    from video_processor import VideoRetriever
+
+    workdir = workdir or tempfile.mkdtemp(prefix="vrag_eval_")
+    shared = {}
+
+    def factory(visual_kwargs, audio_kwargs):
+        if not shared:
+            if stub:
+                clip_stub = StubClip()
+                shared.update(model=clip_stub, preprocess=clip_stub.preprocess,
+                              whisper_model=StubWhisper(), text_encoder=HashingTextEncoder())
+            else:
+                first_v = VideoRetriever(keyframe_dir=os.path.join(workdir, "keyframes"))
+                first_a = AudioRetriever(cache_dir=os.path.join(workdir, "audio_cache"))
+                shared.update(model=first_v.model, preprocess=first_v.preprocess,
+                              whisper_model=first_a.whisper_model, text_encoder=first_a.text_encoder)
+        video = VideoRetriever(model=shared["model"], preprocess=shared["preprocess"],
+                               keyframe_dir=os.path.join(workdir, "keyframes"), **visual_kwargs)
+        audio = AudioRetriever(whisper_model=shared["whisper_model"], text_encoder=shared["text_encoder"],
+                               cache_dir=os.path.join(workdir, "audio_cache"), **audio_kwargs)
+        return video, audio
+
+    return factory
+
+
+def sweep(dataset, grid, factory, ks=(1, 5, 10), use_reference_transcript=False):
+    """
+    Evaluate every combination of a parameter grid.
+
+    Args:
+        grid: {"visual.diff_threshold": [0.1, 0.15, 0.25], "audio.segment_window": [1, 3], ...};
+            names matching a retriever constructor argument configure the retriever,
+            the rest are passed to process_video / process_audio
+        factory: fn(visual_ctor_kwargs, audio_ctor_kwargs) -> (VideoRetriever, AudioRetriever)
+
+    Returns:
+        List of {"params": {...}, "report": {...}} rows
+    """
+    keys = sorted(grid)
+    rows = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        params = dict(zip(keys, values))
+        split = _split_params(params)
+        video, audio = factory(split["visual"][0], split["audio"][0])
+        print(f"[Eval] {params}")
+        report = evaluate(dataset, video, audio, ks=ks, visual_params=split["visual"][1],
+                          audio_params=split["audio"][1], use_reference_transcript=use_reference_transcript)
+        rows.append({"params": params, "report": report})
+    return rows
+
+
+def _row_quality(row, metric):
+    values = [m[metric] for m in row["report"].values() if m.get("queries") and metric in m]
+    return float(np.mean(values)) if values else 0.0
+
+
+def _row_latency(row):
+    return sum(m["latency_p50_ms"] for m in row["report"].values())
+
+
+def pareto_table(rows, metric="recall@5"):
+    """
+    Mark rows not dominated on (quality up, query latency down) and format a text table
+
+    Returns:
+        (rows sorted by latency with "quality"/"latency_ms"/"pareto" added, table string)
+    """
+    for row in rows:
+        row["quality"] = _row_quality(row, metric)
+        row["latency_ms"] = _row_latency(row)
+    for row in rows:
+        row["pareto"] = not any(
+            other["quality"] >= row["quality"] and other["latency_ms"] <= row["latency_ms"]
+            and (other["quality"] > row["quality"] or other["latency_ms"] < row["latency_ms"])
+            for other in rows
+        )
+    rows = sorted(rows, key=lambda r: r["latency_ms"])
+
+    header = f"{'pareto':<7}{metric:>10}{'mrr':>8}{'tIoU':>8}{'p50 ms':>9}{'ingest s':>10}{'index KB':>10}  params"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        report = row["report"]
+        lines.append(
+            f"{'*' if row['pareto'] else '':<7}{row['quality']:>10.3f}"
+            f"{_row_quality(row, 'mrr'):>8.3f}{_row_quality(row, 'tiou'):>8.3f}"
+            f"{row['latency_ms']:>9.2f}"
+            f"{sum(m['ingest_seconds'] for m in report.values()):>10.1f}"
+            f"{sum(m['index_bytes'] for m in report.values()) / 1024:>10.1f}  "
+            + ", ".join(f"{k}={v}" for k, v in row["params"].items())
+        )
+    return rows, "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Video-RAG retrieval quality / latency evaluation")
+    parser.add_argument("dataset", help="labelled dataset JSON (see load_dataset)")
+    parser.add_argument("--grid", help='JSON file or string, e.g. {"visual.diff_threshold": [0.1, 0.2]}')
+    parser.add_argument("--ks", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--metric", default="recall@5", help="quality axis of the Pareto table")
+    parser.add_argument("--stub", action="store_true", help="offline stub encoders (no model downloads)")
+    parser.add_argument("--out", help="write rows as JSON")
+    args = parser.parse_args()
+
+    dataset = load_dataset(args.dataset)
+    grid = {}
+    if args.grid:
+        grid = json.load(open(args.grid, encoding="utf-8")) if os.path.exists(args.grid) else json.loads(args.grid)
+
+    rows = sweep(dataset, grid, make_retriever_factory(stub=args.stub), ks=tuple(args.ks),
+                 use_reference_transcript=args.stub)
+    rows, table = pareto_table(rows, metric=args.metric)
+    print(table)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
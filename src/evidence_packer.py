@@ -0,0 +1,281 @@
+import glob
+import os
+import re
+import uuid
+from dataclasses import dataclass, field
+
+from PIL import Image
+
+
+def downscaled_copies(path):
+    """Cached downscaled copies of a keyframe (any resolution, any source version)"""
+    root, ext = os.path.splitext(path)
+    return glob.glob(f"{glob.escape(root)}_*_*{glob.escape(ext or '.jpg')}")
+
+
+def downscaled_copies_of(paths):
+    """
+    Cached downscaled copies of many keyframes; each directory is listed once.
+
+    Same match as downscaled_copies ({root}_{res}_{tag}{ext}), without one glob per keyframe.
+    """
+    wanted = {}
+    for path in paths:
+        directory, name = os.path.split(path)
+        root, ext = os.path.splitext(name)
+        wanted.setdefault(directory, {})[root] = ext or ".jpg"
+    copies = []
+    for directory, roots in wanted.items():
+        try:
+            names = os.listdir(directory or ".")
+        except FileNotFoundError:
+            continue
+        for name in names:
+            root, ext = os.path.splitext(name)
+            # 缓存名 = 原名 + "_{分辨率}_{版本}"，去掉最后两段就是原关键帧名
+            parts = root.rsplit("_", 2)
+            if len(parts) < 3 or roots.get(parts[0]) != ext:
+                continue
+            copies.append(os.path.join(directory, name))
+    return copies
+
+
+@dataclass
+class PackedEvidence:
+    images_info: list
+    audio_info: list
+    tokens_used: int
+    token_budget: int
+    image_tokens: int = 0
+    audio_tokens: int = 0
+    reserved_tokens: int = 0
+    dropped_images: int = 0
+    dropped_audio: int = 0
+    notes: list = field(default_factory=list)
+
+    def summary(self):
+        return (
+            f"{self.tokens_used}/{self.token_budget} tokens "
+            f"(images={len(self.images_info)}:{self.image_tokens}, "
+            f"audio={len(self.audio_info)}:{self.audio_tokens}, "
+            f"reserved={self.reserved_tokens}, "
+            f"dropped={self.dropped_images}+{self.dropped_audio})"
+        )
+
+
+class EvidencePacker:
+    def __init__(
+        self,
+        token_budget=2048,
+        tokenizer=None,
+        image_tokens=256,
+        image_resolution=448,
+        max_images=6,
+        max_audio=10,
+        min_time_gap=5.0,
+        redundancy_threshold=0.8,
+        order="time",
+    ):
+        """
+        Token-budgeted evidence packing for the VLM prompt.
+
+        Args:
+            token_budget: Total prompt tokens allowed for evidence + instructions
+            tokenizer: Tokenizer used to count text tokens (falls back to a char heuristic)
+            image_tokens: Tokens one image costs after the visual encoder (Qwen-VL: 256)
+            image_resolution: Max side length images are downscaled to before the VLM
+            max_images / max_audio: Hard caps per modality
+            min_time_gap: Evidence closer than this (seconds) to a picked item is penalised
+            redundancy_threshold: Transcript word-overlap above which a snippet is a duplicate
+            order: "time" (chronological) or "relevance" for the packed lists
+        """
+        self.token_budget = token_budget
+        self.tokenizer = tokenizer
+        self.image_tokens = image_tokens
+        self.image_resolution = image_resolution
+        self.max_images = max_images
+        self.max_audio = max_audio
+        self.min_time_gap = min_time_gap
+        self.redundancy_threshold = redundancy_threshold
+        self.order = order
+
+    def estimate_text_tokens(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            try:
+                return len(self.tokenizer.encode(text))
+            except Exception:
+                pass
+        # 粗略估计：中日韩字符约 1 token/字，其余约 4 字符/token
+        cjk = len(re.findall(r"[぀-ヿ㐀-鿿가-힯]", text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def estimate_image_tokens(self, path=None):
+        # Qwen-VL 把每张图片压缩成固定数量的视觉 token，外加 <img></img> 两个边界 token
+        return self.image_tokens + 2
+
+    def _image_line_tokens(self, ts):
+        return self.estimate_text_tokens(f"Image 00: Timestamp {self._fmt(ts)}\n")
+
+    def _audio_line_tokens(self, ts, text):
+        return self.estimate_text_tokens(f"- At {self._fmt(ts)}: \"{text}\"\n")
+
+    @staticmethod
+    def _fmt(ts):
+        m, s = divmod(int(ts), 60)
+        return f"{m:02d}:{s:02d}"
+
+    @staticmethod
+    def _relevance(distances):
+        """Map L2 distances (lower is better) to [0, 1] relevance within one modality"""
+        if not distances:
+            return []
+        # 归一化向量上的平方 L2 距离: d = 2 - 2cos
+        sims = [1.0 - float(d) / 2.0 for d in distances]
+        lo, hi = min(sims), max(sims)
+        if hi - lo < 1e-6:
+            return [1.0 for _ in sims]
+        return [(s - lo) / (hi - lo) for s in sims]
+
+    @staticmethod
+    def _words(text):
+        return set(re.findall(r"\w+", text.lower()))
+
+    def _is_redundant(self, text, picked_texts):
+        words = self._words(text)
+        if not words:
+            return True
+        for other in picked_texts:
+            if not other:
+                continue
+            overlap = len(words & other) / max(1, min(len(words), len(other)))
+            if overlap >= self.redundancy_threshold:
+                return True
+        return False
+
+    def _time_penalty(self, ts, picked_times):
+        if not picked_times or self.min_time_gap <= 0:
+            return 0.0
+        nearest = min(abs(ts - t) for t in picked_times)
+        if nearest >= self.min_time_gap:
+            return 0.0
+        return 0.5 * (1.0 - nearest / self.min_time_gap)
+
+    def downscale(self, path):
+        """Return a copy of the keyframe no larger than image_resolution (cached next to it)"""
+        if not self.image_resolution or not path or not os.path.exists(path):
+            return path
+        root, ext = os.path.splitext(path)
+        # 关键帧文件名每次上传都会复用，缓存名带上源文件的 mtime/大小，旧副本不会被误用
+        stat = os.stat(path)
+        small_path = f"{root}_{self.image_resolution}_{stat.st_mtime_ns:x}-{stat.st_size:x}{ext or '.jpg'}"
+        if os.path.exists(small_path):
+            return small_path
+        # 同一进程内并发查询可能同时缩放同一关键帧：临时文件名按调用区分
+        tmp_path = f"{root}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}{ext or '.jpg'}"
+        try:
+            with Image.open(path) as img:
+                if max(img.size) <= self.image_resolution:
+                    return path
+                img = img.convert("RGB")
+                img.thumbnail((self.image_resolution, self.image_resolution), Image.BICUBIC)
+                img.save(tmp_path, quality=90)
+            os.replace(tmp_path, small_path)
+            for stale in downscaled_copies(path):
+                if stale != small_path:
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+            return small_path
+        except Exception as e:
+            print(f"[Packer Warning] 缩放失败 {os.path.basename(path)}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return path
+
+    def pack(self, images_info, audio_info, reserved_tokens=0, token_budget=None):
+        """
+        Choose, downscale and order evidence under a token budget.
+
+        Args:
+            images_info: [(timestamp, distance, path), ...] from VideoRetriever.search
+            audio_info: [(start, text, distance), ...] from AudioRetriever.search
+            reserved_tokens: Tokens already spent on query + instructions
+            token_budget: Override for self.token_budget
+
+        Returns:
+            PackedEvidence
+        """
+        budget = token_budget if token_budget is not None else self.token_budget
+        images_info = list(images_info or [])
+        audio_info = list(audio_info or [])
+
+        candidates = []
+        for item, rel in zip(images_info, self._relevance([d for _, d, _ in images_info])):
+            ts = item[0]
+            cost = self.estimate_image_tokens(item[2]) + self._image_line_tokens(ts)
+            candidates.append(("image", item, rel, ts, cost))
+        for item, rel in zip(audio_info, self._relevance([d for _, _, d in audio_info])):
+            ts, text = item[0], item[1]
+            cost = self._audio_line_tokens(ts, text)
+            candidates.append(("audio", item, rel, ts, cost))
+
+        used = reserved_tokens
+        picked = {"image": [], "audio": []}
+        picked_times = {"image": [], "audio": []}
+        picked_texts = []
+        spent = {"image": 0, "audio": 0}
+        caps = {"image": self.max_images, "audio": self.max_audio}
+        notes = []
+
+        # 贪心选择：每轮挑选 (相关性 - 时间邻近惩罚) 最高且放得下的证据
+        remaining = list(candidates)
+        while remaining:
+            best, best_gain = None, None
+            for cand in remaining:
+                kind, item, rel, ts, cost = cand
+                gain = rel - self._time_penalty(ts, picked_times[kind])
+                if best_gain is None or gain > best_gain:
+                    best, best_gain = cand, gain
+            remaining.remove(best)
+            kind, item, rel, ts, cost = best
+            if len(picked[kind]) >= caps[kind]:
+                continue
+            if used + cost > budget:
+                notes.append(f"{kind}@{self._fmt(ts)} over budget")
+                continue
+            if kind == "audio":
+                if self._is_redundant(item[1], picked_texts):
+                    notes.append(f"audio@{self._fmt(ts)} redundant")
+                    continue
+                picked_texts.append(self._words(item[1]))
+            picked[kind].append((item, rel))
+            picked_times[kind].append(ts)
+            spent[kind] += cost
+            used += cost
+
+        for kind in picked:
+            if self.order == "time":
+                picked[kind].sort(key=lambda x: x[0][0])
+            else:
+                picked[kind].sort(key=lambda x: -x[1])
+
+        packed_images = [
+            (ts, score, self.downscale(path)) for (ts, score, path), _ in picked["image"]
+        ]
+        packed_audio = [item for item, _ in picked["audio"]]
+
+        return PackedEvidence(
+            images_info=packed_images,
+            audio_info=packed_audio,
+            tokens_used=used,
+            token_budget=budget,
+            image_tokens=spent["image"],
+            audio_tokens=spent["audio"],
+            reserved_tokens=reserved_tokens,
+            dropped_images=len(images_info) - len(packed_images),
+            dropped_audio=len(audio_info) - len(packed_audio),
+            notes=notes,
+        )
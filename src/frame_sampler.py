@@ -0,0 +1,202 @@
+import math
+
+import cv2
+import numpy as np
+
+
+def frame_signature(frame):
+    """Keyframe detector's view of a BGR frame: min-max normalised hue histogram of a 64x64 thumbnail"""
+    small = cv2.resize(frame, (64, 64))
+    hist = cv2.calcHist([cv2.cvtColor(small, cv2.COLOR_BGR2HSV)], [0], None, [256], [0, 256])
+    cv2.normalize(hist, hist, 0, 1, cv2.NORM_MINMAX)
+    return hist
+
+
+def signature_diff(a, b):
+    """Bhattacharyya distance between two signatures (0 = identical)"""
+    return cv2.compareHist(a, b, cv2.HISTCMP_BHATTACHARYYA)
+
+
+class FrameReader:
+    """
+    Random-access reads over a cv2.VideoCapture that count the decode work.
+
+    Short forward gaps are skipped with grab() (decoded, but without colour conversion);
+    backward or long jumps seek. A seek lands on the preceding GOP keyframe and decodes
+    forward from there inside the backend; that hidden work is estimated as half a GOP.
+    """
+
+    def __init__(self, cap, seek_threshold=100, gop_size=250):
+        """
+        Args:
+            seek_threshold: Longest forward gap walked with grab() instead of seeking
+            gop_size: Assumed keyframe interval of the source (libx264 default) for seek cost estimates
+        """
+        self.cap = cap
+        self.seek_threshold = seek_threshold
+        self.gop_size = gop_size
+        self.pos = 0
+        self.retrieved = 0
+        self.grabbed = 0
+        self.seeks = 0
+        self.seek_decoded = 0
+
+    def _seek(self, frame_idx):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        self.seeks += 1
+        self.seek_decoded += min(frame_idx, self.gop_size // 2)
+
+    def seek(self, frame_idx):
+        """Position the stream so the next read(frame_idx) decodes forward from here"""
+        self._seek(frame_idx)
+        self.pos = frame_idx
+
+    def read(self, frame_idx):
+        """Frame at frame_idx, or None past the end of the stream"""
+        gap = frame_idx - self.pos
+        if gap < 0 or gap > self.seek_threshold:
+            self._seek(frame_idx)
+        else:
+            for _ in range(gap):
+                if not self.cap.grab():
+                    self.pos = frame_idx
+                    return None
+                self.grabbed += 1
+        ret, frame = self.cap.read()
+        self.pos = frame_idx + 1
+        if not ret:
+            return None
+        self.retrieved += 1
+        return frame
+
+    @property
+    def decoded(self):
+        """Frames the decoder worked through: compared + grabbed + (estimated) decoded behind seeks"""
+        return self.retrieved + self.grabbed + self.seek_decoded
+
+    def stats(self):
+        return {"retrieved": self.retrieved, "grabbed": self.grabbed, "seeks": self.seeks,
+                "seek_decoded": self.seek_decoded}
+
+
+def fixed_samples(reader, step, start_frame=0, end_frame=None):
+    """
+    Every step-th frame of the video (on the global grid 0, step, 2*step, ...) in [start_frame, end_frame)
+
+    Yields:
+        (frame_idx, frame, signature)
+    """
+    frame_idx = -(-start_frame // step) * step
+    while end_frame is None or frame_idx < end_frame:
+        frame = reader.read(frame_idx)
+        if frame is None:
+            break
+        yield frame_idx, frame, frame_signature(frame)
+        frame_idx += step
+
+
+def fixed_keyframes(reader, step, diff_threshold, end_frame=None):
+    """
+    Fixed-rate sampling: every step-th frame, kept when it differs from the last kept frame
+
+    Yields:
+        (frame_idx, frame) for each keyframe
+    """
+    reference = None
+    for frame_idx, frame, signature in fixed_samples(reader, step, end_frame=end_frame):
+        if reference is None or signature_diff(reference, signature) > diff_threshold:
+            reference = signature
+            yield frame_idx, frame
+
+
+def adaptive_keyframes(reader, coarse_step, fine_step, diff_threshold, end_frame):
+    """
+    Coarse-to-fine sampling: walk at coarse_step and, when a coarse sample differs
+    from the last keyframe, locate the first changed frame (to fine_step resolution)
+    in that interval.
+
+    The coarse walk only moves forward with grab() (the reader's seek threshold is
+    raised to coarse_step), so static stretches cost one comparison per coarse_step
+    and no seeks. Locating a change costs one seek back to the previous coarse
+    sample and a forward scan at fine_step up to the change; a binary search would
+    seek (and re-decode from the GOP start) on every backward probe.
+
+    A change that reverts within one coarse interval is not seen.
+
+    Yields:
+        (frame_idx, frame) for each keyframe
+    """
+    reader.seek_threshold = max(reader.seek_threshold, coarse_step)
+    frame = reader.read(0)
+    if frame is None:
+        return
+    reference = frame_signature(frame)
+    yield 0, frame
+
+    lo = 0
+    while lo < end_frame - 1:
+        hi = min(lo + coarse_step, end_frame - 1)
+        frame = reader.read(hi)
+        if frame is None:
+            break
+        signature = frame_signature(frame)
+        if signature_diff(reference, signature) <= diff_threshold:
+            lo = hi
+            continue
+        # lo 与参考帧相同，hi 已变化：回到 lo 向前扫描，第一个变化的精采样帧即为关键帧
+        for idx in range(lo + fine_step, hi, fine_step):
+            probe = reader.read(idx)
+            if probe is None:
+                break
+            probe_signature = frame_signature(probe)
+            if signature_diff(reference, probe_signature) > diff_threshold:
+                hi, frame, signature = idx, probe, probe_signature
+                break
+        reference = signature
+        yield hi, frame
+        lo = hi
+
+
+def fixed_rate_equivalent(end_frame, step):
+    """Frames a fixed-rate sampler with this step would decode and compare"""
+    return int(math.ceil(end_frame / step)) if end_frame > 0 else 0
+
+
+class FrameRing:
+    """
+    Preallocated (capacity, size, size, 3) RGB uint8 batch of model-resolution crops.
+
+    Frames are shrunk (short side -> size, centre crop) as soon as they are kept, so
+    memory per batch is fixed by the model input size, not the source resolution.
+    """
+
+    def __init__(self, capacity, size):
+        self.buffer = np.empty((capacity, size, size, 3), dtype=np.uint8)
+        self.size = size
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count == len(self.buffer)
+
+    def put(self, frame):
+        """Copy a BGR frame into the next slot (resize + crop, colour converted in place)"""
+        h, w = frame.shape[:2]
+        scale = self.size / min(h, w)
+        new_w, new_h = max(self.size, round(w * scale)), max(self.size, round(h * scale))
+        # 缩小用 INTER_AREA（抗混叠），放大用 INTER_CUBIC
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        resized = cv2.resize(frame, (new_w, new_h), interpolation=interpolation)
+        top, left = (new_h - self.size) // 2, (new_w - self.size) // 2
+        slot = self.buffer[self.count]
+        slot[...] = resized[top:top + self.size, left:left + self.size]
+        cv2.cvtColor(slot, cv2.COLOR_BGR2RGB, dst=slot)
+        self.count += 1
+
+    def view(self):
+        return self.buffer[:self.count]
+
+    def clear(self):
+        self.count = 0
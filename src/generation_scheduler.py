@@ -0,0 +1,231 @@
+import json
+import threading
+import time
+from collections import deque
+
+from tracing import tracer
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class GenerationRequest:
+    """Handle for one queued generation; returned by GenerationScheduler.submit"""
+
+    def __init__(self, prompt, gen_params, session_id=None, scheduler=None):
+        self.prompt = prompt
+        self.gen_params = dict(gen_params or {})
+        self.session_id = session_id
+        self.params_key = json.dumps(self.gen_params, sort_keys=True, default=str)
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.response = None
+        self.error = None
+        self.cancelled = False
+        self.trace_parent = tracer.current()
+        self._scheduler = scheduler
+        self._done = threading.Event()
+
+    def cancel(self):
+        """Cancel if still queued; returns False once generation has started"""
+        if self._scheduler is not None:
+            return self._scheduler._cancel(self)
+        if self.started_at is not None or self._done.is_set():
+            return False
+        self.cancelled = True
+        self._done.set()
+        return True
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("generation timed out")
+        if self.cancelled:
+            raise GenerationCancelled()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class GenerationScheduler:
+    def __init__(self, handler, max_batch_size=4, max_wait_ms=20, max_queue=64, history_size=512):
+        """
+        Queue generation requests and micro-batch compatible ones.
+
+        Args:
+            handler: Object with generate_batch(prompts, gen_params) -> list[str]
+                (VLMHandler, or any CPU stub with the same method); session requests
+                call handler.generate_session(session_id, prompt, gen_params) instead
+            max_batch_size: Max requests per model call
+            max_wait_ms: How long the first request waits for batch partners
+            max_queue: Max pending requests before submit() rejects
+            history_size: Number of recent requests kept for latency percentiles
+        """
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._stopped = False
+
+        self._latencies = deque(maxlen=history_size)
+        self._waits = deque(maxlen=history_size)
+        self._batch_sizes = deque(maxlen=history_size)
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.in_flight = 0
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._stopped = False
+            self._worker = threading.Thread(target=self._run, name="vlm-scheduler", daemon=True)
+            self._worker.start()
+
+    def submit(self, prompt, gen_params=None, session_id=None):
+        request = GenerationRequest(prompt, gen_params, session_id=session_id, scheduler=self)
+        with self._cond:
+            if self._stopped and self._worker is not None and self._worker.is_alive():
+                raise RuntimeError("generation scheduler is stopping")
+            if len(self._pending) >= self.max_queue:
+                raise RuntimeError(f"generation queue full ({self.max_queue})")
+            self._pending.append(request)
+            self._ensure_worker()
+            self._cond.notify()
+        return request
+
+    def generate(self, prompt, gen_params=None, timeout=None, session_id=None):
+        """Blocking submit + wait"""
+        request = self.submit(prompt, gen_params, session_id=session_id)
+        try:
+            return request.result(timeout)
+        except TimeoutError:
+            request.cancel()
+            raise
+
+    def _cancel(self, request):
+        # 与 _next_batch 在同一把锁下：请求要么被取走开始生成，要么从队列移除
+        with self._cond:
+            if request.started_at is not None or request._done.is_set():
+                return False
+            try:
+                self._pending.remove(request)
+            except ValueError:
+                # 已被 _next_batch 取出、尚未标记开始：由它跳过
+                pass
+            request.cancelled = True
+            self.cancelled += 1
+            request._done.set()
+            return True
+
+    def stop(self):
+        """Stop the worker; requests still queued fail with RuntimeError instead of waiting forever"""
+        with self._cond:
+            self._stopped = True
+            pending, self._pending = list(self._pending), deque()
+            for request in pending:
+                request.error = RuntimeError("generation scheduler stopped")
+                request.finished_at = time.time()
+                request._done.set()
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout=5)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return []
+            first = self._pending.popleft()
+            batch = [first]
+            deadline = time.time() + self.max_wait
+            # 在等待窗口内收集参数相同的请求（会话请求带独立 KV 缓存，不参与合批）
+            while first.session_id is None and len(batch) < self.max_batch_size:
+                for request in list(self._pending):
+                    if request.session_id is None and request.params_key == first.params_key:
+                        self._pending.remove(request)
+                        batch.append(request)
+                        if len(batch) >= self.max_batch_size:
+                            break
+                remaining = deadline - time.time()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            live = []
+            for request in batch:
+                if not request.cancelled:
+                    request.started_at = time.time()
+                    live.append(request)
+            return live
+
+    def _run(self):
+        while not self._stopped:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            self.in_flight = len(batch)
+            self._batch_sizes.append(len(batch))
+            for request in batch:
+                tracer.record("scheduler.queue_wait", request.started_at - request.enqueued_at,
+                              parent=request.trace_parent)
+            try:
+                with tracer.span("vlm.generate", parent=batch[0].trace_parent, batch_size=len(batch)):
+                    if batch[0].session_id is not None:
+                        responses = [
+                            self.handler.generate_session(batch[0].session_id, batch[0].prompt, batch[0].gen_params)
+                        ]
+                    else:
+                        responses = self.handler.generate_batch(
+                            [r.prompt for r in batch], batch[0].gen_params
+                        )
+                if len(responses) != len(batch):
+                    # zip 会让多出来的请求静默地以 None 结束
+                    raise RuntimeError(f"handler returned {len(responses)} responses for {len(batch)} requests")
+                for request, response in zip(batch, responses):
+                    request.response = response
+                self.completed += len(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                self.failed += len(batch)
+            finally:
+                now = time.time()
+                for request in batch:
+                    request.finished_at = now
+                    self._latencies.append(now - request.enqueued_at)
+                    self._waits.append(request.started_at - request.enqueued_at)
+                    request._done.set()
+                self.in_flight = 0
+
+    @staticmethod
+    def _percentile(values, q):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        pos = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[pos]
+
+    def metrics(self):
+        latencies = list(self._latencies)
+        waits = list(self._waits)
+        sizes = list(self._batch_sizes)
+        return {
+            "queue_depth": len(self._pending),
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "avg_batch_size": sum(sizes) / len(sizes) if sizes else 0.0,
+            "latency_p50": self._percentile(latencies, 0.50),
+            "latency_p95": self._percentile(latencies, 0.95),
+            "queue_wait_p50": self._percentile(waits, 0.50),
+            "queue_wait_p95": self._percentile(waits, 0.95),
+        }
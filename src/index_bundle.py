@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+import uuid
+
+from index_storage import load_snapshot, save_snapshot
+
+BUNDLE_VERSION = 1
+LIBRARIES = ("visual", "audio")
+
+
+def model_info(services):
+    """Identifiers of the encoders a bundle's vectors were produced with"""
+    return {
+        "visual": {"encoder": services.retriever.model_name, "dim": services.retriever.dimension},
+        "audio": {
+            "encoder": services.audio_retriever.text_model_name,
+            "dim": services.audio_retriever.dimension,
+            "whisper": services.audio_retriever.whisper_model_size,
+            "segment_window": services.audio_retriever.segment_window,
+        },
+    }
+
+
+def _sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _list_files(root):
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            yield os.path.relpath(path, root).replace(os.sep, "/"), path
+
+
+def resolve_bundle_path(services, path):
+    """
+    Absolute location of a bundle inside the configured bundle root (AppServices.bundle_root)
+
+    Relative paths are taken relative to the root; anything resolving outside it
+    (absolute paths elsewhere, "..", symlinks) raises ValueError.
+    """
+    root = os.path.realpath(services.bundle_root())
+    resolved = os.path.realpath(os.path.join(root, path))
+    if not resolved.startswith(root + os.sep):
+        raise ValueError(f"bundle path must be inside the bundle directory {root}: {path}")
+    return resolved
+
+
+def export_bundle(services, path, session_id=None):
+    """
+    Write a session's (default: the process-wide) visual + audio libraries as a bundle.
+
+    Layout (a directory, or the same tree in an uncompressed .tar when path ends in .tar):
+
+        bundle.json    bundle version / id, model identifiers, per-file size + sha256
+        visual/        index_storage layout (vectors, columnar metadata, keyframes)
+        audio/         index_storage layout
+
+    The path is resolved inside the bundle root (see resolve_bundle_path) and must not
+    exist yet; the bundle is built in a private staging directory and moved into place.
+
+    Returns:
+        The bundle manifest
+    """
+    path = resolve_bundle_path(services, path)
+    if os.path.lexists(path):
+        raise FileExistsError(f"bundle already exists: {path}")
+    as_tar = path.endswith(".tar")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 只删除自己创建的暂存目录，绝不删除调用方给的路径
+    staging = f"{path}.staging-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    os.makedirs(staging)
+    try:
+        libraries = {}
+        # 固定这一代：复制期间并发的删除/压缩不能先删掉它的关键帧（save_snapshot 会跳过缺失文件）
+        with services.indexes.lookup(session_id).acquire() as snapshots:
+            for name, snapshot in zip(LIBRARIES, snapshots):
+                save_snapshot(snapshot, os.path.join(staging, name))
+                libraries[name] = {"snapshot_id": snapshot.snapshot_id, "ntotal": snapshot.ntotal,
+                                   "videos": snapshot.videos}
+
+        manifest = {
+            "bundle_version": BUNDLE_VERSION,
+            "bundle_id": uuid.uuid4().hex[:12],
+            "created_at": time.time(),
+            "models": model_info(services),
+            "libraries": libraries,
+            "files": {
+                rel: {"size": os.path.getsize(full), "sha256": _sha256(full)}
+                for rel, full in sorted(_list_files(staging))
+            },
+        }
+        with open(os.path.join(staging, "bundle.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+        if as_tar:
+            # 不压缩：向量本身几乎不可压缩，导入时可直接解包后 mmap
+            tar_path = os.path.join(staging, "bundle.tar")
+            with tarfile.open(tar_path, "w") as tar:
+                tar.add(os.path.join(staging, "bundle.json"), arcname="bundle.json")
+                for name in LIBRARIES:
+                    tar.add(os.path.join(staging, name), arcname=name)
+            # link 在目标已存在时失败，不会覆盖并发写入的同名包
+            os.link(tar_path, path)
+        else:
+            if os.path.lexists(path):
+                raise FileExistsError(f"bundle already exists: {path}")
+            os.rename(staging, path)
+            staging = None
+    finally:
+        if staging:
+            shutil.rmtree(staging, ignore_errors=True)
+    print(f"[Bundle] Exported {manifest['bundle_id']} -> {path} "
+          f"({libraries['visual']['ntotal']} frames, {libraries['audio']['ntotal']} segments)")
+    return manifest
+
+
+def _extract(path, dest):
+    with tarfile.open(path, "r") as tar:
+        members = tar.getmembers()
+        for member in members:
+            target = os.path.abspath(os.path.join(dest, member.name))
+            if not target.startswith(os.path.abspath(dest) + os.sep) or not (member.isfile() or member.isdir()):
+                raise ValueError(f"unsafe bundle member: {member.name}")
+        tar.extractall(dest, members=members)
+
+
+def read_manifest(bundle_dir):
+    with open(os.path.join(bundle_dir, "bundle.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("bundle_version") != BUNDLE_VERSION:
+        raise ValueError(f"bundle version {manifest.get('bundle_version')} unsupported, expected {BUNDLE_VERSION}")
+    # bundle_id 会拼进导入目录名
+    if not re.fullmatch(r"[0-9A-Za-z_-]{1,64}", str(manifest.get("bundle_id", ""))):
+        raise ValueError(f"invalid bundle id: {manifest.get('bundle_id')!r}")
+    return manifest
+
+
+def verify_bundle(bundle_dir, manifest):
+    """Raise ValueError on a missing, truncated or corrupted file"""
+    for rel, expected in manifest["files"].items():
+        full = os.path.join(bundle_dir, rel)
+        if not os.path.isfile(full) or os.path.getsize(full) != expected["size"]:
+            raise ValueError(f"bundle file missing or truncated: {rel}")
+        if _sha256(full) != expected["sha256"]:
+            raise ValueError(f"bundle checksum mismatch: {rel}")
+
+
+def check_models(services, manifest):
+    """The running encoders must match the bundle's, otherwise query vectors are incomparable"""
+    running = model_info(services)
+    for name in LIBRARIES:
+        bundled = manifest["models"][name]
+        for key in ("encoder", "dim"):
+            if bundled[key] != running[name][key]:
+                raise ValueError(
+                    f"bundle {name} {key} is {bundled[key]!r} but this node runs {running[name][key]!r}"
+                )
+
+
+def import_bundle(services, path, session_id=None, verify=True):
+    """
+    Open a bundle (directory or .tar) memory-mapped and publish it as a session's libraries.
+
+    The path is resolved inside the bundle root (see resolve_bundle_path). A .tar is
+    unpacked next to the persisted libraries (VRAG_INDEX_DIR) or into the bundle root.
+    Importing into the default library with an index directory configured moves the
+    libraries into it, so they are loaded again on restart.
+
+    Args:
+        verify: Check every file's sha256 before publishing (reads the whole bundle once)
+
+    Returns:
+        The bundle manifest
+    """
+    path = resolve_bundle_path(services, path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"bundle not found: {path}")
+    root = services.index_dir or services.bundle_root()
+    os.makedirs(root, exist_ok=True)
+    staging = None
+    if os.path.isdir(path):
+        bundle_dir = path
+    else:
+        staging = os.path.join(root, f".bundle-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+        _extract(path, staging)
+        bundle_dir = staging
+
+    try:
+        manifest = read_manifest(bundle_dir)
+        if verify:
+            verify_bundle(bundle_dir, manifest)
+        check_models(services, manifest)
+
+        if session_id is None and services.index_dir:
+            library_root = services.index_dir
+            for name in LIBRARIES:
+                source = os.path.join(bundle_dir, name)
+                incoming = os.path.join(library_root, f"{name}.import-{os.getpid()}")
+                if staging:
+                    os.rename(source, incoming)
+                else:
+                    shutil.copytree(source, incoming)
+                # 与 save_snapshot 相同的换目录方式：正在 mmap 旧库的读者不受影响
+                target, old = os.path.join(library_root, name), os.path.join(library_root, f"{name}.old-{os.getpid()}")
+                if os.path.exists(target):
+                    os.rename(target, old)
+                os.rename(incoming, target)
+                shutil.rmtree(old, ignore_errors=True)
+        elif staging:
+            library_root = os.path.join(root, "bundles", manifest["bundle_id"])
+            # 同一 bundle_id 已导入过（可能仍被某个会话 mmap）：沿用，不覆盖
+            if not os.path.isdir(library_root):
+                os.makedirs(os.path.dirname(library_root), exist_ok=True)
+                os.rename(staging, library_root)
+                staging = None
+        else:
+            library_root = bundle_dir
+    finally:
+        if staging:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    session = services.indexes.get(session_id)
+    for name, handle in zip(LIBRARIES, (session.visual, session.audio)):
+        handle.publish(load_snapshot(os.path.join(library_root, name)))
+    print(f"[Bundle] Imported {manifest['bundle_id']} from {path} (mmap: {library_root})")
+    return manifest
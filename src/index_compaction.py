@@ -0,0 +1,148 @@
+import os
+import queue
+import threading
+import time
+import traceback
+
+from evidence_packer import downscaled_copies_of
+from index_filters import copy_library
+from index_state import IndexSnapshot
+from tracing import tracer
+
+
+def tombstone_videos(base, video_ids):
+    """
+    New generation of base with the given videos removed from search.
+
+    Vectors, metadata and segment level are shared with base (nothing is copied), so
+    it can be published at once; the removed rows stay in the index until compaction.
+    """
+    video_ids = set(video_ids)
+    snapshot = IndexSnapshot(base.index, base.metadata, assets_dir=base.assets_dir, source=base.source)
+    snapshot.storage_dir = base.storage_dir
+    snapshot.lineage = base.lineage
+    snapshot.segments = base.segments
+    snapshot.videos = [dict(v) for v in base.videos if v["video_id"] not in video_ids]
+    snapshot.tombstones = [dict(v) for v in base.tombstones] + [
+        dict(v) for v in base.videos if v["video_id"] in video_ids
+    ]
+    snapshot.next_video_id = max(
+        [base.next_video_id] + [v["video_id"] + 1 for v in base.videos + base.tombstones]
+    )
+    return snapshot
+
+
+def compact_snapshot(base, fresh):
+    """Rebuild base into the empty snapshot `fresh` without its tombstoned rows"""
+    copy_library(base, fresh)
+    fresh.source = base.source
+    fresh.assets_dir = base.assets_dir
+    return fresh
+
+
+def removed_assets(snapshot, video_ids, field="path"):
+    """
+    Keyframe files of the given videos (and their cached downscaled copies, see
+    evidence_packer.downscale) that can be deleted with them.
+
+    Files inside a persisted library (storage_dir) are left alone; they go away when
+    the library is saved again.
+    """
+    if field not in snapshot.metadata.schema:
+        return []
+    keep_root = os.path.abspath(snapshot.storage_dir) + os.sep if snapshot.storage_dir else None
+    paths = []
+    for video in snapshot.videos + snapshot.tombstones:
+        if video["video_id"] not in video_ids:
+            continue
+        for i in range(video["start_id"], video["end_id"]):
+            path = snapshot.metadata.string(field, i)
+            if keep_root is None or not os.path.abspath(path).startswith(keep_root):
+                paths.append(path)
+    # 共享资产目录只列一次，而不是每个关键帧 glob 一遍
+    return paths + downscaled_copies_of(paths)
+
+
+def delete_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Compactor:
+    def __init__(self, delay=2.0):
+        """
+        Background compaction of tombstoned generations.
+
+        Each library is rebuilt off-lock from the generation it started with and
+        hot-swapped only if that generation is still current; otherwise (an ingestion
+        or another removal published meanwhile) it is retried on the newer one. The
+        ingestion lock is never taken, so a long (or live) ingestion does not stall it.
+
+        Args:
+            delay: Seconds to wait after a removal, so a burst of removals is compacted once
+        """
+        self.delay = delay
+        self.compactions = 0
+        self.retries = 0
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="index-compactor", daemon=True).start()
+
+    def submit(self, session, factories, on_done=None):
+        """
+        Args:
+            session: SessionIndexes to compact
+            factories: {"visual": fn() -> empty snapshot, "audio": ...} (the retrievers' new_snapshot)
+            on_done: Optional fn(session) after at least one library was swapped
+        """
+        with self._lock:
+            if id(session) in self._pending:
+                return
+            self._pending.add(id(session))
+        self._queue.put((time.time() + self.delay, session, factories, on_done))
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            due, session, factories, on_done = self._queue.get()
+            time.sleep(max(0.0, due - time.time()))
+            with self._lock:
+                self._pending.discard(id(session))
+            try:
+                if self.compact(session, factories, on_done) and on_done:
+                    on_done(session)
+            except Exception:
+                traceback.print_exc()
+
+    def compact(self, session, factories, on_done=None):
+        """Compact a session's tombstoned libraries now; True if any was swapped in"""
+        swapped = False
+        for name, handle in (("visual", session.visual), ("audio", session.audio)):
+            base = handle.current()
+            if not base.tombstones:
+                continue
+            start = time.time()
+            with tracer.span("index.compact", library=name, ntotal=base.ntotal) as span:
+                snapshot = compact_snapshot(base, factories[name]())
+                span.set(dropped=base.ntotal - snapshot.ntotal)
+            if not handle.publish_if(snapshot, expected=base):
+                # 压缩期间有新一代发布：若它仍带墓碑，稍后基于它重做
+                self.retries += 1
+                if handle.current().tombstones:
+                    self.submit(session, factories, on_done)
+                continue
+            self.compactions += 1
+            swapped = True
+            print(f"[Compact] {name}: dropped {base.ntotal - snapshot.ntotal} rows of "
+                  f"{len(base.tombstones)} removed videos, {snapshot.ntotal} remain ({time.time() - start:.2f}s)")
+        return swapped
+
+    def stats(self):
+        return {"compactions": self.compactions, "retries": self.retries, "pending": self.pending()}
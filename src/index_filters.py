@@ -0,0 +1,147 @@
+import faiss
+import numpy as np
+
+
+def flat_vectors(index):
+    """Zero-copy (ntotal, d) view of a flat index's vectors, or None for other index types"""
+    if hasattr(index, "xb"):
+        return index.xb
+    if isinstance(index, faiss.IndexFlat):
+        if index.ntotal == 0:
+            return np.zeros((0, index.d), dtype="float32")
+        return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+    return None
+
+
+def copy_library(base, snapshot):
+    """
+    Seed an empty snapshot with base's vectors, metadata rows, video table and segment
+    level (append ingestion, compaction).
+
+    Rows of tombstoned videos are left out and the remaining videos move down to
+    contiguous ids, so every copy is also a compaction.
+    """
+    n = base.ntotal
+    videos = [dict(v) for v in base.videos]
+    if n and not videos and not base.tombstones:
+        # 旧快照没有视频表：整库视为一个视频
+        videos = [{"video_id": 0, "source": base.source, "start_id": 0, "end_id": n}]
+    moves = None
+    if base.tombstones:
+        # [(旧起点, 旧终点, 新起点)]：保留的视频按原顺序紧凑排列
+        moves, position = [], 0
+        for video in sorted(videos, key=lambda v: v["start_id"]):
+            lo, hi = video["start_id"], video["end_id"]
+            moves.append((lo, hi, position))
+            video["start_id"], video["end_id"] = position, position + hi - lo
+            position += hi - lo
+        ids = np.concatenate([np.arange(lo, hi, dtype=np.int64) for lo, hi, _ in moves] or [np.zeros(0, np.int64)])
+    else:
+        ids = np.arange(n, dtype=np.int64)
+    if len(ids):
+        vectors = flat_vectors(base.index)
+        if vectors is None:
+            vectors = base.index.reconstruct_n(0, n)
+        vectors = vectors[ids] if moves is not None else vectors
+        snapshot.index.add(np.ascontiguousarray(vectors, dtype="float32"))
+        snapshot.metadata.append(**base.metadata.gather(ids))
+    snapshot.videos = videos
+    snapshot.lineage = base.lineage
+    if base.segments is not None:
+        snapshot.segments = base.segments.compact(moves) if moves is not None else base.segments
+    snapshot.next_video_id = max(
+        [base.next_video_id] + [v["video_id"] + 1 for v in base.videos + base.tombstones]
+    )
+
+
+def allocate_video_id(snapshot):
+    """Id for the next video added to an unpublished snapshot (ids of removed videos are not reused)"""
+    video_id = snapshot.next_video_id
+    snapshot.next_video_id = video_id + 1
+    return video_id
+
+
+def candidate_ranges(snapshot, time_range=None, video_ids=None, start_field="timestamp", end_field=None):
+    """
+    Translate filters into contiguous FAISS id ranges.
+
+    Rows of one video are stored contiguously in time order, so a video filter is
+    one range and a time filter is a binary search inside it. Snapshots with
+    tombstones are always filtered to their remaining videos.
+
+    Args:
+        time_range: (start_sec, end_sec), either bound may be None
+        video_ids: Video ids (see snapshot.videos) to keep
+        start_field / end_field: Time columns; an item matches if it overlaps time_range
+
+    Returns:
+        List of (lo, hi) id ranges, or None when no filter is needed
+    """
+    if time_range is None and video_ids is None and not snapshot.tombstones:
+        return None
+    videos = snapshot.videos
+    if not videos and not snapshot.tombstones:
+        videos = [{"video_id": 0, "start_id": 0, "end_id": snapshot.ntotal}]
+    t0, t1 = time_range if time_range is not None else (None, None)
+    ranges = []
+    for video in videos:
+        if video_ids is not None and video["video_id"] not in video_ids:
+            continue
+        lo, hi = video["start_id"], video["end_id"]
+        if t1 is not None:
+            starts = snapshot.metadata.column(start_field)[video["start_id"]:video["end_id"]]
+            hi = video["start_id"] + int(np.searchsorted(starts, t1, side="right"))
+        if t0 is not None:
+            ends = snapshot.metadata.column(end_field or start_field)[video["start_id"]:video["end_id"]]
+            lo = video["start_id"] + int(np.searchsorted(ends, t0, side="left"))
+        if hi > lo:
+            ranges.append((lo, hi))
+    return ranges
+
+
+def _pad(distances, labels, k):
+    if distances.shape[1] >= k:
+        return distances[:, :k], labels[:, :k]
+    pad = k - distances.shape[1]
+    return (
+        np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf),
+        np.pad(labels, ((0, 0), (0, pad)), constant_values=-1),
+    )
+
+
+def search_ranges(index, queries, k, ranges):
+    """
+    k-NN restricted to id ranges, evaluated inside FAISS.
+
+    Flat indexes scan only the selected slices of the vector matrix (cost grows with
+    the filtered size, not the library); other index types get an IDSelector.
+    """
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    empty = (np.full((len(queries), k), np.inf, dtype="float32"), np.full((len(queries), k), -1, dtype="int64"))
+    if not ranges:
+        return empty
+
+    vectors = flat_vectors(index)
+    if vectors is not None:
+        all_distances, all_labels = [], []
+        for lo, hi in ranges:
+            distances, labels = faiss.knn(queries, vectors[lo:hi], min(k, hi - lo))
+            all_distances.append(distances)
+            all_labels.append(labels + lo)
+        distances, labels = np.hstack(all_distances), np.hstack(all_labels)
+        if len(ranges) > 1:
+            order = np.argsort(distances, axis=1)[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            labels = np.take_along_axis(labels, order, axis=1)
+        return _pad(distances, labels, k)
+
+    if len(ranges) == 1:
+        selector = faiss.IDSelectorRange(ranges[0][0], ranges[0][1])
+    else:
+        ids = np.concatenate([np.arange(lo, hi, dtype="int64") for lo, hi in ranges])
+        selector = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+    if isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(queries, k, params=params)
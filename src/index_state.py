@@ -0,0 +1,346 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class RWLock:
+    """Reader-writer lock: many concurrent readers, one writer (writers are not starved)"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def _run_deferred(fn):
+    try:
+        fn()
+    except Exception as e:
+        print(f"[Index Warning] deferred cleanup failed: {e}")
+
+
+def _carry_tombstones(current, snapshot):
+    if snapshot is current or snapshot.lineage != current.lineage or not current.tombstones:
+        return
+    removed = {v["video_id"] for v in current.tombstones}
+    carried = [v for v in snapshot.videos if v["video_id"] in removed]
+    if carried:
+        # snapshot 尚未发布，可以直接修改
+        snapshot.videos = [v for v in snapshot.videos if v["video_id"] not in removed]
+        snapshot.tombstones = snapshot.tombstones + [dict(v) for v in carried]
+
+
+class IndexSnapshot:
+    """
+    One published version of a retriever's index + metadata.
+
+    Ingestion fills a fresh snapshot privately and publishes it once complete;
+    after publishing it is never mutated, so searches need no lock.
+    """
+
+    def __init__(self, index, metadata=None, assets_dir=None, source=None):
+        self.index = index
+        self.metadata = metadata if metadata is not None else {}
+        self.assets_dir = assets_dir
+        self.source = source
+        # 从磁盘库加载时的目录（见 index_storage）
+        self.storage_dir = None
+        # [{"video_id", "source", "start_id", "end_id"}]：每个视频占一段连续 id
+        self.videos = []
+        # 视觉库的段级（粗粒度）索引，见 segment_index.SegmentLevel
+        self.segments = None
+        # 已删除但行仍在索引中的视频（检索时跳过，压缩后清空），见 index_compaction
+        self.tombstones = []
+        # 下一个视频编号：删除的编号不复用，视觉库与音频库的编号保持一致
+        self.next_video_id = 0
+        self.snapshot_id = uuid.uuid4().hex[:12]
+        # 同一个库的各代（追加、删除、压缩）共享 lineage；全新建库时重新开始
+        self.lineage = self.snapshot_id
+        self.version = 0
+        self.created_at = time.time()
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+
+class IndexHandle:
+    """
+    Slot holding the current snapshot; readers take a reference, writers swap atomically.
+
+    Queries that use files a later generation may drop (keyframes handed to the VLM)
+    pin their generation with acquire(); defer() runs a cleanup once every generation
+    older than the current one is unpinned.
+    """
+
+    def __init__(self, snapshot):
+        self._lock = RWLock()
+        self._current = snapshot
+        self._version = 0
+        self._refs_lock = threading.Lock()
+        self._refs = {}
+        self._deferred = []
+
+    def current(self):
+        with self._lock.read_lock():
+            return self._current
+
+    @contextmanager
+    def acquire(self):
+        """Pin the current snapshot for the duration of the block"""
+        with self._lock.read_lock():
+            snapshot = self._current
+            # 在读锁内计数：publish 之后的 defer 一定能看到这次引用
+            with self._refs_lock:
+                self._refs[snapshot] = self._refs.get(snapshot, 0) + 1
+        try:
+            yield snapshot
+        finally:
+            self._release(snapshot)
+
+    def _release(self, snapshot):
+        ready = []
+        with self._refs_lock:
+            count = self._refs[snapshot] - 1
+            if count:
+                self._refs[snapshot] = count
+            else:
+                del self._refs[snapshot]
+                for waiting, _ in self._deferred:
+                    waiting.discard(snapshot)
+                ready = [fn for waiting, fn in self._deferred if not waiting]
+                self._deferred = [(waiting, fn) for waiting, fn in self._deferred if waiting]
+        for fn in ready:
+            _run_deferred(fn)
+
+    def defer(self, fn, include_current=False):
+        """
+        Run fn once no query holds a generation older than the current one (now, if none does)
+
+        Args:
+            include_current: Also wait for queries on the current generation (the handle is being retired)
+        """
+        with self._refs_lock:
+            current = self._current
+            waiting = {snapshot for snapshot in self._refs if include_current or snapshot is not current}
+            if waiting:
+                self._deferred.append((waiting, fn))
+                return
+        _run_deferred(fn)
+
+    def publish(self, snapshot):
+        """
+        Swap in snapshot unconditionally.
+
+        A snapshot built from an older generation of the same library (an ingestion
+        that ran while videos were removed) keeps those removals: video ids are never
+        reused, so any video tombstoned in the current generation is tombstoned in
+        the incoming one as well.
+        """
+        with self._lock.write_lock():
+            _carry_tombstones(self._current, snapshot)
+            self._version += 1
+            snapshot.version = self._version
+            previous, self._current = self._current, snapshot
+        return previous
+
+    def publish_if(self, snapshot, expected):
+        """Publish only if `expected` is still current (a rebuild started from it); True if swapped"""
+        with self._lock.write_lock():
+            if self._current is not expected:
+                return False
+            self._version += 1
+            snapshot.version = self._version
+            self._current = snapshot
+        return True
+
+    def generations(self):
+        """Current version and the older generations still pinned by running queries"""
+        with self._refs_lock:
+            current = self._current
+            pinned = [snapshot for snapshot in self._refs if snapshot is not current]
+            return {
+                "version": self._version,
+                "pinned_generations": len(pinned),
+                "pinned_queries": sum(self._refs[snapshot] for snapshot in pinned),
+                "deferred_cleanups": len(self._deferred),
+            }
+
+    @property
+    def version(self):
+        return self._version
+
+
+class SessionIndexes:
+    def __init__(self, visual, audio):
+        self.visual = visual
+        self.audio = audio
+        self.last_used = time.time()
+        self.ingest_lock = threading.Lock()
+        # 关键帧 ↔ 转录片段的时间关联（temporal_join.TemporalJoin），随快照对更新
+        self.join = None
+
+    def snapshots(self):
+        self.last_used = time.time()
+        return self.visual.current(), self.audio.current()
+
+    @contextmanager
+    def acquire(self):
+        """Pinned (visual, audio) snapshot pair for one query (see IndexHandle.acquire)"""
+        self.last_used = time.time()
+        with self.visual.acquire() as visual, self.audio.acquire() as audio:
+            yield visual, audio
+
+
+class IndexRegistry:
+    def __init__(self, video_retriever, audio_retriever, max_sessions=32, idle_seconds=6 * 3600):
+        """
+        Per-session index state; the models are shared, the indexes are not.
+
+        Args:
+            video_retriever / audio_retriever: Shared retrievers (used to create empty snapshots)
+            max_sessions: Max sessions kept (least recently used are dropped)
+            idle_seconds: Sessions idle longer than this are dropped
+        """
+        self.video_retriever = video_retriever
+        self.audio_retriever = audio_retriever
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions = {}
+        # 会话 id -> 排队/运行中的摄取数；有摄取待完成的会话不会被淘汰
+        self._holds = {}
+        self._lock = threading.Lock()
+        self._default_session = SessionIndexes(video_retriever.handle, audio_retriever.handle)
+        # 未知会话的只读视图：读路径不会因为客户端给的任意 id 创建会话、挤掉真实会话
+        self._empty_session = SessionIndexes(
+            IndexHandle(video_retriever.new_snapshot()), IndexHandle(audio_retriever.new_snapshot())
+        )
+
+    def lookup(self, session_id=None):
+        """
+        Existing session for read paths (queries, listings, evidence); never creates one
+
+        Unknown ids get a shared empty session (no videos), so callers see "no index yet".
+        """
+        if session_id is None:
+            return self.get(None)
+        with self._lock:
+            self._evict_locked(keep=session_id)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return self._empty_session
+            session.last_used = time.time()
+            return session
+
+    def get(self, session_id=None):
+        """
+        Session for write paths (ingestion, import); created on first use
+
+        session_id None maps to the retrievers' own (process-wide) handles.
+        """
+        if session_id is None:
+            self._default_session.last_used = time.time()
+            return self._default_session
+        with self._lock:
+            self._evict_locked(keep=session_id)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = SessionIndexes(
+                    IndexHandle(self.video_retriever.new_snapshot()),
+                    IndexHandle(self.audio_retriever.new_snapshot()),
+                )
+                self._sessions[session_id] = session
+            session.last_used = time.time()
+            return session
+
+    def hold(self, session_id):
+        """Keep a session from eviction while an ingestion for it is queued or running"""
+        if session_id is None:
+            return
+        with self._lock:
+            self._holds[session_id] = self._holds.get(session_id, 0) + 1
+
+    def unhold(self, session_id):
+        if session_id is None:
+            return
+        with self._lock:
+            remaining = self._holds.get(session_id, 0) - 1
+            if remaining > 0:
+                self._holds[session_id] = remaining
+            else:
+                self._holds.pop(session_id, None)
+
+    def drop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._release(session)
+
+    def _evictable(self, session_id, keep):
+        # 正在摄取的会话若被淘汰，关键帧会写进已删除的目录、结果发布到没人能访问的句柄
+        if session_id == keep or self._holds.get(session_id):
+            return False
+        return not self._sessions[session_id].ingest_lock.locked()
+
+    def _evict_locked(self, keep=None):
+        now = time.time()
+        expired = [
+            sid for sid, s in self._sessions.items()
+            if now - s.last_used > self.idle_seconds and self._evictable(sid, keep)
+        ]
+        while len(self._sessions) - len(expired) >= self.max_sessions:
+            candidates = [sid for sid in self._sessions if sid not in expired and self._evictable(sid, keep)]
+            if not candidates:
+                break
+            expired.append(min(candidates, key=lambda sid: self._sessions[sid].last_used))
+        for sid in expired:
+            self._release(self._sessions.pop(sid))
+
+    @staticmethod
+    def _release(session):
+        assets_dir = session.visual.current().assets_dir
+        if not assets_dir:
+            return
+
+        def remove():
+            if os.path.isdir(assets_dir):
+                shutil.rmtree(assets_dir, ignore_errors=True)
+
+        # 仍在进行的查询固定着这一代（VLM 还要读关键帧），等最后一个引用释放后再删
+        session.visual.defer(remove, include_current=True)
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import time
+
+import faiss
+import numpy as np
+
+from index_filters import flat_vectors
+from index_state import IndexSnapshot
+from metadata_store import MetadataStore
+from segment_index import SegmentLevel
+
+FORMAT_VERSION = 2
+
+
+class MmapFlatIndex:
+    """
+    Read-only exact L2 index over a memory-mapped (n, d) float32 matrix.
+
+    Same search() contract as faiss.IndexFlatL2, but the vectors stay in the page
+    cache (shared by every process that maps the file) instead of the heap.
+    """
+
+    def __init__(self, vectors):
+        self.xb = vectors
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, x, k):
+        if self.ntotal == 0:
+            return (np.full((len(x), k), np.inf, dtype="float32"), np.full((len(x), k), -1, dtype="int64"))
+        distances, labels = faiss.knn(np.ascontiguousarray(x, dtype="float32"), self.xb, min(k, self.ntotal))
+        if k > self.ntotal:
+            pad = k - self.ntotal
+            distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+            labels = np.pad(labels, ((0, 0), (0, pad)), constant_values=-1)
+        return distances, labels
+
+    def reconstruct_n(self, start, n):
+        return np.asarray(self.xb[start:start + n])
+
+
+def save_snapshot(snapshot, directory, path_fields=("path",)):
+    """
+    Persist a published snapshot in a memory-mappable layout.
+
+        manifest.json        snapshot id / source / index kind / video table and tombstones
+        vectors.npy          flat indexes: raw (n, d) float32 vectors
+        index.faiss          other index types (IVF lists can be mmapped by FAISS)
+        segments*.npy        visual segment level (mean-pooled vectors + frame id ranges)
+        meta/                columnar metadata as raw buffers (see MetadataStore.save)
+        assets/              copied keyframes; path columns are stored relative to directory
+
+    Writes into a temporary directory and renames it into place, so a reader never
+    opens a half-written library.
+    """
+    tmp_dir = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    vectors = flat_vectors(snapshot.index)
+    if vectors is not None:
+        np.save(os.path.join(tmp_dir, "vectors.npy"), np.ascontiguousarray(vectors, dtype="float32"))
+        kind = "flat"
+    else:
+        faiss.write_index(snapshot.index, os.path.join(tmp_dir, "index.faiss"))
+        kind = "faiss"
+
+    if snapshot.segments is not None:
+        np.save(os.path.join(tmp_dir, "segments.npy"), snapshot.segments.vectors)
+        np.save(os.path.join(tmp_dir, "segment_ranges.npy"), snapshot.segments.ranges)
+
+    rewrite = None
+    fields = [field for field in path_fields if field in snapshot.metadata.schema]
+    if fields:
+        # 关键帧随索引一起保存（keyframes 目录在进程启动时会被清空）；
+        # 追加构建的库引用多个目录，按文件逐个复制
+        os.makedirs(os.path.join(tmp_dir, "assets"))
+        for field in fields:
+            for i in range(len(snapshot.metadata)):
+                path = snapshot.metadata.string(field, i)
+                dest = os.path.join(tmp_dir, "assets", os.path.basename(path))
+                if os.path.isfile(path) and not os.path.exists(dest):
+                    shutil.copy2(path, dest)
+        rewrite = {field: (lambda path: os.path.join("assets", os.path.basename(path))) for field in fields}
+    snapshot.metadata.save(os.path.join(tmp_dir, "meta"), rewrite=rewrite)
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "format_version": FORMAT_VERSION,
+            "kind": kind,
+            "snapshot_id": snapshot.snapshot_id,
+            "source": snapshot.source,
+            "ntotal": snapshot.ntotal,
+            "videos": snapshot.videos,
+            "tombstones": snapshot.tombstones,
+            "next_video_id": snapshot.next_video_id,
+            "path_fields": sorted(rewrite or ()),
+            "saved_at": time.time(),
+        }, f, ensure_ascii=False)
+
+    old_dir = f"{directory}.old-{os.getpid()}"
+    if os.path.exists(directory):
+        os.rename(directory, old_dir)
+    os.rename(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return directory
+
+
+def load_snapshot(directory, mmap=True):
+    """
+    Open a saved snapshot; with mmap=True vectors and metadata are mapped, not read.
+
+    Returns None when the directory holds no saved index.
+    """
+    manifest_path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(
+            f"index library {directory} has format {manifest.get('format_version')}, expected {FORMAT_VERSION}; rebuild it"
+        )
+
+    if manifest["kind"] == "flat":
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r" if mmap else None)
+        index = MmapFlatIndex(vectors)
+    else:
+        path = os.path.join(directory, "index.faiss")
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError as e:
+                # 部分索引类型不支持 mmap，退回普通读取
+                print(f"[Index Warning] mmap load unsupported for {path}, reading into memory: {e}")
+        if index is None:
+            index = faiss.read_index(path)
+
+    metadata = MetadataStore.load(
+        os.path.join(directory, "meta"), mmap=mmap,
+        path_fields=manifest.get("path_fields", ()), path_root=directory,
+    )
+    snapshot = IndexSnapshot(index, metadata, source=manifest.get("source"))
+    snapshot.snapshot_id = manifest["snapshot_id"]
+    snapshot.storage_dir = directory
+    snapshot.videos = manifest.get("videos", [])
+    snapshot.tombstones = manifest.get("tombstones", [])
+    snapshot.next_video_id = manifest.get(
+        "next_video_id", max([v["video_id"] + 1 for v in snapshot.videos + snapshot.tombstones], default=0)
+    )
+    if os.path.exists(os.path.join(directory, "segments.npy")):
+        snapshot.segments = SegmentLevel(
+            np.load(os.path.join(directory, "segments.npy"), mmap_mode="r" if mmap else None),
+            np.load(os.path.join(directory, "segment_ranges.npy")),
+        )
+    # assets_dir 留空：持久化库不随会话回收而删除
+    return snapshot
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class IngestJobQueue:
+    def __init__(
+        self,
+        services,
+        db_path="../data/embeddings/ingest_jobs.sqlite3",
+        num_workers=1,
+        progress_interval=0.5,
+    ):
+        """
+        Persistent background ingestion queue.
+
+        Args:
+            services: AppServices used to run ingest_video
+            db_path: SQLite file holding the job table (survives restarts)
+            num_workers: Ingestions allowed to run at once (e.g. one per GPU)
+            progress_interval: Min seconds between progress writes to the database
+        """
+        self.services = services
+        self.db_path = db_path
+        self.num_workers = num_workers
+        self.progress_interval = progress_interval
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._cancel_events = {}
+        self._workers = []
+        self._stopped = False
+        self._init_db()
+
+    def _init_db(self):
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    dedup_key TEXT,
+                    video_path TEXT,
+                    session_id TEXT,
+                    priority INTEGER DEFAULT 0,
+                    append INTEGER DEFAULT 0,
+                    live INTEGER DEFAULT 0,
+                    status TEXT,
+                    progress REAL DEFAULT 0,
+                    message TEXT DEFAULT '',
+                    branches TEXT,
+                    result TEXT,
+                    error TEXT,
+                    submitted_at REAL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            # 旧版本数据库补列
+            for column in ("append", "live"):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} INTEGER DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs (dedup_key, status)")
+            # 上次进程退出时未完成的任务：默认库持久化在磁盘上，重新排队即可；
+            # 会话库只存在于旧进程内存中，无论排队还是运行中，重跑都会写进一个没人持有的新会话，直接标记失败
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, error = ? "
+                "WHERE status IN (?, ?) AND session_id IS NOT NULL",
+                (time.time(), "interrupted by a server restart; the session's in-memory index was lost, "
+                              "upload the video again") + ACTIVE_STATES,
+            )
+            self._conn.execute("UPDATE jobs SET status = 'queued', progress = 0 WHERE status = 'running'")
+
+    @staticmethod
+    def _dedup_key(video_path, session_id, append=False, live=False):
+        if live:
+            # 录制中的文件大小/修改时间一直在变，只按路径去重
+            src = f"{os.path.abspath(video_path)}|{session_id}|{int(append)}|live"
+            return hashlib.md5(src.encode("utf-8")).hexdigest()
+        try:
+            stat = os.stat(video_path)
+            src = f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime}|{session_id}|{int(append)}"
+        except FileNotFoundError:
+            src = f"{os.path.abspath(video_path)}|{session_id}|{int(append)}"
+        return hashlib.md5(src.encode("utf-8")).hexdigest()
+
+    def start(self):
+        self._stopped = False
+        while len(self._workers) < self.num_workers:
+            worker = threading.Thread(
+                target=self._worker_loop, name=f"ingest-worker-{len(self._workers)}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def stop(self):
+        self._stopped = True
+        for event in list(self._cancel_events.values()):
+            event.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def submit(self, video_path, session_id=None, priority=0, append=False, live=False):
+        """
+        Queue an ingestion; an identical queued/running submission returns the existing job id
+
+        append: add the video to the session's library instead of replacing it
+        live: follow a recording that is still being written (occupies a worker until it ends)
+        """
+        dedup_key = self._dedup_key(video_path, session_id, append, live)
+        with self._db_lock, self._conn:
+            row = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE dedup_key = ? AND status IN (?, ?) "
+                "ORDER BY submitted_at DESC LIMIT 1",
+                (dedup_key,) + ACTIVE_STATES,
+            ).fetchone()
+            if row is not None:
+                return row["job_id"]
+            job_id = uuid.uuid4().hex[:12]
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, dedup_key, video_path, session_id, priority, append, live, status, "
+                "submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?)",
+                (job_id, dedup_key, video_path, session_id, priority, int(append), int(live), time.time()),
+            )
+            self._hold(session_id)
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a queued job immediately, or ask a running one to stop at its next progress report"""
+        with self._db_lock, self._conn:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            cancelled = cur.rowcount > 0
+            if cancelled:
+                row = self._conn.execute("SELECT session_id FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+                self._unhold(row["session_id"])
+            event = self._cancel_events.get(job_id)
+        if event is not None:
+            event.set()
+            cancelled = True
+        return cancelled
+
+    def _hold(self, session_id):
+        # 排队中的会话任务不能让会话被淘汰（见 IndexRegistry.hold）
+        if self.services is not None:
+            self.services.indexes.hold(session_id)
+
+    def _unhold(self, session_id):
+        if self.services is not None:
+            self.services.indexes.unhold(session_id)
+
+    def cancel_session(self, session_id):
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE session_id = ? AND status IN (?, ?)",
+                (session_id,) + ACTIVE_STATES,
+            ).fetchall()
+        for row in rows:
+            self.cancel(row["job_id"])
+
+    def get(self, job_id):
+        with self._db_lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, status=None, limit=100):
+        query, args = "SELECT * FROM jobs", ()
+        if status:
+            query, args = query + " WHERE status = ?", (status,)
+        with self._db_lock:
+            rows = self._conn.execute(query + " ORDER BY submitted_at DESC LIMIT ?", args + (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def counts(self):
+        with self._db_lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        for key in ("branches", "result"):
+            job[key] = json.loads(job[key]) if job[key] else None
+        job.pop("dedup_key", None)
+        return job
+
+    def _claim_next(self):
+        with self._db_lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, submitted_at ASC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE job_id = ?",
+                (time.time(), row["job_id"]),
+            )
+            # 与状态更新在同一把锁内登记取消事件，避免 cancel() 落在两者之间
+            self._cancel_events[row["job_id"]] = threading.Event()
+            return dict(row)
+
+    def _update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._db_lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", tuple(fields.values()) + (job_id,))
+
+    def _worker_loop(self):
+        while not self._stopped:
+            job = self._claim_next()
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=2.0)
+                continue
+            self._run_job(job)
+
+    def _run_job(self, job):
+        job_id = job["job_id"]
+        cancel_event = self._cancel_events[job_id]
+        last_write = [0.0]
+
+        def progress(state):
+            now = time.time()
+            if now - last_write[0] < self.progress_interval:
+                return
+            last_write[0] = now
+            fraction = sum(st["fraction"] for st in state.values()) / len(state)
+            message = " | ".join(f"{name}: {st['message']}" for name, st in state.items())
+            self._update(job_id, progress=fraction, message=message, branches=json.dumps(state, ensure_ascii=False))
+
+        # 延迟导入：services 依赖模型库（torch / clip / whisper），队列本身的持久化逻辑不需要
+        from services import IngestCancelled, ingest_video
+
+        try:
+            result = ingest_video(
+                job["video_path"], self.services, job["session_id"], progress=progress, cancel_event=cancel_event,
+                append=bool(job["append"]), live=bool(job["live"]),
+            )
+            failed = all(branch["status"] == "error" for branch in result.values())
+            self._update(
+                job_id,
+                status="failed" if failed else "done",
+                progress=1.0,
+                result=json.dumps(result, ensure_ascii=False),
+                error="; ".join(b["message"] for b in result.values() if b["status"] == "error") or None,
+                finished_at=time.time(),
+            )
+        except IngestCancelled:
+            self._update(job_id, status="cancelled", finished_at=time.time())
+        except Exception as e:
+            traceback.print_exc()
+            self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+        finally:
+            self._cancel_events.pop(job_id, None)
+            self._unhold(job["session_id"])
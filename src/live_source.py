@@ -0,0 +1,131 @@
+import os
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import cv2
+
+
+@dataclass
+class MediaWindow:
+    """[start, end) seconds of `path` (end None = to the end of the file); offset maps it onto the recording timeline"""
+    path: str
+    offset: float
+    start: float
+    end: Optional[float]
+
+
+def probe_duration(path):
+    """Current duration in seconds of a (possibly still growing) media file, or None if unreadable"""
+    cmd = [
+        "ffprobe", "-v", "error", "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", path,
+    ]
+    try:
+        return float(subprocess.run(cmd, check=True, capture_output=True, text=True).stdout.strip())
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        pass
+    cap = cv2.VideoCapture(path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        if cap.isOpened() and fps > 0 and frames > 0:
+            return frames / fps
+    finally:
+        cap.release()
+    return None
+
+
+def parse_playlist(path):
+    """
+    Segments of an HLS-style (EVENT) playlist
+
+    Returns:
+        ([(segment_path, duration), ...], ended) where ended means #EXT-X-ENDLIST was seen
+    """
+    if not os.path.exists(path):
+        return [], False
+    segments, duration, ended = [], None, False
+    base_dir = os.path.dirname(path)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line.startswith("#EXT-X-ENDLIST"):
+                ended = True
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((os.path.join(base_dir, line), duration))
+                duration = None
+    return segments, ended
+
+
+class LiveSource:
+    def __init__(self, source, min_window_seconds=10.0, poll_interval=5.0, idle_timeout=120.0, tail_margin=2.0,
+                 heartbeat=None):
+        """
+        Follow a recording that is still being written and hand it out in windows.
+
+        Args:
+            source: Growing media file (MPEG-TS / MKV / fragmented MP4) or an .m3u8 segment playlist
+            min_window_seconds: Growing files: new media needed before a window is emitted
+            poll_interval: Seconds between checks for new data
+            idle_timeout: The recording counts as finished after this long without growth
+                (playlists also finish at #EXT-X-ENDLIST)
+            tail_margin: Growing files: trailing seconds left for the next window, since the
+                writer may be in the middle of a GOP
+            heartbeat: Optional fn(recorded_seconds) called on every idle poll; may raise to stop
+        """
+        self.source = source
+        self.min_window_seconds = min_window_seconds
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.tail_margin = tail_margin
+        self.heartbeat = heartbeat
+
+    def windows(self):
+        """Yields MediaWindow in timeline order until the recording is finished"""
+        if self.source.endswith(".m3u8"):
+            yield from self._playlist_windows()
+        else:
+            yield from self._file_windows()
+
+    def _wait(self, recorded):
+        if self.heartbeat:
+            self.heartbeat(recorded)
+        time.sleep(self.poll_interval)
+
+    def _file_windows(self):
+        processed = 0.0
+        last_size, last_growth = -1, time.time()
+        while True:
+            size = os.path.getsize(self.source) if os.path.exists(self.source) else 0
+            if size != last_size:
+                last_size, last_growth = size, time.time()
+            finished = time.time() - last_growth > self.idle_timeout
+            duration = probe_duration(self.source) if size else None
+            if duration is not None:
+                end = duration if finished else duration - self.tail_margin
+                if end > processed and (finished or end - processed >= self.min_window_seconds):
+                    # 录制结束后最后一个窗口读到文件末尾
+                    yield MediaWindow(self.source, 0.0, processed, None if finished else end)
+                    processed = end
+                    continue
+            if finished:
+                return
+            self._wait(processed)
+
+    def _playlist_windows(self):
+        seen, offset = 0, 0.0
+        last_growth = time.time()
+        while True:
+            segments, ended = parse_playlist(self.source)
+            for path, duration in segments[seen:]:
+                yield MediaWindow(path, offset, 0.0, None)
+                offset += duration
+            if len(segments) > seen:
+                seen, last_growth = len(segments), time.time()
+            if ended or time.time() - last_growth > self.idle_timeout:
+                return
+            self._wait(offset)
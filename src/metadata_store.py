@@ -0,0 +1,231 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+VIDEO_SCHEMA = {"timestamp": "float64", "video_id": "int32", "frame_id": "int64", "path": "str"}
+AUDIO_SCHEMA = {"start": "float64", "end": "float64", "video_id": "int32", "text": "str"}
+
+
+def gather_results(metadata, distances, indices, fields):
+    """
+    Assemble a FAISS (nq, k) result matrix in one vectorized gather.
+
+    Returns:
+        Per query row: ({field: values for the valid ids}, distances of those ids, the ids)
+    """
+    valid = metadata.valid(indices)
+    flat_ids = indices[valid]
+    columns = metadata.gather(flat_ids, fields)
+    flat_distances = distances[valid]
+    results, start = [], 0
+    for count in valid.sum(axis=1).tolist():
+        end = start + count
+        results.append((
+            {name: values[start:end] for name, values in columns.items()},
+            flat_distances[start:end],
+            flat_ids[start:end],
+        ))
+        start = end
+    return results
+
+
+class _StringColumn:
+    """Offset-indexed UTF-8 pool: value i is pool[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, offsets=None, pool=None):
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self.pool = pool if pool is not None else bytearray()
+        self.count = len(self.offsets) - 1
+
+    def append(self, values):
+        encoded = [v.encode("utf-8") for v in values]
+        ends = self.offsets[self.count] + np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        if self.count + 1 + len(encoded) > len(self.offsets):
+            grown = np.zeros(max(2 * len(self.offsets), self.count + 1 + len(encoded)), dtype=np.int64)
+            grown[:self.count + 1] = self.offsets[:self.count + 1]
+            self.offsets = grown
+        self.offsets[self.count + 1:self.count + 1 + len(encoded)] = ends
+        self.pool += b"".join(encoded)
+        self.count += len(encoded)
+
+    def get(self, i):
+        return bytes(self.pool[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+
+class MetadataStore(Mapping):
+    """
+    Columnar per-vector metadata (row i = FAISS id i).
+
+    Numeric fields are NumPy columns, strings share one byte pool per field, so a
+    row costs its payload bytes rather than a Python dict. Behaves as a read-only
+    {id: {field: value}} mapping for single lookups; use gather() / range_ids()
+    for result assembly and filtering.
+    """
+
+    def __init__(self, schema, capacity=1024):
+        """
+        Args:
+            schema: {field: numpy dtype name, or "str"}
+            capacity: Initial rows allocated for numeric columns (grows by doubling)
+        """
+        self.schema = dict(schema)
+        self._n = 0
+        self._numeric = {
+            name: np.zeros(capacity, dtype=dtype) for name, dtype in self.schema.items() if dtype != "str"
+        }
+        self._strings = {name: _StringColumn() for name, dtype in self.schema.items() if dtype == "str"}
+        self.read_only = False
+        self.path_root = None
+        self.path_fields = set()
+
+    # ---- 写入 ----
+
+    def append(self, **columns):
+        """Append a batch of rows: append(timestamp=[...], path=[...]); missing fields are 0 / ""."""
+        if self.read_only:
+            raise RuntimeError("metadata store is read-only (memory-mapped)")
+        n = len(next(iter(columns.values())))
+        if self._n + n > self.capacity:
+            new_capacity = max(2 * self.capacity, self._n + n)
+            for name, column in self._numeric.items():
+                grown = np.zeros(new_capacity, dtype=column.dtype)
+                grown[:self._n] = column[:self._n]
+                self._numeric[name] = grown
+        for name, column in self._numeric.items():
+            if name in columns:
+                column[self._n:self._n + n] = columns[name]
+        for name, column in self._strings.items():
+            column.append(columns.get(name, [""] * n))
+        self._n += n
+
+    @property
+    def capacity(self):
+        return min((len(c) for c in self._numeric.values()), default=0)
+
+    # ---- 读取 ----
+
+    def column(self, name):
+        """Numeric column view for the stored rows (no copy)"""
+        return self._numeric[name][:self._n]
+
+    def string(self, name, i):
+        value = self._strings[name].get(i)
+        if name in self.path_fields and self.path_root:
+            value = os.path.join(self.path_root, value)
+        return value
+
+    def gather(self, ids, fields=None):
+        """
+        Vectorized row assembly.
+
+        Returns:
+            {field: np.ndarray for numeric fields, list[str] for string fields}
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        out = {}
+        for name in fields or self.schema:
+            if name in self._numeric:
+                out[name] = self._numeric[name][ids]
+            else:
+                out[name] = [self.string(name, int(i)) for i in ids]
+        return out
+
+    def valid(self, ids):
+        """Mask of FAISS result ids that refer to stored rows (drops -1 padding)"""
+        ids = np.asarray(ids)
+        return (ids >= 0) & (ids < self._n)
+
+    def range_ids(self, name, lo=None, hi=None):
+        """Ids with lo <= column < hi (None = unbounded)"""
+        column = self.column(name)
+        mask = np.ones(self._n, dtype=bool)
+        if lo is not None:
+            mask &= column >= lo
+        if hi is not None:
+            mask &= column < hi
+        return np.flatnonzero(mask)
+
+    def nbytes(self):
+        numeric = sum(c[:self._n].nbytes for c in self._numeric.values())
+        strings = sum(c.offsets[:c.count + 1].nbytes + len(c.pool) for c in self._strings.values())
+        return numeric + strings
+
+    def __getitem__(self, i):
+        if i not in self:
+            raise KeyError(i)
+        i = int(i)
+        row = {name: column[i].item() for name, column in self._numeric.items()}
+        row.update({name: self.string(name, i) for name in self._strings})
+        return row
+
+    def __contains__(self, i):
+        try:
+            return 0 <= int(i) < self._n
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        return iter(range(self._n))
+
+    def __len__(self):
+        return self._n
+
+    # ---- 持久化：原始缓冲区，可直接 np.memmap ----
+
+    def save(self, directory, rewrite=None):
+        """
+        Write columns as raw buffers plus columns.json (dtype / row count).
+
+        Args:
+            rewrite: Optional {field: fn(value) -> value} applied to string fields
+                (e.g. to store keyframe paths relative to the library)
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name, column in self._numeric.items():
+            np.ascontiguousarray(column[:self._n]).tofile(os.path.join(directory, f"{name}.bin"))
+        for name, column in self._strings.items():
+            if rewrite and name in rewrite:
+                copy = _StringColumn()
+                copy.append([rewrite[name](self.string(name, i)) for i in range(self._n)])
+                column = copy
+            np.ascontiguousarray(column.offsets[:self._n + 1]).tofile(os.path.join(directory, f"{name}.offsets.bin"))
+            with open(os.path.join(directory, f"{name}.pool.bin"), "wb") as f:
+                f.write(bytes(column.pool[:column.offsets[self._n]]))
+        with open(os.path.join(directory, "columns.json"), "w", encoding="utf-8") as f:
+            json.dump({"rows": self._n, "schema": self.schema}, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True, path_fields=(), path_root=None):
+        """
+        Open saved columns; with mmap=True every column is a read-only np.memmap
+
+        Args:
+            path_fields: String fields stored relative to path_root
+        """
+        with open(os.path.join(directory, "columns.json"), "r", encoding="utf-8") as f:
+            layout = json.load(f)
+        n = layout["rows"]
+
+        def read(name, dtype, count):
+            path = os.path.join(directory, name)
+            if count == 0 or os.path.getsize(path) == 0:
+                return np.zeros(count, dtype=dtype)
+            if mmap:
+                return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+            return np.fromfile(path, dtype=dtype, count=count)
+
+        store = cls(layout["schema"], capacity=0)
+        for name, dtype in store.schema.items():
+            if dtype == "str":
+                offsets = read(f"{name}.offsets.bin", np.int64, n + 1)
+                pool = read(f"{name}.pool.bin", np.uint8, int(offsets[-1]) if n else 0)
+                store._strings[name] = _StringColumn(offsets, pool)
+            else:
+                store._numeric[name] = read(f"{name}.bin", dtype, n)
+        store._n = n
+        store.read_only = True
+        store.path_fields = set(path_fields)
+        store.path_root = path_root
+        return store
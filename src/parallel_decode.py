@@ -0,0 +1,151 @@
+import bisect
+import multiprocessing
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from frame_sampler import FrameReader, fixed_samples, signature_diff
+
+
+def keyframe_positions(video_path, fps):
+    """
+    Frame indices of the video's GOP keyframes, read from packet flags with ffprobe
+    (demux only, no decoding). Returns None when ffprobe is unavailable or fails.
+    """
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", video_path,
+    ]
+    try:
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"[Decode Warning] ffprobe 读取关键帧位置失败，按时长均分: {e}")
+        return None
+    positions = set()
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" not in flags:
+            continue
+        try:
+            positions.add(int(round(float(pts_time) * fps)))
+        except ValueError:
+            continue
+    return sorted(positions)
+
+
+def plan_slices(end_frame, workers, fps, keyframes=None, min_slice_seconds=60.0):
+    """
+    Split [0, end_frame) into up to `workers` slices, each starting on a GOP keyframe
+    so a worker's seek lands exactly where decoding can begin.
+
+    Returns:
+        [(start_frame, end_frame), ...] in timeline order
+    """
+    n = max(1, min(workers, int(end_frame / (min_slice_seconds * fps))))
+    starts = [0]
+    for i in range(1, n):
+        target = end_frame * i // n
+        if keyframes:
+            # 对齐到目标位置之后最近的关键帧（GOP 起点）
+            j = bisect.bisect_left(keyframes, target)
+            if j == len(keyframes):
+                break
+            target = keyframes[j]
+        if starts[-1] < target < end_frame:
+            starts.append(target)
+    return list(zip(starts, starts[1:] + [end_frame]))
+
+
+def decode_slice(video_path, start_frame, end_frame, step, diff_threshold, out_dir):
+    """
+    Worker: sample one slice and compute every sample's signature.
+
+    Frames this slice keeps on its own (reference reset at the slice start) are
+    written losslessly to out_dir; the parent re-decides across slice boundaries.
+    """
+    cap = cv2.VideoCapture(video_path)
+    reader = FrameReader(cap)
+    if start_frame > 0:
+        reader.seek(start_frame)
+    indices, signatures, kept = [], [], {}
+    reference = None
+    for frame_idx, frame, signature in fixed_samples(reader, step, start_frame, end_frame):
+        indices.append(frame_idx)
+        signatures.append(signature.ravel())
+        if reference is None or signature_diff(reference, signature) > diff_threshold:
+            reference = signature
+            path = os.path.join(out_dir, f"slice_{frame_idx:09d}.png")
+            cv2.imwrite(path, frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            kept[frame_idx] = path
+    cap.release()
+    return {
+        "indices": indices,
+        "signatures": np.asarray(signatures, dtype="float32").reshape(len(indices), -1),
+        "kept": kept,
+        "stats": reader.stats(),
+    }
+
+
+def parallel_fixed_keyframes(video_path, reader, step, diff_threshold, total_frames, fps, workers, work_dir,
+                             end_frame=None):
+    """
+    fixed_keyframes over time slices decoded in parallel worker processes.
+
+    Keyframe decisions are replayed in timeline order over all samples' signatures,
+    so the result is identical to a serial run; the rare frame kept globally but not
+    by its slice (right after a boundary) is re-decoded with `reader`. Worker decode
+    counts are added to reader's counters.
+
+    Slices are planned over total_frames (container metadata); without end_frame the
+    last slice reads to the end of the stream like the serial loop.
+
+    Yields:
+        (frame_idx, frame) for each keyframe
+    """
+    slices = plan_slices(end_frame or total_frames, workers, fps, keyframe_positions(video_path, fps))
+    print(f"[Decode] {len(slices)} slices on {min(workers, len(slices))} processes: "
+          + ", ".join(f"{lo / fps / 60:.1f}-{hi / fps / 60:.1f}min" for lo, hi in slices))
+    if end_frame is None:
+        slices[-1] = (slices[-1][0], None)
+    os.makedirs(work_dir, exist_ok=True)
+    # spawn：子进程不继承父进程里的 CUDA / 线程状态
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(slices)),
+                                   mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = [
+            executor.submit(decode_slice, video_path, lo, hi, step, diff_threshold, work_dir)
+            for lo, hi in slices
+        ]
+        reference = None
+        for (lo, hi), future in zip(slices, futures):
+            result = future.result()
+            for name, count in result["stats"].items():
+                setattr(reader, name, getattr(reader, name) + count)
+            for frame_idx, signature in zip(result["indices"], result["signatures"]):
+                signature = signature.reshape(-1, 1)
+                if reference is not None and signature_diff(reference, signature) <= diff_threshold:
+                    continue
+                reference = signature
+                path = result["kept"].pop(frame_idx, None)
+                if path is not None:
+                    frame = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                    os.remove(path)
+                else:
+                    frame = reader.read(frame_idx)
+                if frame is not None:
+                    yield frame_idx, frame
+            for path in result["kept"].values():
+                os.remove(path)
+            # 流在分片内提前结束（帧数元数据偏大）：与串行读到末尾即停止一致
+            if hi is None:
+                break
+            last_expected = (hi - 1) // step * step
+            if last_expected >= lo and (not result["indices"] or result["indices"][-1] < last_expected):
+                break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
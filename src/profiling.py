@@ -0,0 +1,205 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+
+class ProfileConfig:
+    def __init__(self, targets=None, mode=None, output_dir=None, rate=None, torch_ops=None, interval_ms=None):
+        """
+        Opt-in profiling settings (defaults come from environment variables).
+
+        Args:
+            targets: VRAG_PROFILE, comma separated entry point names, or "all" ("" disables)
+            mode: VRAG_PROFILE_MODE, "cprofile" (deterministic) or "sampling" (stack sampler)
+            output_dir: VRAG_PROFILE_DIR, one sub-directory per profiled run is written here
+            rate: VRAG_PROFILE_RATE, fraction of calls profiled (e.g. 0.01 for a canary)
+            torch_ops: VRAG_PROFILE_TORCH, "1" also records a torch.profiler op table
+            interval_ms: VRAG_PROFILE_INTERVAL_MS, sampling period for "sampling" mode
+        """
+        env = os.environ
+        targets = env.get("VRAG_PROFILE", "") if targets is None else targets
+        self.targets = {t.strip() for t in targets.split(",") if t.strip() and t.strip() != "0"}
+        self.mode = mode or env.get("VRAG_PROFILE_MODE", "cprofile")
+        self.output_dir = output_dir or env.get("VRAG_PROFILE_DIR", "../data/profiles")
+        self.rate = float(env.get("VRAG_PROFILE_RATE", "1.0")) if rate is None else rate
+        self.torch_ops = env.get("VRAG_PROFILE_TORCH", "0") == "1" if torch_ops is None else torch_ops
+        self.interval = (float(env.get("VRAG_PROFILE_INTERVAL_MS", "5")) if interval_ms is None else interval_ms) / 1000
+
+    def wants(self, name):
+        if not self.targets:
+            return False
+        return ("all" in self.targets or "1" in self.targets or name in self.targets) and random.random() < self.rate
+
+
+config = ProfileConfig()
+
+# cProfile / torch.profiler 同一时间只能有一个实例，忙时直接跳过本次采样
+_profiler_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Replace the global profiling config (same arguments as ProfileConfig)"""
+    global config
+    config = ProfileConfig(**kwargs)
+    return config
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval and counts collapsed stacks"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, path):
+        # flamegraph.pl / speedscope 可直接读取的 "a;b;c count" 格式
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _run_dir(name):
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(config.output_dir, f"{name}-{stamp}-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def profile_region(name):
+    """Profile the enclosed block if `name` is selected by the config; otherwise a no-op"""
+    if not config.wants(name):
+        yield None
+        return
+    # cProfile 与 torch.profiler 都是进程内单例：sampling 模式只有开了 torch_ops 才需要锁
+    exclusive = config.mode != "sampling" or config.torch_ops
+    if exclusive and not _profiler_lock.acquire(blocking=False):
+        yield None
+        return
+
+    try:
+        try:
+            profiler, sampler, torch_prof = _start_collectors(name)
+            try:
+                out_dir = _run_dir(name)
+            except Exception:
+                _stop_collectors(profiler, sampler, torch_prof)
+                raise
+        except Exception as e:
+            # profiler 起不来不能影响被测调用：告警后不采集地运行
+            print(f"[Profile Warning] {name}: profiler failed to start, running unprofiled: {e}")
+            yield None
+            return
+        t0 = time.time()
+        try:
+            region = nullcontext()
+            if torch_prof is not None:
+                import torch
+                region = torch.profiler.record_function(name)
+            with region:
+                yield out_dir
+        finally:
+            elapsed = time.time() - t0
+            # 先停止所有采集器，再写文件；出错只告警，不掩盖被测代码的异常
+            try:
+                _stop_collectors(profiler, sampler, torch_prof)
+                _write_artifacts(out_dir, profiler, sampler, torch_prof)
+                print(f"[Profile] {name}: {elapsed:.2f}s -> {out_dir}")
+            except Exception as e:
+                print(f"[Profile Warning] {name}: writing results to {out_dir} failed: {e}")
+    finally:
+        # 无论写文件是否出错都要释放，否则之后的确定性 profile 请求全部被跳过
+        if exclusive:
+            _profiler_lock.release()
+
+
+def _start_collectors(name):
+    """Start the configured collectors; on failure the ones already started are stopped"""
+    profiler = sampler = torch_prof = None
+    try:
+        if config.mode == "sampling":
+            sampler = StackSampler(threading.get_ident(), config.interval)
+            sampler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if config.torch_ops:
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            torch_prof = torch.profiler.profile(activities=activities, record_shapes=True)
+            torch_prof.__enter__()
+    except Exception:
+        _stop_collectors(profiler, sampler, None)
+        raise
+    return profiler, sampler, torch_prof
+
+
+def _stop_collectors(profiler, sampler, torch_prof):
+    if profiler is not None:
+        profiler.disable()
+    if sampler is not None:
+        sampler.stop()
+    if torch_prof is not None:
+        torch_prof.__exit__(None, None, None)
+
+
+def _write_artifacts(out_dir, profiler, sampler, torch_prof):
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(out_dir, "profile.pstats"))
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(40)
+        with open(os.path.join(out_dir, "profile.txt"), "w", encoding="utf-8") as f:
+            f.write(text.getvalue())
+    if sampler is not None:
+        sampler.write_collapsed(os.path.join(out_dir, "stacks.collapsed"))
+    if torch_prof is not None:
+        import torch
+        sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+        with open(os.path.join(out_dir, "torch_ops.txt"), "w", encoding="utf-8") as f:
+            f.write(torch_prof.key_averages().table(sort_by=sort_by, row_limit=50))
+        torch_prof.export_chrome_trace(os.path.join(out_dir, "torch_trace.json"))
+
+
+def profiled(name):
+    """Decorator form of profile_region; costs one set lookup per call when profiling is off"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not config.targets:
+                return fn(*args, **kwargs)
+            with profile_region(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
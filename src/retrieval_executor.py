@@ -0,0 +1,92 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dataclasses import dataclass
+
+from tracing import tracer
+
+
+@dataclass
+class BranchResult:
+    name: str
+    results: list
+    elapsed: float
+    ok: bool = True
+    error: str = ""
+    queued: float = 0.0
+
+
+class RetrievalExecutor:
+    def __init__(self, max_workers=4, default_timeout=10.0, queue_timeout=None):
+        """
+        Run retrieval branches (visual, audio, ...) concurrently.
+
+        Args:
+            max_workers: Thread pool size (FAISS and torch release the GIL)
+            default_timeout: Seconds a branch may run before it is dropped (counted from when it starts)
+            queue_timeout: Seconds a branch may wait for a free worker before it is dropped
+                (default: the branch's own timeout, so a query waits at most about twice that)
+        """
+        self.default_timeout = default_timeout
+        self.queue_timeout = queue_timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval")
+
+    def run(self, branches, timeouts=None):
+        """
+        Args:
+            branches: {name: zero-arg callable returning a result list}
+            timeouts: Optional {name: seconds} overriding default_timeout
+
+        Returns:
+            {name: BranchResult}; failed or timed-out branches return an empty list
+        """
+        timeouts = timeouts or {}
+        submitted = time.time()
+        # 工作线程没有调用方的 span 栈，显式传入父 span
+        parent = tracer.current()
+        started = {name: [threading.Event(), None] for name in branches}
+        futures = {
+            name: self._pool.submit(self._timed, name, fn, parent, started[name])
+            for name, fn in branches.items()
+        }
+
+        outcomes = {}
+        for name, future in futures.items():
+            timeout = timeouts.get(name, self.default_timeout)
+            event, _ = started[name]
+            queue_timeout = timeout if self.queue_timeout is None else self.queue_timeout
+            wait = None if queue_timeout is None else max(0.0, queue_timeout - (time.time() - submitted))
+            # 超时从分支真正开始运行算起：并发高时在线程池排队的时间单独限制（默认同分支超时）
+            if not event.wait(wait) and future.cancel():
+                queued = time.time() - submitted
+                print(f"[Retrieval Warning] Branch '{name}' waited {queued:.1f}s for a worker, skipped.")
+                outcomes[name] = BranchResult(name, [], 0.0, ok=False, error="queue timeout", queued=queued)
+                continue
+            event.wait()
+            began = started[name][1]
+            queued = began - submitted
+            remaining = None if timeout is None else max(0.0, timeout - (time.time() - began))
+            try:
+                results, elapsed = future.result(timeout=remaining)
+                outcomes[name] = BranchResult(name, results, elapsed, queued=queued)
+            except FutureTimeout:
+                print(f"[Retrieval Warning] Branch '{name}' timed out after {timeout:.1f}s, skipped.")
+                outcomes[name] = BranchResult(name, [], time.time() - began, ok=False, error="timeout", queued=queued)
+            except Exception as e:
+                print(f"[Retrieval Warning] Branch '{name}' failed: {e}")
+                outcomes[name] = BranchResult(name, [], time.time() - began, ok=False, error=str(e), queued=queued)
+        return outcomes
+
+    @staticmethod
+    def _timed(name, fn, parent=None, started=None):
+        t0 = time.time()
+        if started is not None:
+            started[1] = t0
+            started[0].set()
+        with tracer.span(f"retrieval.{name}", parent=parent) as span:
+            results = fn()
+            span.set(results=len(results))
+        return results, time.time() - t0
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
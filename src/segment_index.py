@@ -0,0 +1,97 @@
+import faiss
+import numpy as np
+
+from index_filters import search_ranges
+
+
+class SegmentLevel:
+    """
+    Coarse level of the two-level visual index.
+
+    Each segment is a contiguous FAISS id range (frames of one video inside one
+    time window) represented by the L2-normalised mean of its frame embeddings.
+    """
+
+    def __init__(self, vectors, ranges):
+        """
+        Args:
+            vectors: (m, d) float32 segment embeddings
+            ranges: (m, 2) int64 [start_id, end_id) frame ranges
+        """
+        self.vectors = vectors
+        self.ranges = ranges
+
+    def __len__(self):
+        return len(self.ranges)
+
+    @classmethod
+    def build(cls, frame_vectors, video_ids, timestamps, segment_seconds=60.0, id_offset=0):
+        """
+        Mean-pool already computed frame embeddings into fixed time windows (no decoding).
+
+        Rows must be grouped by video and time-sorted, as process_video writes them.
+        """
+        n = len(timestamps)
+        if n == 0:
+            return cls(np.zeros((0, frame_vectors.shape[1]), dtype="float32"), np.zeros((0, 2), dtype=np.int64))
+        windows = np.floor(np.asarray(timestamps) / segment_seconds).astype(np.int64)
+        keys = np.asarray(video_ids, dtype=np.int64) * (1 << 32) + windows
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1])
+        ends = np.append(starts[1:], n)
+        sums = np.add.reduceat(np.asarray(frame_vectors, dtype="float32"), starts, axis=0)
+        vectors = np.ascontiguousarray(sums / (ends - starts)[:, None], dtype="float32")
+        faiss.normalize_L2(vectors)
+        ranges = np.stack([starts, ends], axis=1).astype(np.int64) + id_offset
+        return cls(vectors, ranges)
+
+    def extend(self, other):
+        if self.vectors is None or len(self) == 0:
+            return other
+        return SegmentLevel(
+            np.ascontiguousarray(np.concatenate([self.vectors, other.vectors]), dtype="float32"),
+            np.concatenate([self.ranges, other.ranges]),
+        )
+
+    def compact(self, moves):
+        """
+        Segments inside kept frame ranges, shifted to the ranges' new positions (no re-pooling)
+
+        Args:
+            moves: [(old_start, old_end, new_start), ...] kept frame id ranges, sorted
+        """
+        if not moves or len(self) == 0:
+            return SegmentLevel(self.vectors[:0], self.ranges[:0])
+        old_starts = np.array([lo for lo, _, _ in moves], dtype=np.int64)
+        old_ends = np.array([hi for _, hi, _ in moves], dtype=np.int64)
+        shifts = np.array([new - lo for lo, _, new in moves], dtype=np.int64)
+        # 段不跨视频：按段起点找到所在的保留区间
+        j = np.searchsorted(old_starts, self.ranges[:, 0], side="right") - 1
+        keep = (j >= 0) & (self.ranges[:, 1] <= old_ends[np.maximum(j, 0)])
+        ranges = self.ranges[keep] + shifts[j[keep]][:, None]
+        return SegmentLevel(np.ascontiguousarray(self.vectors[keep], dtype="float32"), ranges)
+
+    def search(self, queries, n):
+        """Top-n segments per query: (distances, segment indices)"""
+        return faiss.knn(queries, self.vectors, min(n, len(self)))
+
+    def frame_ranges(self, segment_ids):
+        """Frame id ranges of the given segments, sorted and with touching ranges merged"""
+        merged = []
+        for lo, hi in sorted(self.ranges[i].tolist() for i in segment_ids if i >= 0):
+            if merged and lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        return [tuple(r) for r in merged]
+
+
+def search_segments(index, segments, queries, k, segments_per_query):
+    """Coarse-to-fine: best segments per query, then exact frame search inside them"""
+    _, segment_ids = segments.search(queries, segments_per_query)
+    all_distances, all_indices = [], []
+    for i in range(len(queries)):
+        ranges = segments.frame_ranges(segment_ids[i].tolist())
+        distances, indices = search_ranges(index, queries[i:i + 1], k, ranges)
+        all_distances.append(distances)
+        all_indices.append(indices)
+    return np.vstack(all_distances), np.vstack(all_indices)
@@ -0,0 +1,525 @@
+import os
+import queue
+import shutil
+import threading
+import traceback
+from dataclasses import dataclass, field
+from typing import Optional
+
+from video_processor import VideoRetriever
+from vlm_handler import VLMHandler
+from audio_processor import AudioRetriever
+from answer_cache import AnswerCache
+from retrieval_executor import RetrievalExecutor
+from index_state import IndexHandle, IndexRegistry, SessionIndexes
+from index_storage import load_snapshot, save_snapshot
+from index_compaction import Compactor, compact_snapshot, delete_files, removed_assets, tombstone_videos
+from shard_pool import ShardPool, split_video_id
+from temporal_join import TemporalJoin, fuse_evidence
+from tracing import tracer
+
+
+@dataclass
+class AppServices:
+    vlm: VLMHandler
+    retriever: VideoRetriever
+    audio_retriever: AudioRetriever
+    answer_cache: AnswerCache = field(default_factory=AnswerCache)
+    retrieval: RetrievalExecutor = field(default_factory=RetrievalExecutor)
+    index_dir: Optional[str] = None
+    # 检索结果按关键帧 ↔ 转录的时间重叠互相补充并融合排序
+    cross_modal_join: bool = True
+    # 默认库分片到多个 worker 进程（见 shard_pool）；会话库仍在本进程
+    shards: Optional[ShardPool] = None
+    # 删除视频后在后台重建索引并热替换
+    compactor: Compactor = field(default_factory=Compactor)
+    # 索引包导出 / 导入只允许在该目录内（默认 <index_dir>/bundles）
+    bundle_dir: Optional[str] = None
+    indexes: IndexRegistry = field(init=False)
+    _save_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        # 模型全局共享，索引按会话隔离
+        self.indexes = IndexRegistry(self.retriever, self.audio_retriever)
+        if self.index_dir:
+            self.load_library()
+
+    def load_library(self):
+        """Open the persisted default (session-less) indexes memory-mapped"""
+        for name, handle in (("visual", self.retriever.handle), ("audio", self.audio_retriever.handle)):
+            snapshot = load_snapshot(os.path.join(self.index_dir, name))
+            if snapshot is not None:
+                handle.publish(snapshot)
+                print(f"[Index] Loaded {name} library ({snapshot.ntotal} vectors, mmap) from {self.index_dir}")
+
+    def save_library(self):
+        # 摄取结束与后台压缩都会调用：串行写盘（临时目录名按进程区分），不占用摄取锁
+        with self._save_lock:
+            self._save_library()
+
+    def _save_library(self):
+        for name, handle in (("visual", self.retriever.handle), ("audio", self.audio_retriever.handle)):
+            snapshot = handle.current()
+            directory = os.path.join(self.index_dir, name)
+            # 已持久化的库即使删空也要覆盖，否则重启后被删的视频会回来
+            if snapshot.ntotal or os.path.exists(directory):
+                save_snapshot(snapshot, directory)
+
+    def bundle_root(self):
+        return self.bundle_dir or os.path.join(self.index_dir or "../data/embeddings", "bundles")
+
+    def snapshot_factories(self):
+        return {"visual": self.retriever.new_snapshot, "audio": self.audio_retriever.new_snapshot}
+
+
+def init_services():
+    print("正在初始化 Web 系统 (这可能需要加载多个模型)...")
+    try:
+        retriever = VideoRetriever(decode_workers=int(os.environ.get("VRAG_DECODE_WORKERS", "1")))
+        index_dir = os.environ.get("VRAG_INDEX_DIR") or None
+        shards = None
+        num_shards = int(os.environ.get("VRAG_SHARDS", "0"))
+        if num_shards > 0:
+            shards = ShardPool(
+                os.path.join(index_dir or "../data/embeddings", "shards"),
+                num_shards=num_shards,
+                timeout=float(os.environ.get("VRAG_SHARD_TIMEOUT", "2.0")),
+                segments_per_query=retriever.segments_per_query,
+                hierarchical_min_frames=retriever.hierarchical_min_frames,
+            )
+        return AppServices(
+            vlm=VLMHandler(),
+            retriever=retriever,
+            audio_retriever=AudioRetriever(),
+            index_dir=index_dir,
+            shards=shards,
+            bundle_dir=os.environ.get("VRAG_BUNDLE_DIR") or None,
+        )
+    except Exception as e:
+        print(f"模型加载出错: {e}")
+        raise
+
+
+def session_join(session, visual_snapshot, audio_snapshot):
+    """The session's temporal join for this snapshot pair (rebuilt if the snapshots changed)"""
+    join = session.join
+    if join is None or not join.matches(visual_snapshot, audio_snapshot):
+        join = TemporalJoin.build(visual_snapshot, audio_snapshot)
+        session.join = join
+    return join
+
+
+class IngestCancelled(Exception):
+    pass
+
+
+def _run_ingest_branch(name, fn, events, cancel_event=None):
+    """Run one ingestion branch in a thread, reporting progress/result through the events queue"""
+    def progress(fraction, message):
+        # 在进度回调里检查取消标志，使分支在下一个批次/分段处停止
+        if cancel_event is not None and cancel_event.is_set():
+            raise IngestCancelled(f"{name} cancelled")
+        events.put((name, "progress", fraction, message))
+
+    def target():
+        try:
+            fn(progress)
+            events.put((name, "done", 1.0, ""))
+        except IngestCancelled as e:
+            events.put((name, "error", None, str(e)))
+        except Exception as e:
+            traceback.print_exc()
+            events.put((name, "error", None, str(e)))
+
+    thread = threading.Thread(target=target, name=f"ingest-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def ingest_events(video_path, services: AppServices, session, cancel_event=None, append=False, live=False):
+    """
+    Build visual and audio indexes concurrently for one session.
+
+    Setting cancel_event stops both branches at their next progress report;
+    append adds the video to the session's library instead of replacing it;
+    live follows a recording that is still being written, publishing partial
+    indexes as it goes (see VideoRetriever.process_live).
+
+    Yields the merged branch state ({branch: {"fraction", "message", "status"}})
+    after every progress event; the last yield has no "running" branch left.
+    """
+    state = {name: {"fraction": 0.0, "message": "等待中", "status": "running"} for name in ("visual", "audio")}
+    yield state
+
+    if live:
+        visual_fn = lambda cb: services.retriever.process_live(
+            video_path, progress_callback=cb, target=session.visual, append=append
+        )
+        audio_fn = lambda cb: services.audio_retriever.process_live(
+            video_path, progress_callback=cb, target=session.audio, append=append
+        )
+    else:
+        visual_fn = lambda cb: services.retriever.process_video(
+            video_path, max_duration_minutes=None, progress_callback=cb, target=session.visual, append=append
+        )
+        audio_fn = lambda cb: services.audio_retriever.process_audio(
+            video_path, progress_callback=cb, target=session.audio, append=append
+        )
+    events = queue.Queue()
+    threads = [
+        _run_ingest_branch("visual", visual_fn, events, cancel_event),
+        _run_ingest_branch("audio", audio_fn, events, cancel_event),
+    ]
+
+    # 合并两个分支的进度到同一个状态流
+    while any(st["status"] == "running" for st in state.values()):
+        try:
+            name, kind, fraction, message = events.get(timeout=1.0)
+        except queue.Empty:
+            if not any(t.is_alive() for t in threads) and events.empty():
+                break
+            continue
+        st = state[name]
+        if kind == "progress":
+            st["fraction"], st["message"] = fraction, message
+        elif kind == "done":
+            st["fraction"], st["status"] = 1.0, "done"
+        else:
+            st["status"], st["message"] = "error", message
+        yield state
+
+    # 两个分支都发布后，建库时一次性建立时间关联，查询时只需查表
+    visual_snapshot, audio_snapshot = session.snapshots()
+    session.join = TemporalJoin.build(visual_snapshot, audio_snapshot)
+    print(f"[Index] Temporal join built ({visual_snapshot.ntotal} frames x {audio_snapshot.ntotal} segments)")
+
+
+def ingest_video(video_path, services: AppServices, session_id=None, progress=None, cancel_event=None,
+                 append=False, live=False):
+    """
+    Blocking ingestion for non-UI callers.
+
+    Args:
+        progress: Optional fn(state) called with the merged branch state
+        cancel_event: Optional threading.Event; when set, raises IngestCancelled
+        append: Add the video to the session's library (see ingest_events)
+        live: Follow a recording still being written (see ingest_events)
+
+    Returns:
+        {"visual": {...}, "audio": {...}} with status/message and indexed counts
+    """
+    if session_id is None and services.shards is not None:
+        return _ingest_shard(video_path, services, progress, cancel_event, live=live)
+    session = services.indexes.get(session_id)
+    with session.ingest_lock:
+        state = None
+        for state in ingest_events(video_path, services, session, cancel_event, append=append, live=live):
+            if progress:
+                progress(state)
+    if cancel_event is not None and cancel_event.is_set():
+        raise IngestCancelled(os.path.basename(video_path))
+    if any(handle.current().tombstones for handle in (session.visual, session.audio)):
+        # 摄取期间删除的视频在发布时沿用了墓碑（见 IndexHandle.publish），再压缩一次
+        services.compactor.submit(session, services.snapshot_factories(), _compaction_done(services, session_id))
+    if session_id is None and services.index_dir:
+        # 默认（无会话）索引持久化，其他进程可直接 mmap 打开
+        services.save_library()
+    state["visual"]["ntotal"] = session.visual.current().ntotal
+    state["audio"]["ntotal"] = session.audio.current().ntotal
+    return state
+
+
+def _ingest_shard(video_path, services: AppServices, progress=None, cancel_event=None, live=False):
+    """
+    Add one video to the smallest shard of the sharded default library.
+
+    The video is indexed on top of a private copy of that shard's libraries, saved
+    into the shard directory and picked up by its worker with one reload. Other
+    shards, and this shard's previous library, keep serving queries meanwhile
+    (a live recording becomes searchable when it is finished).
+    """
+    shards = services.shards
+    shard = shards.pick_shard()
+    directory = shards.shard_dir(shard)
+    with shards.ingest_lock(shard):
+        session = SessionIndexes(*(
+            IndexHandle(load_snapshot(os.path.join(directory, name)) or retriever.new_snapshot())
+            for name, retriever in (("visual", services.retriever), ("audio", services.audio_retriever))
+        ))
+        state = None
+        for state in ingest_events(video_path, services, session, cancel_event, append=True, live=live):
+            if progress:
+                progress(state)
+        if cancel_event is not None and cancel_event.is_set():
+            raise IngestCancelled(os.path.basename(video_path))
+        for name, handle in (("visual", session.visual), ("audio", session.audio)):
+            # 版本 0 = 该分支失败，分片里的库保持不变
+            if handle.version:
+                save_snapshot(handle.current(), os.path.join(directory, name))
+        info = shards.reload(shard)
+        assets_dir = session.visual.current().assets_dir
+        if assets_dir:
+            # 关键帧已复制进分片目录
+            shutil.rmtree(assets_dir, ignore_errors=True)
+    print(f"[Shard] {os.path.basename(video_path)} -> shard {shard} "
+          f"({info['visual']['ntotal']} frames, {info['audio']['ntotal']} segments)")
+    state["visual"]["ntotal"] = info["visual"]["ntotal"]
+    state["audio"]["ntotal"] = info["audio"]["ntotal"]
+    return state
+
+
+def answer_query(query, services: AppServices, session_id=None, k=6, time_range=None, video_ids=None):
+    """
+    Retrieve, pack and answer one query.
+
+    Args:
+        time_range: Optional (start_sec, end_sec) restricting retrieved evidence
+        video_ids: Optional library video ids to search in (see list_videos)
+
+    Returns:
+        dict with "answer", "cache_hit", "visual", "audio", "budget" and "retrieval"
+        ("answer" is None when the session has no index yet)
+    """
+    with tracer.span("query", k=k) as span:
+        result = _answer_query(query, services, session_id, k, time_range, video_ids)
+        span.set(cache_hit=result["cache_hit"], visual=len(result["visual"]), audio=len(result["audio"]))
+    return result
+
+
+def shard_branches(services, queries, k, time_range=None, video_ids=None):
+    """Retrieval branches over the sharded default library: encode once here, search in the shard workers"""
+    shards = services.shards
+    return {
+        "visual": lambda: shards.search(
+            "visual", services.retriever.encode_queries(queries), k, time_range, video_ids
+        ),
+        "audio": lambda: shards.search(
+            "audio", services.audio_retriever.encode_queries(queries), k, time_range, video_ids
+        ),
+    }
+
+
+def _retrieve(query, services, session_id, snapshots, k, time_range=None, video_ids=None):
+    """
+    Args:
+        snapshots: The session's pinned (visual, audio) snapshots
+
+    Returns:
+        (visual_results, audio_results, branches, library_ids, evidence_id) where
+        library_ids identifies the searched libraries (answer cache key) and
+        evidence_id(path) names a keyframe for /evidence; None when nothing is indexed
+    """
+    if session_id is None and services.shards is not None:
+        shards = services.shards
+        if shards.ntotal("visual") == 0 and shards.ntotal("audio") == 0:
+            return None
+        print(f"[App] Visual + Audio Search ({shards.num_shards} shards)...")
+        # 跨分片没有统一的 id 空间，不做跨模态时间关联
+        branches = services.retrieval.run({
+            name: (lambda fn=fn: fn()[0])
+            for name, fn in shard_branches(services, [query], k, time_range, video_ids).items()
+        })
+        return (
+            branches["visual"].results, branches["audio"].results, branches,
+            shards.snapshot_ids("visual") + shards.snapshot_ids("audio"), shards.evidence_id,
+        )
+
+    session = services.indexes.lookup(session_id)
+    visual_snapshot, audio_snapshot = snapshots
+    # 全部视频都已删除（待压缩）的库也视为空
+    if all(s.ntotal == 0 or (s.tombstones and not s.videos) for s in snapshots):
+        return None
+
+    print("[App] Visual + Audio Search...")
+    # 每个分支返回 [(命中, 索引 id), ...]，id 用于跨模态关联
+    branches = services.retrieval.run({
+        "visual": lambda: list(zip(*services.retriever.search(
+            query, k=k, snapshot=visual_snapshot, time_range=time_range, video_ids=video_ids, with_ids=True
+        ))),
+        "audio": lambda: list(zip(*services.audio_retriever.search(
+            query, k=k, snapshot=audio_snapshot, time_range=time_range, video_ids=video_ids, with_ids=True
+        ))),
+    })
+    visual_results = [hit for hit, _ in branches["visual"].results]
+    audio_results = [hit for hit, _ in branches["audio"].results]
+    print("[App] Retrieval: " + ", ".join(
+        f"{name}={b.elapsed:.3f}s{'' if b.ok else ' (' + b.error + ')'}" for name, b in branches.items()
+    ))
+    if services.cross_modal_join:
+        with tracer.span("temporal_join") as span:
+            join = session_join(session, visual_snapshot, audio_snapshot)
+            visual_results, audio_results = fuse_evidence(
+                join, visual_snapshot, audio_snapshot,
+                visual_results, [i for _, i in branches["visual"].results],
+                audio_results, [i for _, i in branches["audio"].results],
+            )
+            span.set(visual=len(visual_results), audio=len(audio_results))
+    return (
+        visual_results, audio_results, branches,
+        (visual_snapshot.snapshot_id, audio_snapshot.snapshot_id),
+        lambda path: f"{visual_snapshot.snapshot_id}/{os.path.basename(path)}",
+    )
+
+
+def _answer_query(query, services, session_id, k, time_range=None, video_ids=None):
+    # 整个查询（含 VLM 读取关键帧）持有这一代快照：并发删除的视频关键帧在查询结束后才删除
+    with services.indexes.lookup(session_id).acquire() as snapshots:
+        return _answer_pinned(query, services, session_id, snapshots, k, time_range, video_ids)
+
+
+def _answer_pinned(query, services, session_id, snapshots, k, time_range=None, video_ids=None):
+    retrieved = _retrieve(query, services, session_id, snapshots, k, time_range, video_ids)
+    if retrieved is None:
+        return {"answer": None, "cache_hit": False, "visual": [], "audio": [], "budget": None, "retrieval": {}}
+    visual_results, audio_results, branches, library_ids, evidence_id = retrieved
+    packed = services.vlm.pack_evidence(query, visual_results, audio_results)
+    images_info, audio_info = packed.images_info, packed.audio_info
+
+    cache_key = AnswerCache.make_key(
+        query,
+        library_ids,
+        [("v", round(float(ts), 3), path) for ts, _, path in images_info]
+        + [("a", round(float(start), 3)) for start, _, _ in audio_info],
+        dict(services.vlm.gen_params, history=services.vlm.sessions.history_key(session_id)),
+    )
+    answer = services.answer_cache.get(cache_key)
+    cache_hit = answer is not None
+    if cache_hit:
+        print("[App] Answer cache hit.")
+        if session_id is not None:
+            services.vlm.record_cached_turn(session_id, query, images_info, audio_info, answer)
+    else:
+        answer = services.vlm.chat(query, images_info, audio_info, session_id=session_id)
+        if not answer.startswith("[Model Error]"):
+            services.answer_cache.put(cache_key, answer)
+
+    return {
+        "answer": answer,
+        "cache_hit": cache_hit,
+        "visual": [
+            {
+                "timestamp": float(ts),
+                "score": float(score),
+                "path": path,
+                "evidence_id": evidence_id(path),
+            }
+            for ts, score, path in images_info
+        ],
+        "audio": [
+            {"start": float(start), "text": text, "score": float(score)}
+            for start, text, score in audio_info
+        ],
+        "budget": {
+            "tokens_used": packed.tokens_used,
+            "token_budget": packed.token_budget,
+            "dropped_images": packed.dropped_images,
+            "dropped_audio": packed.dropped_audio,
+        },
+        "retrieval": {
+            name: {"elapsed": b.elapsed, "ok": b.ok, "error": b.error} for name, b in branches.items()
+        },
+    }
+
+
+def _compaction_done(services, session_id):
+    if session_id is None and services.index_dir:
+        return lambda session: services.save_library()
+    return None
+
+
+def remove_video(services: AppServices, video_id, session_id=None):
+    """
+    Remove one video from a session's library without interrupting queries.
+
+    A tombstoned generation (same vectors, the video hidden from search) is published
+    at once and the compactor rebuilds the library without the video's rows in the
+    background. The video's keyframes are deleted once the last query still running
+    on an older generation has finished. Re-ingesting a video is remove_video followed
+    by an append ingestion.
+
+    Does not wait for a running ingestion: the tombstone is published with a
+    compare-and-swap, and an ingestion that publishes later keeps it (see IndexHandle.publish).
+
+    Returns:
+        The removed video's visual (or audio) entry; raises KeyError for an unknown video
+    """
+    if session_id is None and services.shards is not None:
+        return _remove_from_shard(services, video_id)
+    session = services.indexes.lookup(session_id)
+    removed = None
+    for handle in (session.visual, session.audio):
+        paths = None
+        while True:
+            base = handle.current()
+            entry = next((v for v in base.videos if v["video_id"] == video_id), None)
+            if entry is None:
+                break
+            if paths is None:
+                # 视频的关键帧路径不随代变化，CAS 重试时不必重新扫描资产目录
+                paths = removed_assets(base, {video_id})
+            # 墓碑代只共享向量、构造很快：有并发发布就基于新一代重做
+            if handle.publish_if(tombstone_videos(base, [video_id]), expected=base):
+                removed = removed or entry
+                if paths:
+                    handle.defer(lambda paths=paths: delete_files(paths))
+                break
+    if removed is None:
+        raise KeyError(video_id)
+    print(f"[Index] Removed video {video_id} ({os.path.basename(str(removed['source']))}), compaction scheduled")
+    services.compactor.submit(session, services.snapshot_factories(), _compaction_done(services, session_id))
+    return removed
+
+
+def _remove_from_shard(services: AppServices, video_id):
+    """Sharded library: rebuild the owning shard without the video and reload only that shard"""
+    shards = services.shards
+    shard, local_id = split_video_id(video_id, shards.num_shards)
+    if shard >= shards.num_shards:
+        raise KeyError(video_id)
+    directory = shards.shard_dir(shard)
+    factories = services.snapshot_factories()
+    removed = None
+    with shards.ingest_lock(shard):
+        for name in ("visual", "audio"):
+            base = load_snapshot(os.path.join(directory, name))
+            entry = next((v for v in base.videos if v["video_id"] == local_id), None) if base else None
+            if entry is None:
+                continue
+            removed = removed or dict(entry, video_id=video_id)
+            snapshot = compact_snapshot(tombstone_videos(base, [local_id]), factories[name]())
+            save_snapshot(snapshot, os.path.join(directory, name))
+        if removed is None:
+            raise KeyError(video_id)
+        shards.reload(shard)
+    print(f"[Shard] Removed video {video_id} from shard {shard}")
+    return removed
+
+
+def list_videos(services: AppServices, session_id=None):
+    """Videos in a session's library with their per-modality vector counts"""
+    if session_id is None and services.shards is not None:
+        return [
+            {
+                "video_id": v["video_id"],
+                "source": v["source"],
+                "duration": v.get("duration"),
+                "frames": v["end_id"] - v["start_id"],
+                "segments": v["segments"],
+                "live": v.get("live", False),
+                "shard": v["shard"],
+            }
+            for v in services.shards.videos()
+        ]
+    visual_snapshot, audio_snapshot = services.indexes.lookup(session_id).snapshots()
+    audio_counts = {v["video_id"]: v["end_id"] - v["start_id"] for v in audio_snapshot.videos}
+    return [
+        {
+            "video_id": v["video_id"],
+            "source": v["source"],
+            "duration": v.get("duration"),
+            "frames": v["end_id"] - v["start_id"],
+            "segments": audio_counts.get(v["video_id"], 0),
+            "live": v.get("live", False),
+        }
+        for v in visual_snapshot.videos
+    ]
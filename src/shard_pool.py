@@ -0,0 +1,352 @@
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from index_filters import candidate_ranges, search_ranges
+from index_storage import load_snapshot
+from metadata_store import gather_results
+from segment_index import search_segments
+from tracing import Histogram, tracer
+
+SHARD_LIBRARIES = ("visual", "audio")
+
+# 各库的过滤字段、返回字段，以及命中元组里距离所在的位置
+LIBRARY_SPECS = {
+    "visual": {"filter": {"start_field": "timestamp"}, "fields": ("timestamp", "path"), "distance": 1},
+    "audio": {"filter": {"start_field": "start", "end_field": "end"}, "fields": ("start", "text"), "distance": 2},
+}
+
+
+def global_video_id(shard, local_id, num_shards):
+    """Library-wide video id of a shard's local video id (interleaved, no catalogue needed)"""
+    return local_id * num_shards + shard
+
+
+def split_video_id(video_id, num_shards):
+    """(shard, local video id) of a library-wide video id"""
+    return video_id % num_shards, video_id // num_shards
+
+
+def _open_libraries(shard_dir):
+    return {name: load_snapshot(os.path.join(shard_dir, name)) for name in SHARD_LIBRARIES}
+
+
+def _describe(libraries):
+    return {
+        name: {
+            "snapshot_id": snapshot.snapshot_id,
+            "ntotal": snapshot.ntotal,
+            "videos": snapshot.videos,
+        } if snapshot is not None else {"snapshot_id": None, "ntotal": 0, "videos": []}
+        for name, snapshot in libraries.items()
+    }
+
+
+def _search_library(snapshot, library, queries, k, time_range, video_ids, options):
+    """Same dispatch as the retrievers' search_many, returning hits in their tuple formats"""
+    spec = LIBRARY_SPECS[library]
+    ranges = candidate_ranges(snapshot, time_range, video_ids, **spec["filter"])
+    if ranges is not None:
+        distances, indices = search_ranges(snapshot.index, queries, k, ranges)
+    elif (library == "visual" and snapshot.segments is not None
+          and snapshot.ntotal >= options["hierarchical_min_frames"]):
+        distances, indices = search_segments(snapshot.index, snapshot.segments, queries, k,
+                                             options["segments_per_query"])
+    else:
+        distances, indices = snapshot.index.search(queries, k)
+
+    results = []
+    for columns, dists, _ in gather_results(snapshot.metadata, distances, indices, spec["fields"]):
+        if library == "visual":
+            results.append(list(zip(columns["timestamp"].tolist(), dists.tolist(), columns["path"])))
+        else:
+            results.append(list(zip(columns["start"].tolist(), columns["text"], dists.tolist())))
+    return results
+
+
+def shard_main(shard_dir, conn, options):
+    """
+    Shard worker: serve searches over one shard's persisted libraries (mmap).
+
+    Requests are (op, request_id, args); every reply is (request_id, ok, result).
+    The worker only needs FAISS + numpy: queries arrive already encoded.
+    """
+    libraries = _open_libraries(shard_dir)
+    while True:
+        try:
+            op, request_id, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        if op == "stop":
+            return
+        try:
+            if op == "search":
+                library, queries, k, time_range, video_ids = args
+                snapshot = libraries[library]
+                if snapshot is None or snapshot.ntotal == 0:
+                    result = [[] for _ in range(len(queries))]
+                else:
+                    result = _search_library(snapshot, library, queries, k, time_range, video_ids, options)
+            elif op == "reload":
+                # 换目录后重新 mmap；进行中的查询已结束（单线程），旧文件随映射释放
+                libraries = _open_libraries(shard_dir)
+                result = _describe(libraries)
+            elif op == "describe":
+                result = _describe(libraries)
+            else:
+                raise ValueError(f"unknown shard op: {op}")
+            conn.send((request_id, True, result))
+        except Exception as e:
+            conn.send((request_id, False, f"{type(e).__name__}: {e}"))
+
+
+class ShardProcess:
+    """
+    One shard served by a local worker process.
+
+    call() returns a Future resolved by a reader thread, so many coordinator threads
+    can have requests in flight; a reply that arrives after its caller gave up is
+    dropped. A remote shard only needs the same call()/info contract.
+    """
+
+    def __init__(self, shard, directory, context, options):
+        self.shard = shard
+        self.directory = directory
+        self.context = context
+        self.options = options
+        self.info = _describe({name: None for name in SHARD_LIBRARIES})
+        self.latency = Histogram()
+        self.queries = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.restarts = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.process = None
+        self._start()
+
+    def _start(self):
+        self.conn, child = self.context.Pipe()
+        self.process = self.context.Process(
+            target=shard_main, args=(self.directory, child, self.options), name=f"shard-{self.shard}", daemon=True
+        )
+        self.process.start()
+        child.close()
+        # 每个 worker 连接有自己的待回复表：重启后旧读线程只清理旧请求
+        self._pending = {}
+        threading.Thread(target=self._read_loop, args=(self.conn, self._pending),
+                         name=f"shard-{self.shard}-reader", daemon=True).start()
+
+    def _read_loop(self, conn, pending):
+        while True:
+            try:
+                request_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                entry = pending.pop(request_id, None)
+            if entry is None:
+                continue
+            future, op, sent_at = entry
+            if op == "search":
+                self.latency.observe(time.time() - sent_at)
+            if ok and op in ("reload", "describe"):
+                self.info = result
+            # 调用方已超时取消的请求：丢弃迟到的结果
+            if future.set_running_or_notify_cancel():
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(f"shard {self.shard}: {result}"))
+        with self._lock:
+            orphaned = list(pending.values())
+            pending.clear()
+        for future, _, _ in orphaned:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError(f"shard {self.shard} worker exited"))
+
+    def call(self, op, *args):
+        future = Future()
+        with self._lock:
+            if not self.process.is_alive():
+                print(f"[Shard Warning] shard {self.shard} worker exited (code {self.process.exitcode}), restarting")
+                self.restarts += 1
+                self._start()
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, op, time.time())
+            self.conn.send((op, request_id, args))
+        return future
+
+    def stop(self):
+        try:
+            with self._lock:
+                self.conn.send(("stop", None, None))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ShardPool:
+    def __init__(self, root, num_shards=2, timeout=2.0, segments_per_query=8, hierarchical_min_frames=2000):
+        """
+        Default library partitioned across worker processes (scatter-gather search).
+
+        Each shard is a persisted library pair (root/shard-<i>/visual, /audio) in the
+        index_storage layout, memory-mapped by its own worker. The coordinator encodes
+        a query once, broadcasts the embedding to the shards holding candidate videos
+        and merges their top-k by distance.
+
+        Args:
+            root: Directory holding the shard libraries
+            num_shards: Worker processes (a video lives entirely in one shard)
+            timeout: Seconds a shard may take before its results are left out
+            segments_per_query / hierarchical_min_frames: Visual coarse-to-fine search,
+                as in VideoRetriever
+        """
+        self.root = root
+        self.num_shards = num_shards
+        self.timeout = timeout
+        os.makedirs(root, exist_ok=True)
+        options = {"segments_per_query": segments_per_query, "hierarchical_min_frames": hierarchical_min_frames}
+        # spawn：worker 不继承父进程里的模型 / CUDA 状态，只加载 FAISS + numpy
+        context = multiprocessing.get_context("spawn")
+        self.shards = [ShardProcess(i, self.shard_dir(i), context, options) for i in range(num_shards)]
+        self._ingest_locks = [threading.Lock() for _ in range(num_shards)]
+        for shard in self.shards:
+            shard.call("describe").result(timeout=60)
+        print(f"[Shard] {num_shards} shards under {root}: "
+              + ", ".join(f"{s.info['visual']['ntotal']} frames" for s in self.shards))
+
+    def shard_dir(self, shard):
+        return os.path.join(self.root, f"shard-{shard}")
+
+    def ntotal(self, library):
+        return sum(shard.info[library]["ntotal"] for shard in self.shards)
+
+    def snapshot_ids(self, library):
+        """Current snapshot id of every shard (changes whenever any shard reloads)"""
+        return tuple(shard.info[library]["snapshot_id"] for shard in self.shards)
+
+    def videos(self):
+        """Library-wide video table: visual entries with global ids and their audio segment counts"""
+        videos = []
+        for shard in self.shards:
+            audio_counts = {v["video_id"]: v["end_id"] - v["start_id"] for v in shard.info["audio"]["videos"]}
+            for video in shard.info["visual"]["videos"]:
+                videos.append(dict(
+                    video,
+                    video_id=global_video_id(shard.shard, video["video_id"], self.num_shards),
+                    shard=shard.shard,
+                    segments=audio_counts.get(video["video_id"], 0),
+                ))
+        return sorted(videos, key=lambda v: v["video_id"])
+
+    def evidence_root(self, snapshot_id):
+        """Keyframe directory of the shard whose visual library has this snapshot id"""
+        for shard in self.shards:
+            if shard.info["visual"]["snapshot_id"] == snapshot_id:
+                return os.path.join(shard.directory, "visual", "assets")
+        return None
+
+    def evidence_id(self, path):
+        shard_root = os.path.abspath(self.root)
+        relative = os.path.relpath(os.path.abspath(path), shard_root).split(os.sep)
+        shard = self.shards[int(relative[0].split("-")[1])]
+        return f"{shard.info['visual']['snapshot_id']}/{os.path.basename(path)}"
+
+    def search(self, library, queries, k=5, time_range=None, video_ids=None):
+        """
+        Scatter already encoded queries ((n, d) float32) to the shards and merge their top-k.
+
+        Args:
+            time_range: Optional (start_sec, end_sec), applied inside every shard
+            video_ids: Optional library-wide video ids; only shards holding them are asked
+
+        Returns:
+            One hit list per query in the retriever's tuple format, best first. Shards
+            that time out or fail are left out (see stats()).
+        """
+        targets = {}
+        if video_ids is None:
+            targets = {shard.shard: None for shard in self.shards if shard.info[library]["ntotal"]}
+        else:
+            for video_id in video_ids:
+                shard, local_id = split_video_id(video_id, self.num_shards)
+                targets.setdefault(shard, []).append(local_id)
+
+        merged = [[] for _ in range(len(queries))]
+        with tracer.span("shards.search", library=library, shards=len(targets), k=k) as span:
+            start = time.time()
+            futures = {
+                i: self.shards[i].call("search", library, queries, k, time_range, local_ids)
+                for i, local_ids in targets.items()
+            }
+            failed = []
+            for i, future in futures.items():
+                shard = self.shards[i]
+                shard.queries += 1
+                # 所有分片共享起始时间：总等待是最慢分片，而不是各分片之和
+                remaining = max(0.0, self.timeout - (time.time() - start))
+                try:
+                    per_query = future.result(timeout=remaining)
+                except FutureTimeout:
+                    future.cancel()
+                    shard.timeouts += 1
+                    failed.append(i)
+                    print(f"[Shard Warning] shard {i} timed out after {self.timeout:.1f}s, skipped.")
+                    continue
+                except Exception as e:
+                    shard.errors += 1
+                    failed.append(i)
+                    print(f"[Shard Warning] {e}")
+                    continue
+                for hits, shard_hits in zip(merged, per_query):
+                    hits.extend(shard_hits)
+            span.set(failed=len(failed))
+
+        distance = LIBRARY_SPECS[library]["distance"]
+        return [sorted(hits, key=lambda hit: hit[distance])[:k] for hits in merged]
+
+    def pick_shard(self):
+        """Shard for the next video: the smallest one not currently ingesting"""
+        idle = [s for s in self.shards if not self._ingest_locks[s.shard].locked()] or self.shards
+        return min(idle, key=lambda s: (s.info["visual"]["ntotal"], s.shard)).shard
+
+    def ingest_lock(self, shard):
+        return self._ingest_locks[shard]
+
+    def reload(self, shard):
+        """Make a shard's worker re-open its libraries after they were saved; other shards are untouched"""
+        return self.shards[shard].call("reload").result(timeout=60)
+
+    def stats(self):
+        stats = {}
+        for shard in self.shards:
+            percentiles = shard.latency.percentiles()
+            stats[str(shard.shard)] = {
+                "alive": shard.process.is_alive(),
+                "frames": shard.info["visual"]["ntotal"],
+                "segments": shard.info["audio"]["ntotal"],
+                "videos": len(shard.info["visual"]["videos"]),
+                "queries": shard.queries,
+                "timeouts": shard.timeouts,
+                "errors": shard.errors,
+                "restarts": shard.restarts,
+                "latency_p50_ms": percentiles[0.5] * 1000,
+                "latency_p95_ms": percentiles[0.95] * 1000,
+                "latency_p99_ms": percentiles[0.99] * 1000,
+            }
+        return stats
+
+    def metrics(self):
+        """stats() flattened for the Prometheus collector: {"<shard>_<name>": number}"""
+        return {f"{shard}_{name}": value for shard, values in self.stats().items() for name, value in values.items()}
+
+    def close(self):
+        for shard in self.shards:
+            shard.stop()
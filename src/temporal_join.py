@@ -0,0 +1,143 @@
+import os
+
+import numpy as np
+
+
+def _normalize_source(source):
+    if not source:
+        return source
+    root, ext = os.path.splitext(os.path.realpath(source))
+    # 旧库里视觉分支可能记录了自动转码后的 xxx_h264.mp4
+    if root.endswith("_h264"):
+        root = root[:-len("_h264")]
+    return root
+
+
+def same_source(a, b):
+    """Whether two video-table sources name the same original video (../ resolution, H.264 transcode)"""
+    return a == b or _normalize_source(a) == _normalize_source(b)
+
+
+class TemporalJoin:
+    """
+    Keyframe <-> transcript interval index for one (visual, audio) snapshot pair.
+
+    A keyframe is on screen from its timestamp until the next keyframe of the same
+    video; it is joined to every transcript segment overlapping that interval. A
+    segment is joined to the keyframe on screen at its midpoint. Both directions
+    are resolved by binary search when the join is built, so a lookup at query
+    time is plain array indexing.
+    """
+
+    def __init__(self, frame_audio, audio_frame, visual_id=None, audio_id=None):
+        """
+        Args:
+            frame_audio: (n_frames, 2) int64 [lo, hi) audio id range per keyframe
+            audio_frame: (n_segments,) int64 keyframe id per segment (-1 = none)
+            visual_id / audio_id: snapshot_id of the snapshots the join was built from
+        """
+        self.frame_audio = frame_audio
+        self.audio_frame = audio_frame
+        self.visual_id = visual_id
+        self.audio_id = audio_id
+
+    @classmethod
+    def build(cls, visual_snapshot, audio_snapshot):
+        frame_audio = np.zeros((visual_snapshot.ntotal, 2), dtype=np.int64)
+        audio_frame = np.full(audio_snapshot.ntotal, -1, dtype=np.int64)
+        audio_videos = {v["video_id"]: v for v in audio_snapshot.videos}
+        for video in visual_snapshot.videos:
+            other = audio_videos.get(video["video_id"])
+            if other is None or not same_source(other["source"], video["source"]):
+                # 某个分支失败时两库的视频表可能错位，此时不关联
+                continue
+            f0, f1 = video["start_id"], video["end_id"]
+            a0, a1 = other["start_id"], other["end_id"]
+            if f1 <= f0 or a1 <= a0:
+                continue
+            times = visual_snapshot.metadata.column("timestamp")[f0:f1]
+            starts = audio_snapshot.metadata.column("start")[a0:a1]
+            ends = audio_snapshot.metadata.column("end")[a0:a1]
+
+            # 关键帧 i 的显示区间 [t_i, t_{i+1})；最后一帧持续到视频结束
+            shown_until = np.append(times[1:], np.inf)
+            lo = np.searchsorted(ends, times, side="right")
+            hi = np.maximum(np.searchsorted(starts, shown_until, side="left"), lo)
+            frame_audio[f0:f1, 0] = a0 + lo
+            frame_audio[f0:f1, 1] = a0 + hi
+
+            # 片段中点时刻屏幕上的关键帧（早于第一帧的片段对应第一帧）
+            on_screen = np.searchsorted(times, (starts + ends) / 2, side="right") - 1
+            audio_frame[a0:a1] = f0 + np.maximum(on_screen, 0)
+        return cls(frame_audio, audio_frame, visual_snapshot.snapshot_id, audio_snapshot.snapshot_id)
+
+    def matches(self, visual_snapshot, audio_snapshot):
+        return self.visual_id == visual_snapshot.snapshot_id and self.audio_id == audio_snapshot.snapshot_id
+
+    def audio_for_frame(self, frame_id, limit=None):
+        """Transcript segment ids overlapping a keyframe's on-screen interval (closest first)"""
+        lo, hi = self.frame_audio[frame_id].tolist()
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return range(lo, hi)
+
+    def frame_for_audio(self, audio_id):
+        frame_id = int(self.audio_frame[audio_id])
+        return frame_id if frame_id >= 0 else None
+
+
+def fuse_evidence(join, visual_snapshot, audio_snapshot, visual_hits, visual_ids, audio_hits, audio_ids,
+                  attach_top=3, audio_per_frame=2, attach_weight=0.5, rrf_k=10):
+    """
+    Fused cross-modal ranking of retrieval results.
+
+    Each hit scores 1 / (rrf_k + rank) in its own modality, plus the score of any
+    hit from the other modality it co-occurs with (a slide and the speech over it
+    confirm each other). The attach_top best hits of each modality also pull in
+    their co-occurring evidence from the other modality (audio_per_frame transcript
+    segments per keyframe, one keyframe per segment) at attach_weight of the
+    parent's score. No extra encoder calls are made.
+
+    Args:
+        visual_hits / visual_ids: [(timestamp, distance, path), ...] and their keyframe ids
+        audio_hits / audio_ids: [(start, text, distance), ...] and their segment ids
+
+    Returns:
+        (images_info, audio_info) in the retrievers' tuple formats, best first;
+        distances are replaced by 2 - 2 * fused score so EvidencePacker ranks by it
+    """
+    visual_rank = {fid: 1.0 / (rrf_k + r + 1) for r, fid in enumerate(visual_ids)}
+    audio_rank = {aid: 1.0 / (rrf_k + r + 1) for r, aid in enumerate(audio_ids)}
+
+    visual_scores, audio_scores = {}, {}
+    for fid, base in visual_rank.items():
+        lo, hi = join.frame_audio[fid].tolist()
+        visual_scores[fid] = base + sum(audio_rank.get(aid, 0.0) for aid in range(lo, hi))
+    for aid, base in audio_rank.items():
+        audio_scores[aid] = base + visual_rank.get(join.frame_for_audio(aid), 0.0)
+
+    # 只为排名靠前的命中补充另一模态的同现证据
+    for fid in visual_ids[:attach_top]:
+        for aid in join.audio_for_frame(fid, limit=audio_per_frame):
+            audio_scores[aid] = max(audio_scores.get(aid, 0.0), attach_weight * visual_scores[fid])
+    for aid in audio_ids[:attach_top]:
+        fid = join.frame_for_audio(aid)
+        if fid is not None:
+            visual_scores[fid] = max(visual_scores.get(fid, 0.0), attach_weight * audio_scores[aid])
+
+    images_info, audio_info = [], []
+    visual_order = sorted(visual_scores, key=visual_scores.get, reverse=True)
+    if visual_order:
+        columns = visual_snapshot.metadata.gather(visual_order, ("timestamp", "path"))
+        images_info = [
+            (ts, 2.0 - 2.0 * visual_scores[fid], path)
+            for fid, ts, path in zip(visual_order, columns["timestamp"].tolist(), columns["path"])
+        ]
+    audio_order = sorted(audio_scores, key=audio_scores.get, reverse=True)
+    if audio_order:
+        columns = audio_snapshot.metadata.gather(audio_order, ("start", "text"))
+        audio_info = [
+            (start, text, 2.0 - 2.0 * audio_scores[aid])
+            for aid, start, text in zip(audio_order, columns["start"].tolist(), columns["text"])
+        ]
+    return images_info, audio_info
@@ -0,0 +1,182 @@
+import functools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Rolling latency window (for percentiles) plus lifetime count/sum"""
+
+    def __init__(self, window=1024):
+        self._values = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._values.append(value)
+            self.count += 1
+            self.total += value
+
+    def percentiles(self, quantiles=QUANTILES):
+        with self._lock:
+            ordered = sorted(self._values)
+        if not ordered:
+            return {q: 0.0 for q in quantiles}
+        return {q: ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] for q in quantiles}
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "duration", "children", "parent")
+
+    def __init__(self, name, attrs, parent=None):
+        self.name = name
+        self.attrs = dict(attrs)
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "duration": self.duration,
+            "attrs": self.attrs,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+class _NoopSpan:
+    name = None
+
+    def set(self, **attrs):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    def __init__(self, enabled=None, window=1024, keep_traces=50):
+        """
+        Nested span tracing with rolling per-span latency histograms.
+
+        Args:
+            enabled: Defaults to the VRAG_TRACING environment variable ("1" to enable)
+            window: Samples per span name kept for p50/p95/p99
+            keep_traces: Number of recent root spans kept for inspection
+        """
+        if enabled is None:
+            enabled = os.environ.get("VRAG_TRACING", "0") == "1"
+        self.enabled = enabled
+        self.window = window
+        self._local = threading.local()
+        self._histograms = {}
+        self._hist_lock = threading.Lock()
+        self._traces = deque(maxlen=keep_traces)
+        self._collectors = []
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        """Innermost open span on this thread (pass as parent= to continue a trace in another thread)"""
+        if not self.enabled:
+            return None
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _histogram(self, name):
+        hist = self._histograms.get(name)
+        if hist is None:
+            with self._hist_lock:
+                hist = self._histograms.setdefault(name, Histogram(self.window))
+        return hist
+
+    def _finish(self, span):
+        self._histogram(span.name).observe(span.duration)
+        if span.parent is not None:
+            span.parent.children.append(span)
+        else:
+            self._traces.append(span)
+
+    @contextmanager
+    def span(self, name, parent=None, **attrs):
+        if not self.enabled:
+            yield NOOP_SPAN
+            return
+        stack = self._stack()
+        span = Span(name, attrs, parent if parent is not None else (stack[-1] if stack else None))
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.start
+            stack.pop()
+            self._finish(span)
+
+    def record(self, name, duration, parent=None, **attrs):
+        """Add an already-measured span (e.g. prefill/decode split measured by a streamer)"""
+        if not self.enabled:
+            return
+        span = Span(name, attrs, parent if parent is not None else self.current())
+        span.duration = duration
+        self._finish(span)
+
+    def traced(self, name):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_collector(self, fn):
+        """fn() -> {metric_name: number}; exported as gauges alongside span summaries"""
+        self._collectors.append(fn)
+
+    def recent_traces(self):
+        return [span.to_dict() for span in list(self._traces)]
+
+    def export_prometheus(self, prefix="vrag"):
+        lines = [
+            f"# HELP {prefix}_span_duration_seconds Span latency (rolling window quantiles)",
+            f"# TYPE {prefix}_span_duration_seconds summary",
+        ]
+        with self._hist_lock:
+            histograms = sorted(self._histograms.items())
+        for name, hist in histograms:
+            for q, value in hist.percentiles().items():
+                lines.append(f'{prefix}_span_duration_seconds{{span="{name}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'{prefix}_span_duration_seconds_sum{{span="{name}"}} {hist.total:.6f}')
+            lines.append(f'{prefix}_span_duration_seconds_count{{span="{name}"}} {hist.count}')
+        for collector in self._collectors:
+            try:
+                values = collector()
+            except Exception as e:
+                lines.append(f"# collector error: {e}")
+                continue
+            for metric, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {prefix}_{metric} gauge")
+                lines.append(f"{prefix}_{metric} {value}")
+        lines.append(f"{prefix}_tracing_enabled {int(self.enabled)}")
+        return "\n".join(lines) + "\n"
+
+
+tracer = Tracer()
@@ -9,29 +9,104 @@ import time
 import shutil
 import subprocess
 
+from index_state import IndexHandle, IndexSnapshot
+from metadata_store import MetadataStore, VIDEO_SCHEMA, gather_results
+from index_filters import allocate_video_id, candidate_ranges, copy_library, flat_vectors, search_ranges
+from segment_index import SegmentLevel, search_segments
+from frame_sampler import (
+    FrameReader, FrameRing, adaptive_keyframes, fixed_keyframes, fixed_rate_equivalent, fixed_samples, signature_diff,
+)
+from live_source import LiveSource
+from parallel_decode import parallel_fixed_keyframes
+from tracing import tracer
+from profiling import profiled
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class _KeyframeBatch:
+    """Saves keyframes to the snapshot's assets and embeds them in fixed-size batches"""
+
+    def __init__(self, retriever, snapshot, video_id, batch_size=64):
+        self.retriever = retriever
+        self.snapshot = snapshot
+        self.video_id = video_id
+        # 预分配的模型分辨率批缓冲区：峰值内存与源视频分辨率无关
+        self.ring = FrameRing(batch_size, retriever.input_resolution)
+        self.timestamps, self.paths, self.frame_ids = [], [], []
+        self.saved = 0
+
+    def frame_path(self, i):
+        return os.path.join(self.snapshot.assets_dir, f"v{self.video_id:03d}_frame_{i:05d}.jpg")
+
+    def add(self, frame, timestamp, frame_idx):
+        """Queue one keyframe; returns True when this filled and flushed a batch"""
+        frame_path = self.frame_path(self.saved)
+        cv2.imwrite(frame_path, frame)
+        self.ring.put(frame)
+        self.timestamps.append(timestamp)
+        self.paths.append(frame_path)
+        self.frame_ids.append(frame_idx)
+        self.saved += 1
+        if self.ring.full():
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if len(self.ring) == 0:
+            return
+        self.retriever._embed_and_add_to_index(self.ring.view(), self.timestamps, self.paths, self.snapshot,
+                                               self.frame_ids, self.video_id)
+        self.ring.clear()
+        self.timestamps, self.paths, self.frame_ids = [], [], []
+
+
 class VideoRetriever:
-    def __init__(self, model_name="ViT-B/32"):
+    def __init__(self, model_name="ViT-B/32", model=None, preprocess=None, keyframe_dir="keyframes",
+                 use_fast_index=False, segment_seconds=60.0, hierarchical_min_frames=2000, segments_per_query=8,
+                 decode_workers=1):
         """
         Initialize retriever: load CLIP model and FAISS index
         
         Args:
             model_name: CLIP model name (default: "ViT-B/32")
+            model / preprocess: Already loaded CLIP model and image transform (skips clip.load;
+                used to share one model across retrievers, or to pass stub encoders offline)
+            keyframe_dir: Directory for extracted keyframes (cleared on start)
+            use_fast_index: 使用 HNSW 索引（大数据量时更快）
+            segment_seconds: Window length of the segment-level (coarse) index
+            hierarchical_min_frames: Libraries with at least this many frames are searched
+                coarse-to-fine (segments first, then frames inside the best segments)
+            segments_per_query: Segments expanded to frame level per query
+            decode_workers: Processes decoding time slices of one video in parallel (1 = serial)
         """
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
         
-        print(f"[Init] 正在加载 CLIP 模型 ({model_name}) 到 {self.device}...")
-        try:
-            self.model, self.preprocess = clip.load(model_name, device=self.device)
-            print("[Init] CLIP 模型加载成功。")
-        except Exception as e:
-            print(f"[Error] 模型加载失败: {e}")
-            raise e
+        # 自行加载的 CLIP 用张量批量预处理；外部传入的 preprocess 逐张应用
+        self.tensor_preprocess = model is None
+        if model is not None:
+            self.model, self.preprocess = model, preprocess
+        else:
+            print(f"[Init] 正在加载 CLIP 模型 ({model_name}) 到 {self.device}...")
+            try:
+                self.model, self.preprocess = clip.load(model_name, device=self.device)
+                print("[Init] CLIP 模型加载成功。")
+            except Exception as e:
+                print(f"[Error] 模型加载失败: {e}")
+                raise e
         
+        self.model_name = model_name
         self.dimension = 512 
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.metadata = {} 
+        self.input_resolution = getattr(getattr(self.model, "visual", None), "input_resolution", 224)
+        self.use_fast_index = use_fast_index
+        self.segment_seconds = segment_seconds
+        self.hierarchical_min_frames = hierarchical_min_frames
+        self.segments_per_query = segments_per_query
+        self.decode_workers = decode_workers
         
-        self.keyframe_dir = "keyframes"
+        self.keyframe_dir = keyframe_dir
         if os.path.exists(self.keyframe_dir):
             try:
                 shutil.rmtree(self.keyframe_dir)
@@ -40,22 +115,25 @@ class VideoRetriever:
         if not os.path.exists(self.keyframe_dir):
             os.makedirs(self.keyframe_dir)
 
-    def _calculate_histogram_diff(self, frame1, frame2):
-        """Calculate histogram difference for keyframe detection"""
-        try:
-            f1_small = cv2.resize(frame1, (64, 64))
-            f2_small = cv2.resize(frame2, (64, 64))
-
-            h1 = cv2.calcHist([cv2.cvtColor(f1_small, cv2.COLOR_BGR2HSV)], [0], None, [256], [0, 256])
-            h2 = cv2.calcHist([cv2.cvtColor(f2_small, cv2.COLOR_BGR2HSV)], [0], None, [256], [0, 256])
-            
-            cv2.normalize(h1, h1, 0, 1, cv2.NORM_MINMAX)
-            cv2.normalize(h2, h2, 0, 1, cv2.NORM_MINMAX)
-            
-            score = cv2.compareHist(h1, h2, cv2.HISTCMP_BHATTACHARYYA)
-            return score
-        except Exception as e:
-            return 0.0
+        self.handle = IndexHandle(self.new_snapshot())
+
+    def new_snapshot(self):
+        """Empty, unpublished index state for one ingestion run"""
+        if self.use_fast_index:
+            return IndexSnapshot(faiss.IndexHNSWFlat(self.dimension, 32), MetadataStore(VIDEO_SCHEMA))
+        return IndexSnapshot(faiss.IndexFlatL2(self.dimension), MetadataStore(VIDEO_SCHEMA))
+
+    @property
+    def index(self):
+        return self.handle.current().index
+
+    @property
+    def metadata(self):
+        return self.handle.current().metadata
+
+    @property
+    def index_version(self):
+        return self.handle.version
 
     def _convert_to_h264(self, input_path):
         """Convert unsupported video format to H.264"""
@@ -75,12 +153,23 @@ class VideoRetriever:
             print(f"[Error] 转码失败: {e}")
         return None
 
-    def _embed_and_add_to_index(self, frame_buffer, timestamp_buffer, path_buffer):
-        """Batch encode frames and add to FAISS index"""
-        if not frame_buffer:
+    def _preprocess_batch(self, frames):
+        """(n, S, S, 3) RGB uint8 crops -> CLIP input tensor on self.device"""
+        if not self.tensor_preprocess:
+            return torch.stack([self.preprocess(Image.fromarray(frame)) for frame in frames]).to(self.device)
+        # 与 clip preprocess 的 ToTensor + Normalize 等价，在设备上整批完成
+        batch = torch.from_numpy(frames).to(self.device).permute(0, 3, 1, 2).float().div_(255.0)
+        mean = torch.tensor(CLIP_MEAN, device=self.device).view(1, 3, 1, 1)
+        std = torch.tensor(CLIP_STD, device=self.device).view(1, 3, 1, 1)
+        return batch.sub_(mean).div_(std)
+
+    def _embed_and_add_to_index(self, frames, timestamp_buffer, path_buffer, snapshot, frame_ids=None,
+                                video_id=0):
+        """Batch encode frames ((n, S, S, 3) RGB crops) and add to the (unpublished) snapshot's FAISS index"""
+        if len(frames) == 0:
             return
 
-        batch_inputs = torch.stack([self.preprocess(img) for img in frame_buffer]).to(self.device)
+        batch_inputs = self._preprocess_batch(frames)
         
         with torch.no_grad():
             features = self.model.encode_image(batch_inputs)
@@ -88,16 +177,18 @@ class VideoRetriever:
         
         faiss.normalize_L2(features)
         
-        start_id = self.index.ntotal
-        self.index.add(features)
-        
-        for i, ts in enumerate(timestamp_buffer):
-            self.metadata[start_id + i] = {
-                "timestamp": ts,
-                "path": path_buffer[i]
-            }
+        snapshot.index.add(features)
+        snapshot.metadata.append(
+            timestamp=timestamp_buffer,
+            frame_id=frame_ids if frame_ids is not None else [0] * len(timestamp_buffer),
+            video_id=[video_id] * len(timestamp_buffer),
+            path=path_buffer,
+        )
 
-    def process_video(self, video_path, sample_rate=1, diff_threshold=0.15, max_duration_minutes=None):
+    @profiled("process_video")
+    def process_video(self, video_path, sample_rate=1, diff_threshold=0.15, max_duration_minutes=None,
+                      progress_callback=None, target=None, append=False, sampling="fixed",
+                      coarse_interval=4.0, fine_rate=None, decode_workers=None):
         """
         Process video: extract keyframes, encode and index
         
@@ -106,7 +197,23 @@ class VideoRetriever:
             sample_rate: Frames per second to sample
             diff_threshold: Threshold for keyframe detection
             max_duration_minutes: Maximum duration to process (None for full video)
+            progress_callback: Optional fn(fraction, message) called as batches are indexed
+            target: IndexHandle to publish into (default: self.handle)
+            append: Add the video to the current library instead of replacing it
+            sampling: "fixed" (every 1/sample_rate s) or "adaptive" (seek-free coarse walk;
+                at a change, one seek back and a forward scan at the fine step;
+                see frame_sampler.adaptive_keyframes)
+            coarse_interval: Adaptive mode: seconds between coarse samples
+            fine_rate: Adaptive mode: change points are located to 1/fine_rate s
+                (default: frame-accurate)
+            decode_workers: Override self.decode_workers; fixed sampling only, slices start
+                on GOP keyframes and the result matches a serial run
+
+        The index is built in a private snapshot and swapped in atomically at the end,
+        so concurrent searches keep seeing the previous complete index.
         """
+        # 视频表记录调用方给的原始路径（与音频库一致），而不是 ../ 解析或转码后的路径
+        source = video_path
         if not os.path.exists(video_path):
             parent_path = os.path.join("..", video_path)
             if os.path.exists(parent_path):
@@ -133,100 +240,284 @@ class VideoRetriever:
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         duration = total_frames / fps
         print(f"[Info] Video info: FPS={fps:.2f}, Duration={duration/60:.2f} minutes")
+
+        handle = target or self.handle
+        snapshot = self.new_snapshot()
+        base = handle.current() if append else None
+        if base is not None:
+            # 复制已有库（含段级索引，顺带压缩已删除的视频），新视频的 id 接在后面；
+            # 关键帧目录沿用（只新增文件）
+            copy_library(base, snapshot)
+            snapshot.assets_dir = base.assets_dir
+        snapshot.source = source
+        own_assets = not snapshot.assets_dir
+        if own_assets:
+            snapshot.assets_dir = os.path.join(self.keyframe_dir, snapshot.snapshot_id)
+        os.makedirs(snapshot.assets_dir, exist_ok=True)
+        video_id = allocate_video_id(snapshot)
+        start_id = snapshot.index.ntotal
         
-        prev_valid_frame = None
-        frame_buffer = []
-        timestamp_buffer = []
-        path_buffer = []
-        batch_size = 64
-        
-        frame_idx = 0
-        saved_count = 0
-        step = int(fps / sample_rate) if sample_rate > 0 else 30
+        batch = _KeyframeBatch(self, snapshot, video_id)
+        step = max(1, int(fps / sample_rate)) if sample_rate > 0 else 30
+        end_frame = None
+        if max_duration_minutes:
+            end_frame = int(max_duration_minutes * 60 * fps) + 1
+        if sampling == "adaptive" and total_frames <= 0:
+            print("[Warning] 无法获取总帧数，自适应采样退回固定间隔采样。")
+            sampling = "fixed"
+
+        try:
+            reader = FrameReader(cap)
+            if sampling == "adaptive":
+                end_frame = min(end_frame or total_frames, total_frames)
+                keyframes = adaptive_keyframes(
+                    reader,
+                    coarse_step=max(1, int(coarse_interval * fps)),
+                    fine_step=max(1, int(fps / fine_rate)) if fine_rate else 1,
+                    diff_threshold=diff_threshold,
+                    end_frame=end_frame,
+                )
+            elif (decode_workers or self.decode_workers) > 1 and total_frames > 0:
+                keyframes = parallel_fixed_keyframes(
+                    video_path, reader, step, diff_threshold, total_frames, fps,
+                    workers=decode_workers or self.decode_workers,
+                    work_dir=os.path.join(self.keyframe_dir, f".decode-{snapshot.snapshot_id}"),
+                    end_frame=end_frame,
+                )
+            else:
+                keyframes = fixed_keyframes(reader, step, diff_threshold, end_frame)
         
-        start_time = time.time()
+            start_time = time.time()
         
-        while True:
-            if step > 100: 
-                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-                ret, frame = cap.read()
-            else:
-                if frame_idx == 0:
-                    ret, frame = cap.read()
-                else:
-                    ret = True
-                    frames_to_skip = step - 1
-                    for _ in range(frames_to_skip):
-                        if not cap.grab():
-                            ret = False
-                            break
-                    if ret:
-                        ret, frame = cap.retrieve()
-                    else:
-                        break
-
-            if not ret: break
-            
-            current_time_sec = frame_idx / fps
-            if max_duration_minutes and (current_time_sec / 60) > max_duration_minutes:
-                print(f"Reached max duration {max_duration_minutes} minutes, stopping.")
-                break
-
-            is_keyframe = False
-            if prev_valid_frame is None:
-                is_keyframe = True 
-            else:
-                diff = self._calculate_histogram_diff(prev_valid_frame, frame)
-                if diff > diff_threshold:
-                    is_keyframe = True
-            
-            if is_keyframe:
-                image_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(image_rgb)
-                
-                frame_filename = f"frame_{saved_count:05d}.jpg"
-                frame_path = os.path.join(self.keyframe_dir, frame_filename)
-                cv2.imwrite(frame_path, frame)
-                
-                frame_buffer.append(pil_image)
-                timestamp_buffer.append(current_time_sec)
-                path_buffer.append(frame_path)
-                
-                prev_valid_frame = frame
-                saved_count += 1
-                
-                if len(frame_buffer) >= batch_size:
-                    self._embed_and_add_to_index(frame_buffer, timestamp_buffer, path_buffer)
-                    frame_buffer = []
-                    timestamp_buffer = []
-                    path_buffer = []
-                    print(f"\r  -> Progress: {current_time_sec/60:.1f}/{duration/60:.1f} min (Indexed: {saved_count} frames)", end="")
-
-            frame_idx += step
-
-        if len(frame_buffer) > 0:
-            self._embed_and_add_to_index(frame_buffer, timestamp_buffer, path_buffer)
-
-        cap.release()
-        print(f"\n[Done] Processing completed in {time.time() - start_time:.2f}s | Total indexed frames: {self.index.ntotal}")
+            for frame_idx, frame in keyframes:
+                current_time_sec = frame_idx / fps
+                if batch.add(frame, current_time_sec, frame_idx):
+                    print(f"\r  -> Progress: {current_time_sec/60:.1f}/{duration/60:.1f} min (Indexed: {batch.saved} frames)", end="")
+                    if progress_callback:
+                        progress_callback(
+                            min(1.0, current_time_sec / duration) if duration > 0 else 0.0,
+                            f"{current_time_sec/60:.1f}/{duration/60:.1f} min, {batch.saved} 帧",
+                        )
+
+            batch.flush()
+            print(f"\n[Done] Processing completed in {time.time() - start_time:.2f}s | Total indexed frames: {snapshot.index.ntotal}")
+            sampled_span = total_frames if total_frames > 0 else reader.pos
+            if end_frame:
+                sampled_span = min(sampled_span, end_frame)
+            # 固定间隔采样同样要 grab 解码每一帧：解码量按全部解码帧（含 grab 和 seek 后的解码）比较
+            sampling_stats = dict(reader.stats(), mode=sampling, decoded=reader.decoded,
+                                  fixed_rate_frames=fixed_rate_equivalent(sampled_span, step),
+                                  fixed_rate_decoded=sampled_span)
+            if sampling_stats["fixed_rate_frames"]:
+                compared = 1 - reader.retrieved / sampling_stats["fixed_rate_frames"]
+                print(f"[Sampling] {sampling}: compared {reader.retrieved} frames "
+                      f"(fixed {sample_rate} fps: {sampling_stats['fixed_rate_frames']}, {compared:.0%} fewer), "
+                      f"decoded ~{reader.decoded} frames (fixed: {sampled_span}; grabbed={reader.grabbed}, "
+                      f"seeks={reader.seeks} ~{reader.seek_decoded} frames)")
         
-        if self.index.ntotal == 0:
-            raise ValueError("No keyframes extracted!")
+            if snapshot.index.ntotal == start_id:
+                raise ValueError("No keyframes extracted!")
+            snapshot.videos.append({
+                "video_id": video_id,
+                "source": source,
+                "start_id": start_id,
+                "end_id": snapshot.index.ntotal,
+                "duration": duration,
+                "sampling": sampling_stats,
+            })
+            self._build_segments(snapshot, start_id)
+            handle.publish(snapshot)
+        except Exception:
+            # 取消（IngestCancelled）或出错：私有快照的关键帧没人会引用，删掉；
+            # 追加模式只删本次写进共享目录的 v{id}_frame_*.jpg
+            self._discard_keyframes(snapshot, batch, own_assets)
+            raise
+        finally:
+            cap.release()
+        if progress_callback:
+            progress_callback(1.0, f"{snapshot.index.ntotal} 帧")
+        return snapshot
+
+    @staticmethod
+    def _discard_keyframes(snapshot, batch, own_assets):
+        if own_assets:
+            shutil.rmtree(snapshot.assets_dir, ignore_errors=True)
+            return
+        for i in range(batch.saved):
+            try:
+                os.remove(batch.frame_path(i))
+            except FileNotFoundError:
+                pass
+
+    def process_live(self, source, sample_rate=1, diff_threshold=0.15, progress_callback=None, target=None,
+                     append=False, publish_interval=30.0, poll_interval=5.0, idle_timeout=120.0):
+        """
+        Index a recording while it is still being written (growing file or .m3u8 playlist)
+
+        Keyframes are appended as new media appears and a queryable snapshot is published
+        at most every publish_interval seconds; the video's entry in snapshot.videos
+        carries "live": True until the recording is finished (see live_source.LiveSource).
+
+        Args:
+            source: Growing media file or segment playlist
+            publish_interval: Min seconds between partial snapshots
+            poll_interval / idle_timeout: See LiveSource
+        """
+        handle = target or self.handle
+        working = self.new_snapshot()
+        base = handle.current() if append else None
+        if base is not None:
+            copy_library(base, working)
+            working.assets_dir = base.assets_dir
+        base_segments = working.segments
+        if not working.assets_dir:
+            working.assets_dir = os.path.join(self.keyframe_dir, working.snapshot_id)
+        os.makedirs(working.assets_dir, exist_ok=True)
+        video_id = allocate_video_id(working)
+        start_id = working.index.ntotal
+        batch = _KeyframeBatch(self, working, video_id)
+
+        def heartbeat(recorded):
+            if progress_callback:
+                progress_callback(0.0, f"直播中：已索引 {recorded/60:.1f} min, {batch.saved} 帧")
+
+        print(f"[Live] Following {os.path.basename(source)}")
+        reference = None
+        recorded = 0.0
+        last_publish = time.time()
+        live = True
+        try:
+            for window in LiveSource(source, poll_interval=poll_interval, idle_timeout=idle_timeout,
+                                     heartbeat=heartbeat).windows():
+                cap = cv2.VideoCapture(window.path)
+                fps = cap.get(cv2.CAP_PROP_FPS)
+                if not cap.isOpened() or fps <= 0:
+                    print(f"[Live Warning] 无法读取 {os.path.basename(window.path)}，跳过该窗口。")
+                    cap.release()
+                    continue
+                step = max(1, int(fps / sample_rate)) if sample_rate > 0 else 30
+                start_frame = int(round(window.start * fps))
+                end_frame = None if window.end is None else int(round(window.end * fps))
+                reader = FrameReader(cap)
+                if start_frame:
+                    reader.seek(start_frame)
+                # 参考签名跨窗口保留，关键帧判定与一次性处理整段录像相同
+                for frame_idx, frame, signature in fixed_samples(reader, step, start_frame, end_frame):
+                    if reference is not None and signature_diff(reference, signature) <= diff_threshold:
+                        continue
+                    reference = signature
+                    timestamp = window.offset + frame_idx / fps
+                    batch.add(frame, timestamp, int(round(timestamp * fps)))
+                cap.release()
+                batch.flush()
+                recorded = window.offset + (window.end if window.end is not None else reader.pos / fps)
+                if time.time() - last_publish >= publish_interval:
+                    self._publish_live(handle, working, base_segments, start_id, video_id, source, recorded, True)
+                    last_publish = time.time()
+                    heartbeat(recorded)
+            live = False
+        finally:
+            # 取消或出错时也发布已索引的部分
+            batch.flush()
+            if working.index.ntotal > start_id or not live:
+                self._publish_live(handle, working, base_segments, start_id, video_id, source, recorded, False)
+        print(f"[Live] Finished: {working.index.ntotal - start_id} keyframes over {recorded/60:.1f} min")
+        if progress_callback:
+            progress_callback(1.0, f"{working.index.ntotal} 帧")
+        return handle.current()
 
-    def search(self, query, k=5):
-        """Search for similar frames given text query"""
+    def _publish_live(self, handle, working, base_segments, start_id, video_id, source, recorded, live):
+        """Publish a copy of the live working snapshot (published snapshots are never mutated)"""
+        snapshot = self.new_snapshot()
+        copy_library(working, snapshot)
+        snapshot.source = source
+        snapshot.assets_dir = working.assets_dir
+        snapshot.segments = base_segments
+        snapshot.videos.append({
+            "video_id": video_id,
+            "source": source,
+            "start_id": start_id,
+            "end_id": snapshot.index.ntotal,
+            "duration": recorded,
+            "live": live,
+        })
+        if snapshot.index.ntotal > start_id:
+            self._build_segments(snapshot, start_id)
+        handle.publish(snapshot)
+        print(f"[Live] Published snapshot: {snapshot.index.ntotal - start_id} keyframes, {recorded/60:.1f} min")
+
+    def _build_segments(self, snapshot, start_id):
+        """Extend the segment level with the frames added since start_id (reuses their embeddings)"""
+        vectors = flat_vectors(snapshot.index)
+        if vectors is not None:
+            vectors = vectors[start_id:]
+        else:
+            vectors = snapshot.index.reconstruct_n(start_id, snapshot.index.ntotal - start_id)
+        new_segments = SegmentLevel.build(
+            vectors,
+            snapshot.metadata.column("video_id")[start_id:],
+            snapshot.metadata.column("timestamp")[start_id:],
+            self.segment_seconds,
+            id_offset=start_id,
+        )
+        snapshot.segments = snapshot.segments.extend(new_segments) if snapshot.segments is not None else new_segments
+
+    def _search_hierarchical(self, snapshot, features, k):
+        """Coarse-to-fine: best segments per query, then exact frame search inside them"""
+        with tracer.span("faiss.search.segments", segments=len(snapshot.segments)):
+            return search_segments(snapshot.index, snapshot.segments, features, k, self.segments_per_query)
+
+    def encode_queries(self, queries, batch_size=256):
+        """Encode text queries with CLIP in batched forward passes -> L2-normalised (n, 512) float32"""
+        features = []
+        with tracer.span("clip.encode_text", queries=len(queries)):
+            for i in range(0, len(queries), batch_size):
+                text_tokens = clip.tokenize(queries[i:i + batch_size], truncate=True).to(self.device)
+                with torch.no_grad():
+                    features.append(self.model.encode_text(text_tokens).cpu().numpy().astype('float32'))
+        features = np.ascontiguousarray(np.concatenate(features))
+        faiss.normalize_L2(features)
+        return features
+
+    def search(self, query, k=5, snapshot=None, time_range=None, video_ids=None, with_ids=False):
+        """
+        Search for similar frames given text query (against snapshot, default: current)
+
+        Args:
+            time_range: Optional (start_sec, end_sec); either bound may be None
+            video_ids: Optional video ids (snapshot.videos) to search in
+            with_ids: Also return the index ids of the hits (see search_many)
+        """
         print(f"\n[Search] Query: '{query}'")
-        text_tokens = clip.tokenize([query]).to(self.device)
-        with torch.no_grad():
-            text_features = self.model.encode_text(text_tokens)
-            text_features = text_features.cpu().numpy().astype('float32')
-            
-        faiss.normalize_L2(text_features)
-        distances, indices = self.index.search(text_features, k)
+        return self.search_many([query], k, snapshot, time_range, video_ids, with_ids)[0]
+
+    def search_many(self, queries, k=5, snapshot=None, time_range=None, video_ids=None, with_ids=False):
+        """
+        Search several text queries at once: one batched CLIP pass, one multi-row FAISS search
+
+        Returns:
+            One [(timestamp, distance, path), ...] list per query, in input order;
+            with with_ids=True one (hits, ids) pair per query
+        """
+        if not queries:
+            return []
+        snapshot = snapshot or self.handle.current()
+        text_features = self.encode_queries(list(queries))
+        ranges = candidate_ranges(snapshot, time_range, video_ids, start_field="timestamp")
+        with tracer.span("faiss.search", index="visual", k=k, ntotal=snapshot.index.ntotal,
+                         queries=len(queries)) as span:
+            if ranges is not None:
+                span.set(candidates=sum(hi - lo for lo, hi in ranges))
+                distances, indices = search_ranges(snapshot.index, text_features, k, ranges)
+            elif snapshot.segments is not None and snapshot.ntotal >= self.hierarchical_min_frames:
+                # 大库：代价取决于段数而不是帧数
+                span.set(hierarchical=True)
+                distances, indices = self._search_hierarchical(snapshot, text_features, k)
+            else:
+                distances, indices = snapshot.index.search(text_features, k)
         
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx != -1 and idx in self.metadata:
-                data = self.metadata[idx]
-                results.append((data["timestamp"], distances[0][i], data["path"]))
-        return results
\ No newline at end of file
+        for columns, dists, ids in gather_results(snapshot.metadata, distances, indices, ("timestamp", "path")):
+            hits = list(zip(columns["timestamp"].tolist(), dists.tolist(), columns["path"]))
+            results.append((hits, ids.tolist()) if with_ids else hits)
+        return results
@@ -1,10 +1,74 @@
 import torch
 import os
+import sys
+import time
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from conversation_state import ConversationStore
+
+from evidence_packer import EvidencePacker
+from generation_scheduler import GenerationScheduler
+from tracing import tracer
+
+PROMPT_INSTRUCTIONS = (
+    "Instructions:\n"
+    "1. **Synthesize**: Combine the visual slides (OCR) and the teacher's speech to answer.\n"
+    "2. **List Extraction**: If the user asks for a list (e.g., universities), extract unique names from the slides/audio. **Do not repeat names.**\n"
+    "3. **Priority**: If the visual text is blurry, RELY on the Audio Transcript.\n"
+    "4. **Concise**: Give a direct and summarized answer."
+)
+
+
+class _GenerationTimer(BaseStreamer):
+    """Streamer that splits a generate() call into prefill and decode time"""
 
-class VLMHandler:
     def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self.end_at = None
+        self.prompt_tokens = 0
+        self.steps = 0
+        self._prompt_seen = False
+
+    def put(self, value):
+        # generate() 先送入整个 prompt，之后每步送入新 token
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            self.prompt_tokens = int(value.shape[-1])
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.steps += 1
+
+    def end(self):
+        self.end_at = time.perf_counter()
+
+    def record(self, batch_size=1):
+        if self.first_token_at is None:
+            return
+        tracer.record("vlm.prefill", self.first_token_at - self.start,
+                      prompt_tokens=self.prompt_tokens, batch_size=batch_size)
+        tracer.record("vlm.decode", (self.end_at or time.perf_counter()) - self.first_token_at,
+                      generated_tokens=self.steps * batch_size, batch_size=batch_size)
+
+
+class VLMHandler:
+    def __init__(self, token_budget=2048, max_batch_size=4, batch_wait_ms=20):
         print("[VLM] Loading Qwen-VL-Chat...")
+        self.tokenizer = None
+        self.gen_params = {
+            "repetition_penalty": 1.2,
+            "temperature": 0.3,
+            "top_p": 0.8,
+            "max_new_tokens": 512,
+        }
         
         local_path = "./Qwen-VL-Chat"
         model_path = local_path if os.path.exists(local_path) else "Qwen/Qwen-VL-Chat"
@@ -25,14 +89,41 @@ class VLMHandler:
             print(f"[Error] Model loading failed: {e}")
             print("Please check if transformers version is 4.37.2")
 
-    def chat(self, query, images_info, audio_info):
-        """Generate answer with multimodal context"""
+        self.packer = EvidencePacker(token_budget=token_budget, tokenizer=self.tokenizer)
+        self.scheduler = GenerationScheduler(self, max_batch_size=max_batch_size, max_wait_ms=batch_wait_ms)
+        self.sessions = ConversationStore()
+
+    def pack_evidence(self, query, images_info, audio_info, token_budget=None):
+        """Select and downscale evidence so the whole prompt fits in the token budget"""
+        reserved = self.packer.estimate_text_tokens(
+            "Visual Evidence (Screenshots):\n"
+            "\nAudio Transcript Evidence (Teacher's speech):\n"
+            f"\nUser Query: {query}\n\n{PROMPT_INSTRUCTIONS}"
+        )
+        with tracer.span("prompt.pack") as span:
+            packed = self.packer.pack(images_info, audio_info, reserved_tokens=reserved, token_budget=token_budget)
+            span.set(tokens_used=packed.tokens_used, images=len(packed.images_info), audio=len(packed.audio_info))
+        print(f"[VLM] Evidence packed: {packed.summary()}")
+        return packed
+
+    def build_prompt(self, query, images_info, audio_info, include_images=True, image_refs=None):
+        """
+        Build the Qwen-VL formatted query (images + fused text instructions)
+
+        Args:
+            include_images: Attach the keyframes (False gives the text-only form kept in history)
+            image_refs: Image numbers from an earlier turn; the images are referenced, not re-attached
+        """
         qwen_input_list = []
         
         visual_context = "Visual Evidence (Screenshots):\n"
         for i, (ts, score, path) in enumerate(images_info):
-            qwen_input_list.append({'image': path})
             m, s = divmod(int(ts), 60)
+            if image_refs is not None:
+                visual_context += f"Image {image_refs[i]} (shown earlier): Timestamp {m:02d}:{s:02d}\n"
+                continue
+            if include_images:
+                qwen_input_list.append({'image': path})
             visual_context += f"Image {i+1}: Timestamp {m:02d}:{s:02d}\n"
         
         audio_context = "\nAudio Transcript Evidence (Teacher's speech):\n"
@@ -49,29 +140,260 @@ class VLMHandler:
             f"{visual_context}"
             f"{audio_context}\n"
             f"User Query: {query}\n\n"
-            "Instructions:\n"
-            "1. **Synthesize**: Combine the visual slides (OCR) and the teacher's speech to answer.\n"
-            "2. **List Extraction**: If the user asks for a list (e.g., universities), extract unique names from the slides/audio. **Do not repeat names.**\n"
-            "3. **Priority**: If the visual text is blurry, RELY on the Audio Transcript.\n"
-            "4. **Concise**: Give a direct and summarized answer."
+            f"{PROMPT_INSTRUCTIONS}"
         )
         
         qwen_input_list.append({'text': prompt_instruction})
-        
-        print(f"[VLM] Fusion prompt constructed. Sending to model...")
+        with tracer.span("prompt.build") as span:
+            prompt = self.tokenizer.from_list_format(qwen_input_list)
+            if tracer.enabled:
+                span.set(prompt_tokens=self.packer.estimate_text_tokens(prompt_instruction)
+                         + self.packer.estimate_image_tokens() * (len(qwen_input_list) - 1))
+        return prompt
+
+    def _qwen_utils(self):
+        # make_context / decode_tokens 来自 Qwen-VL 的 remote code 模块
+        return sys.modules[self.model.__class__.__module__]
+
+    @staticmethod
+    def _split_prompt(prompt):
+        # 批量项可以是格式化好的 query，或 (query, history)（无可复用 KV 的会话轮次）
+        if isinstance(prompt, tuple):
+            return prompt
+        return prompt, None
+
+    def generate_batch(self, prompts, gen_params=None):
+        """
+        Generate answers for several formatted queries in one model call
+
+        Args:
+            prompts: Formatted queries, or (query, history) pairs for conversational turns
+        """
+        gen_params = gen_params or self.gen_params
+        if len(prompts) == 1:
+            query, history = self._split_prompt(prompts[0])
+            timer = _GenerationTimer() if tracer.enabled else None
+            response, _ = self.model.chat(self.tokenizer, query=query, history=history, streamer=timer, **gen_params)
+            if timer:
+                timer.record()
+            return [response]
 
         try:
-            query_formatted = self.tokenizer.from_list_format(qwen_input_list)
-            
-            response, history = self.model.chat(
-                self.tokenizer, 
-                query=query_formatted, 
-                history=None,
-                repetition_penalty=1.2,
-                temperature=0.3,
-                top_p=0.8,
-                max_new_tokens=512
+            return self._generate_padded_batch(prompts, gen_params)
+        except Exception as e:
+            print(f"[VLM Warning] Batched generation failed, falling back to sequential: {e}")
+            responses = []
+            for prompt in prompts:
+                query, history = self._split_prompt(prompt)
+                responses.append(self.model.chat(self.tokenizer, query=query, history=history, **gen_params)[0])
+            return responses
+
+    def _generate_padded_batch(self, prompts, gen_params):
+        utils = self._qwen_utils()
+        generation_config = self.model.generation_config
+        raw_texts = []
+        for prompt in prompts:
+            query, history = self._split_prompt(prompt)
+            raw_texts.append(
+                utils.make_context(
+                    self.tokenizer,
+                    query,
+                    history=history,
+                    system="You are a helpful assistant.",
+                    max_window_size=generation_config.max_window_size,
+                    chat_format=generation_config.chat_format,
+                )[0]
+            )
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token_id = self.tokenizer.eod_id
+        try:
+            batch = self.tokenizer(raw_texts, padding="longest", return_tensors="pt").to(self.model.device)
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+        timer = _GenerationTimer() if tracer.enabled else None
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **batch,
+                stop_words_ids=utils.get_stop_words_ids(generation_config.chat_format, self.tokenizer),
+                return_dict_in_generate=False,
+                generation_config=generation_config,
+                streamer=timer,
+                **gen_params,
+            )
+        if timer:
+            timer.record(batch_size=len(prompts))
+
+        responses = []
+        for i, raw_text in enumerate(raw_texts):
+            padding_len = batch.input_ids[i].eq(self.tokenizer.pad_token_id).sum().item()
+            responses.append(
+                utils.decode_tokens(
+                    outputs[i][padding_len:],
+                    self.tokenizer,
+                    raw_text_len=len(raw_text),
+                    context_length=len(batch.input_ids[i]) - padding_len,
+                    chat_format=generation_config.chat_format,
+                    verbose=False,
+                    errors="replace",
+                )
             )
-            return response
+        return responses
+
+    def _prefix_length(self, session, context_tokens):
+        """Length of the cached prefix of context_tokens whose KV can be reused (0 if none)"""
+        cached = session.cached_tokens
+        if session.past_key_values is None or not cached:
+            return 0
+        n = 0
+        limit = min(len(cached), len(context_tokens) - 1)
+        while n < limit and cached[n] == context_tokens[n]:
+            n += 1
+        image_start_id = self.model.config.visual["image_start_id"]
+        # Qwen-VL 只在没有 past_key_values 时编码图片，新增部分含图片就必须重算
+        if n == 0 or image_start_id in context_tokens[n:]:
+            return 0
+        return n
+
+    def _reusable_prefix(self, session, context_tokens):
+        """Longest cached prefix of context_tokens whose KV can be reused (no new images after it)"""
+        n = self._prefix_length(session, context_tokens)
+        if n == 0:
+            return None, 0
+        return self._truncate_cache(session.past_key_values, n, len(session.cached_tokens)), n
+
+    def _context_tokens(self, query, history):
+        utils = self._qwen_utils()
+        generation_config = self.model.generation_config
+        return utils.make_context(
+            self.tokenizer,
+            query,
+            history=history,
+            system="You are a helpful assistant.",
+            max_window_size=generation_config.max_window_size,
+            chat_format=generation_config.chat_format,
+        )[1]
+
+    # Qwen-VL remote code 的 KV 布局为 [batch, seq, heads, head_dim]（在 dim=1 上拼接），
+    # 不是 HF 常见的 [batch, heads, seq, head_dim]
+    KV_SEQ_AXIS = 1
+
+    @classmethod
+    def _truncate_cache(cls, past_key_values, length, total):
+        truncated = []
+        for layer in past_key_values:
+            tensors = []
+            for t in layer:
+                if t.shape[cls.KV_SEQ_AXIS] != total:
+                    raise ValueError(
+                        f"KV cache layout mismatch: expected {total} tokens on axis {cls.KV_SEQ_AXIS}, "
+                        f"got shape {tuple(t.shape)}"
+                    )
+                tensors.append(t.narrow(cls.KV_SEQ_AXIS, 0, length))
+            truncated.append(tuple(tensors))
+        return tuple(truncated)
+
+    def _generate_with_cache(self, session, query, history, gen_params):
+        utils = self._qwen_utils()
+        generation_config = self.model.generation_config
+        context_tokens = self._context_tokens(query, history)
+        past, reused = self._reusable_prefix(session, context_tokens)
+        print(f"[VLM] Session {session.session_id[:8]}: reusing {reused}/{len(context_tokens)} prompt tokens from KV cache")
+
+        stop_ids = {ids[0] for ids in utils.get_stop_words_ids(generation_config.chat_format, self.tokenizer)}
+        processors = LogitsProcessorList()
+        if gen_params.get("repetition_penalty", 1.0) != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(gen_params["repetition_penalty"]))
+        temperature = gen_params.get("temperature", 1.0)
+        if temperature and temperature > 0:
+            processors.append(TemperatureLogitsWarper(temperature))
+            processors.append(TopPLogitsWarper(gen_params.get("top_p", 1.0)))
+
+        device = self.model.device
+        all_ids = torch.tensor([context_tokens], device=device)
+        generated = []
+        with torch.no_grad():
+            with tracer.span("vlm.prefill", prompt_tokens=len(context_tokens), reused_tokens=reused):
+                out = self.model(input_ids=all_ids[:, reused:], past_key_values=past, use_cache=True)
+            with tracer.span("vlm.decode") as span:
+                for _ in range(gen_params.get("max_new_tokens", 512)):
+                    scores = processors(all_ids, out.logits[:, -1, :].float())
+                    if temperature and temperature > 0:
+                        next_id = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+                    else:
+                        next_id = scores.argmax(dim=-1, keepdim=True)
+                    all_ids = torch.cat([all_ids, next_id], dim=-1)
+                    generated.append(int(next_id))
+                    # 停止符也送入模型，这样缓存恰好覆盖下一轮 history 的前缀
+                    out = self.model(input_ids=next_id, past_key_values=out.past_key_values, use_cache=True)
+                    if generated[-1] in stop_ids:
+                        break
+                span.set(generated_tokens=len(generated))
+
+        self.sessions.store_cache(session.session_id, out.past_key_values, context_tokens + generated)
+        answer_ids = generated[:-1] if generated and generated[-1] in stop_ids else generated
+        return self.tokenizer.decode(answer_ids, errors="replace").strip()
+
+    def _session_turn(self, session, query, images_info, audio_info):
+        """
+        Qwen-VL query and history for a conversational turn
+
+        Returns:
+            (full, text, history, evidence): the query the model sees, its text-only form kept in
+            history, the history to prepend, and the new evidence images (None if referenced)
+        """
+        paths = [path for _, _, path in images_info]
+        if session.evidence_turn is not None and set(paths) <= set(session.evidence_images):
+            # 证据已在上一轮出现过：只引用图片编号，复用前缀 KV
+            refs = [session.evidence_images.index(p) + 1 for p in paths]
+            full = text = self.build_prompt(query, images_info, audio_info, image_refs=refs)
+            return full, text, session.history(), None
+        full = self.build_prompt(query, images_info, audio_info)
+        text = self.build_prompt(query, images_info, audio_info, include_images=False)
+        history = [(past["text"], past["response"]) for past in session.turns]
+        return full, text, history, paths
+
+    def generate_session(self, session_id, turn, gen_params=None):
+        """One conversational turn with Qwen-VL history and prefix KV cache reuse"""
+        gen_params = gen_params or self.gen_params
+        query, images_info, audio_info = turn
+        session = self.sessions.get(session_id)
+        full, text, history, evidence = self._session_turn(session, query, images_info, audio_info)
+        response = self._generate_with_cache(session, full, history, gen_params)
+        self.sessions.record_turn(session_id, full, text, response, evidence_images=evidence)
+        return response
+
+    def record_cached_turn(self, session_id, query, images_info, audio_info, response):
+        """Keep conversational context when an answer came from the answer cache"""
+        text = self.build_prompt(query, images_info, audio_info, include_images=False)
+        self.sessions.record_turn(session_id, text, text, response)
+
+    def _use_kv_path(self, session, full, history):
+        # 有可复用的前缀 KV 才走逐 token 的会话路径；调度器空闲时（本来也凑不成批）也走，顺便建立缓存
+        if self._prefix_length(session, self._context_tokens(full, history)) > 0:
+            return True
+        metrics = self.scheduler.metrics()
+        return metrics["queue_depth"] == 0 and metrics["in_flight"] == 0
+
+    def chat(self, query, images_info, audio_info, timeout=None, session_id=None):
+        """Generate answer with multimodal context (queued through the scheduler)"""
+        try:
+            if session_id is not None:
+                session = self.sessions.get(session_id)
+                full, text, history, evidence = self._session_turn(session, query, images_info, audio_info)
+                if self._use_kv_path(session, full, history):
+                    print(f"[VLM] Follow-up aware turn for session {session_id[:8]} (KV cache path)...")
+                    return self.scheduler.generate(
+                        (query, images_info, audio_info), self.gen_params, timeout=timeout, session_id=session_id
+                    )
+                print(f"[VLM] Follow-up aware turn for session {session_id[:8]} (batched)...")
+                response = self.scheduler.generate((full, history or None), self.gen_params, timeout=timeout)
+                self.sessions.record_turn(session_id, full, text, response, evidence_images=evidence)
+                return response
+            query_formatted = self.build_prompt(query, images_info, audio_info)
+            print(f"[VLM] Fusion prompt constructed. Sending to model...")
+            return self.scheduler.generate(query_formatted, self.gen_params, timeout=timeout)
         except Exception as e:
-            return f"[Model Error] {str(e)}"
\ No newline at end of file
+            return f"[Model Error] {str(e)}"
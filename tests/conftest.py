@@ -0,0 +1,5 @@
+import os
+import sys
+
+# src/ 下的模块以平铺方式互相导入（与 `cd src && python app.py` 一致）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
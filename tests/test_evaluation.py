@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+import pytest
+
+import evaluation
+
+COLOURS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+TRANSCRIPT = [
+    {"start": 0.0, "end": 2.0, "text": "gradient descent converges slowly"},
+    {"start": 2.0, "end": 4.0, "text": "convolution kernels slide over images"},
+    {"start": 4.0, "end": 6.0, "text": "attention weights sum to one"},
+    {"start": 6.0, "end": 8.0, "text": "dropout regularises large networks"},
+]
+
+
+def _write_video(path, fps=10, seconds_per_colour=2):
+    cv2 = pytest.importorskip("cv2")
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (64, 48))
+    for colour in COLOURS:
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        frame[:] = colour
+        for _ in range(fps * seconds_per_colour):
+            writer.write(frame)
+    writer.release()
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    _write_video(tmp_path / "lec1.mp4")
+    data = {
+        "videos": [{"id": "lec1", "path": "lec1.mp4", "transcript": TRANSCRIPT}],
+        "queries": [
+            {"video": "lec1", "query": seg["text"], "relevant": [[seg["start"], seg["end"]]], "modality": "audio"}
+            for seg in TRANSCRIPT
+        ] + [{"video": "lec1", "query": "slide", "relevant": [[0.0, 8.0]], "modality": "visual"}],
+    }
+    path = tmp_path / "dataset.json"
+    path.write_text(json.dumps(data), encoding="utf-8")
+    return evaluation.load_dataset(str(path))
+
+
+def test_stub_pareto_sweep(dataset, tmp_path):
+    # stub 编码器替换了模型，但检索器本身（video_processor / audio_processor）仍依赖这些库
+    for module in ("torch", "clip", "whisper", "sentence_transformers"):
+        pytest.importorskip(module)
+    grid = {"visual.diff_threshold": [0.1, 0.3], "audio.segment_window": [1, 2]}
+    factory = evaluation.make_retriever_factory(stub=True, workdir=str(tmp_path / "work"))
+    rows = evaluation.sweep(dataset, grid, factory, ks=(1, 5), use_reference_transcript=True)
+
+    assert len(rows) == 4
+    assert {tuple(sorted(r["params"].items())) for r in rows} == {
+        (("audio.segment_window", w), ("visual.diff_threshold", t)) for w in (1, 2) for t in (0.1, 0.3)
+    }
+    for row in rows:
+        audio, visual = row["report"]["audio"], row["report"]["visual"]
+        assert audio["queries"] == 4 and visual["queries"] == 1
+        for metrics in (audio, visual):
+            for key in ("recall@1", "recall@5", "mrr", "tiou"):
+                assert 0.0 <= metrics[key] <= 1.0
+            assert metrics["ntotal"] > 0 and metrics["index_bytes"] > 0
+        # 哈希文本编码是词袋：用原句查询，逐句窗口时 top-1 必然命中
+        if row["params"]["audio.segment_window"] == 1:
+            assert audio["recall@1"] == 1.0 and audio["mrr"] == 1.0
+
+    ranked, table = evaluation.pareto_table(rows, metric="recall@5")
+    assert len(ranked) == 4 and any(r["pareto"] for r in ranked)
+    assert [r["latency_ms"] for r in ranked] == sorted(r["latency_ms"] for r in ranked)
+    assert len(table.splitlines()) == 2 + len(rows)
+
+
+def test_score_ranking():
+    scores = evaluation.score_ranking([(10.0, 12.0), (0.0, 2.0)], [(0.0, 2.0), (5.0, 6.0)], ks=(1, 2))
+    assert scores["recall@1"] == 0.0
+    assert scores["recall@2"] == 0.5
+    assert scores["mrr"] == 0.5
+    assert scores["tiou"] == 0.0
+
+
+def test_hashing_text_encoder_without_torch():
+    vectors = evaluation.HashingTextEncoder(dim=16).encode(["gradient descent", "descent gradient", "dropout"])
+    assert vectors.shape == (3, 16)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+    assert np.allclose(vectors[0], vectors[1])
+    assert not np.allclose(vectors[0], vectors[2])
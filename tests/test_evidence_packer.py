@@ -0,0 +1,53 @@
+import os
+import threading
+
+from PIL import Image
+
+import evidence_packer
+from evidence_packer import EvidencePacker, downscaled_copies
+
+
+def _keyframe(tmp_path, size=(896, 504)):
+    path = str(tmp_path / "v000_frame_00000.jpg")
+    Image.new("RGB", size, (40, 80, 120)).save(path)
+    return path
+
+
+def test_downscale_caches_one_copy_per_source_version(tmp_path):
+    packer = EvidencePacker(image_resolution=448)
+    path = _keyframe(tmp_path)
+    small = packer.downscale(path)
+    assert small != path and packer.downscale(path) == small
+    with Image.open(small) as img:
+        assert max(img.size) == 448
+
+    # 同名关键帧被新上传覆盖：旧副本不再使用并被清理
+    os.utime(path, ns=(1, 1))
+    newer = packer.downscale(path)
+    assert newer != small and downscaled_copies(path) == [newer]
+
+
+def test_concurrent_downscale_of_one_keyframe(tmp_path, monkeypatch):
+    packer = EvidencePacker(image_resolution=448)
+    path = _keyframe(tmp_path)
+    barrier = threading.Barrier(2, timeout=5)
+    replace = os.replace
+
+    def replace_together(src, dst):
+        # 两个线程都写完临时文件后再移动，原来同名的临时文件会在这里互相覆盖
+        barrier.wait()
+        return replace(src, dst)
+
+    monkeypatch.setattr(evidence_packer.os, "replace", replace_together)
+    results = [None, None]
+
+    def run(i):
+        results[i] = packer.downscale(path)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results[0] == results[1] != path
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(path), os.path.basename(results[0])])
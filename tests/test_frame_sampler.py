@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from frame_sampler import FrameReader, adaptive_keyframes, fixed_keyframes  # noqa: E402
+
+FPS = 30
+# 每段 (颜色, 帧数)：变化点在 150、330 帧
+SCENES = [((255, 0, 0), 150), ((0, 255, 0), 180), ((0, 0, 255), 150)]
+
+
+@pytest.fixture(scope="module")
+def video(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("video") / "scenes.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), FPS, (64, 48))
+    for colour, frames in SCENES:
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        frame[:] = colour
+        for _ in range(frames):
+            writer.write(frame)
+    writer.release()
+    return path
+
+
+def _reader(path):
+    cap = cv2.VideoCapture(path)
+    return cap, FrameReader(cap)
+
+
+def test_adaptive_finds_change_points_without_coarse_seeks(video):
+    cap, reader = _reader(video)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    keyframes = [idx for idx, _ in adaptive_keyframes(reader, coarse_step=4 * FPS, fine_step=1,
+                                                      diff_threshold=0.15, end_frame=total)]
+    cap.release()
+    assert keyframes == [0, 150, 330]
+    # 粗扫描只 grab 前进（步长 120 超过默认 seek 阈值 100）；每个变化点只回退一次
+    assert reader.seeks == 2
+    assert reader.decoded >= total - 1
+    assert reader.decoded == reader.retrieved + reader.grabbed + reader.seek_decoded
+
+
+def test_adaptive_matches_fixed_rate_keyframes_on_the_grid(video):
+    cap, reader = _reader(video)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    adaptive = [idx for idx, _ in adaptive_keyframes(reader, coarse_step=4 * FPS, fine_step=FPS,
+                                                     diff_threshold=0.15, end_frame=total)]
+    cap.release()
+    cap, reader = _reader(video)
+    fixed = [idx for idx, _ in fixed_keyframes(reader, FPS, 0.15, end_frame=total)]
+    cap.release()
+    assert adaptive == fixed == [0, 150, 330]
+
+
+def test_reader_counts_grabs_and_seeks(video):
+    cap, reader = _reader(video)
+    assert reader.read(10) is not None
+    assert reader.grabbed == 10 and reader.retrieved == 1 and reader.seeks == 0
+    assert reader.read(5) is not None
+    assert reader.seeks == 1 and reader.seek_decoded == 5
+    cap.release()
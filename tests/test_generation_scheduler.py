@@ -0,0 +1,165 @@
+import threading
+import time
+
+import pytest
+
+from generation_scheduler import GenerationCancelled, GenerationScheduler
+
+
+class StubHandler:
+    """CPU stand-in for VLMHandler: echoes prompts, optionally blocking until released"""
+
+    def __init__(self, block=False):
+        self.batches = []
+        self.session_calls = []
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+        self.started = threading.Event()
+
+    def generate_batch(self, prompts, gen_params):
+        self.started.set()
+        self.release.wait(5)
+        self.batches.append(list(prompts))
+        return [f"echo:{p}" for p in prompts]
+
+    def generate_session(self, session_id, prompt, gen_params):
+        self.started.set()
+        self.release.wait(5)
+        self.session_calls.append((session_id, prompt))
+        return f"{session_id}:{prompt}"
+
+
+def test_compatible_requests_are_batched():
+    handler = StubHandler(block=True)
+    scheduler = GenerationScheduler(handler, max_batch_size=4, max_wait_ms=200)
+    try:
+        blocker = scheduler.submit("first")
+        assert handler.started.wait(2)
+        requests = [scheduler.submit(f"q{i}", {"max_new_tokens": 8}) for i in range(3)]
+        handler.release.set()
+        assert blocker.result(5) == "echo:first"
+        assert [r.result(5) for r in requests] == ["echo:q0", "echo:q1", "echo:q2"]
+        assert handler.batches[-1] == ["q0", "q1", "q2"]
+        assert scheduler.metrics()["completed"] == 4
+    finally:
+        scheduler.stop()
+
+
+def test_different_params_and_sessions_are_not_batched_together():
+    handler = StubHandler(block=True)
+    scheduler = GenerationScheduler(handler, max_batch_size=4, max_wait_ms=50)
+    try:
+        blocker = scheduler.submit("first")
+        assert handler.started.wait(2)
+        a = scheduler.submit("a", {"temperature": 0.1})
+        b = scheduler.submit("b", {"temperature": 0.9})
+        s = scheduler.submit("s", session_id="sess")
+        handler.release.set()
+        assert (blocker.result(5), a.result(5), b.result(5), s.result(5)) == ("echo:first", "echo:a", "echo:b", "sess:s")
+        assert ["a"] in handler.batches and ["b"] in handler.batches
+        assert handler.session_calls == [("sess", "s")]
+    finally:
+        scheduler.stop()
+
+
+def test_cancel_removes_request_from_queue():
+    handler = StubHandler(block=True)
+    scheduler = GenerationScheduler(handler, max_batch_size=1, max_wait_ms=0, max_queue=2)
+    try:
+        scheduler.submit("running")
+        assert handler.started.wait(2)
+        queued = scheduler.submit("queued")
+        other = scheduler.submit("other")
+        assert queued.cancel()
+        # 取消的请求不再占用队列名额
+        assert scheduler.metrics()["queue_depth"] == 1
+        scheduler.submit("refill")
+        with pytest.raises(GenerationCancelled):
+            queued.result(1)
+        handler.release.set()
+        assert other.result(5) == "echo:other"
+        assert ["queued"] not in handler.batches
+        assert scheduler.metrics()["cancelled"] == 1
+    finally:
+        scheduler.stop()
+
+
+def test_cancel_after_start_is_refused():
+    handler = StubHandler(block=True)
+    scheduler = GenerationScheduler(handler, max_batch_size=1, max_wait_ms=0)
+    try:
+        request = scheduler.submit("running")
+        assert handler.started.wait(2)
+        assert not request.cancel()
+        handler.release.set()
+        assert request.result(5) == "echo:running"
+    finally:
+        scheduler.stop()
+
+
+def test_queue_limit():
+    handler = StubHandler(block=True)
+    scheduler = GenerationScheduler(handler, max_batch_size=1, max_wait_ms=0, max_queue=1)
+    try:
+        scheduler.submit("running")
+        assert handler.started.wait(2)
+        scheduler.submit("queued")
+        with pytest.raises(RuntimeError):
+            scheduler.submit("overflow")
+    finally:
+        handler.release.set()
+        scheduler.stop()
+
+
+def test_stop_fails_pending_requests():
+    handler = StubHandler(block=True)
+    scheduler = GenerationScheduler(handler, max_batch_size=1, max_wait_ms=0)
+    running = scheduler.submit("running")
+    assert handler.started.wait(2)
+    pending = [scheduler.submit(f"p{i}") for i in range(3)]
+    threading.Timer(0.2, handler.release.set).start()
+    start = time.time()
+    scheduler.stop()
+    for request in pending:
+        with pytest.raises(RuntimeError):
+            request.result(1)
+    assert running.result(5) == "echo:running"
+    assert time.time() - start < 5
+
+
+def test_handler_error_is_raised_to_caller():
+    class Failing(StubHandler):
+        def generate_batch(self, prompts, gen_params):
+            raise ValueError("boom")
+
+    scheduler = GenerationScheduler(Failing(), max_wait_ms=0)
+    try:
+        with pytest.raises(ValueError):
+            scheduler.generate("x", timeout=5)
+        assert scheduler.metrics()["failed"] == 1
+    finally:
+        scheduler.stop()
+
+
+def test_short_handler_response_fails_the_whole_batch():
+    class Short(StubHandler):
+        def generate_batch(self, prompts, gen_params):
+            self.started.set()
+            self.release.wait(5)
+            return [f"echo:{p}" for p in prompts][:1]
+
+    handler = Short(block=True)
+    scheduler = GenerationScheduler(handler, max_batch_size=4, max_wait_ms=200)
+    try:
+        blocker = scheduler.submit("first")
+        assert handler.started.wait(2)
+        requests = [scheduler.submit(f"q{i}") for i in range(3)]
+        handler.release.set()
+        assert blocker.result(5) == "echo:first"
+        for request in requests:
+            with pytest.raises(RuntimeError):
+                request.result(5)
+        assert scheduler.metrics()["failed"] == 3
+    finally:
+        scheduler.stop()
@@ -0,0 +1,125 @@
+import json
+import os
+import tarfile
+
+import faiss
+import numpy as np
+import pytest
+
+from index_bundle import export_bundle, import_bundle, resolve_bundle_path
+from index_state import IndexHandle, IndexRegistry, IndexSnapshot
+from metadata_store import AUDIO_SCHEMA, VIDEO_SCHEMA, MetadataStore
+
+
+class StubRetriever:
+    def __init__(self, schema, dim=4):
+        self.schema = schema
+        self.dimension = dim
+        self.model_name = self.text_model_name = "stub"
+        self.whisper_model_size = "none"
+        self.segment_window = 1
+        self.handle = IndexHandle(self.new_snapshot())
+
+    def new_snapshot(self):
+        return IndexSnapshot(faiss.IndexFlatIP(self.dimension), MetadataStore(self.schema))
+
+
+class StubServices:
+    def __init__(self, bundle_dir, index_dir=None):
+        self.retriever = StubRetriever(VIDEO_SCHEMA)
+        self.audio_retriever = StubRetriever(AUDIO_SCHEMA)
+        self.indexes = IndexRegistry(self.retriever, self.audio_retriever)
+        self.index_dir = index_dir
+        self.bundle_dir = bundle_dir
+
+    def bundle_root(self):
+        return self.bundle_dir
+
+
+@pytest.fixture
+def services(tmp_path):
+    services = StubServices(str(tmp_path / "bundles"))
+    snapshot = services.audio_retriever.new_snapshot()
+    snapshot.index.add(np.eye(4, dtype="float32")[:2])
+    snapshot.metadata.append(start=[0.0, 2.0], end=[2.0, 4.0], video_id=[0, 0], text=["a", "b"])
+    snapshot.videos = [{"video_id": 0, "source": "lec.mp4", "start_id": 0, "end_id": 2}]
+    services.audio_retriever.handle.publish(snapshot)
+    return services
+
+
+@pytest.mark.parametrize("name", ["lec.tar", "lec"])
+def test_export_import_round_trip(services, name):
+    manifest = export_bundle(services, name)
+    assert os.path.exists(os.path.join(services.bundle_dir, name))
+    assert os.listdir(services.bundle_dir) == [name]
+
+    imported = import_bundle(services, name, session_id="s1")
+    assert imported["bundle_id"] == manifest["bundle_id"]
+    assert services.indexes.lookup("s1").audio.current().ntotal == 2
+
+
+@pytest.mark.parametrize("path", ["../outside.tar", "/tmp/outside.tar", "."])
+def test_paths_outside_the_bundle_root_are_rejected(services, path):
+    with pytest.raises(ValueError):
+        export_bundle(services, path)
+    with pytest.raises(ValueError):
+        import_bundle(services, path)
+
+
+def test_symlink_escaping_the_root_is_rejected(services, tmp_path):
+    os.makedirs(services.bundle_dir)
+    os.symlink(str(tmp_path), os.path.join(services.bundle_dir, "link"))
+    with pytest.raises(ValueError):
+        resolve_bundle_path(services, "link/x.tar")
+
+
+def test_existing_target_is_not_overwritten(services):
+    target = os.path.join(services.bundle_dir, "data")
+    os.makedirs(target)
+    with open(os.path.join(target, "keep.txt"), "w") as f:
+        f.write("keep")
+    with pytest.raises(FileExistsError):
+        export_bundle(services, "data")
+    assert os.listdir(target) == ["keep.txt"]
+    assert sorted(os.listdir(services.bundle_dir)) == ["data"]
+
+
+def test_missing_bundle_raises_file_not_found(services):
+    with pytest.raises(FileNotFoundError):
+        import_bundle(services, "missing.tar")
+
+
+def test_manifest_bundle_id_cannot_escape(services):
+    export_bundle(services, "src")
+    src = os.path.join(services.bundle_dir, "src")
+    manifest_path = os.path.join(src, "bundle.json")
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest["bundle_id"] = "../../escape"
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    with tarfile.open(os.path.join(services.bundle_dir, "evil.tar"), "w") as tar:
+        for name in os.listdir(src):
+            tar.add(os.path.join(src, name), arcname=name)
+    with pytest.raises(ValueError):
+        import_bundle(services, "evil.tar", session_id="s1")
+
+
+def test_export_pins_the_generation_it_copies(services, monkeypatch):
+    import index_bundle
+
+    handle = services.audio_retriever.handle
+    deleted = []
+    save = index_bundle.save_snapshot
+
+    def save_during_removal(snapshot, path):
+        # 复制期间发布新一代并登记删除（remove_video / 压缩的做法），删除必须等导出结束
+        if path.endswith("audio"):
+            handle.publish(services.audio_retriever.new_snapshot())
+            handle.defer(lambda: deleted.append(path))
+            assert deleted == []
+        return save(snapshot, path)
+
+    monkeypatch.setattr(index_bundle, "save_snapshot", save_during_removal)
+    export_bundle(services, "pinned")
+    assert len(deleted) == 1
@@ -0,0 +1,99 @@
+import os
+import threading
+
+import faiss
+import numpy as np
+import pytest
+
+pytest.importorskip("PIL")
+
+from index_compaction import Compactor, removed_assets, tombstone_videos  # noqa: E402
+from index_filters import allocate_video_id, copy_library  # noqa: E402
+from index_state import IndexHandle, IndexSnapshot, SessionIndexes  # noqa: E402
+from metadata_store import VIDEO_SCHEMA, MetadataStore  # noqa: E402
+
+
+def new_snapshot():
+    return IndexSnapshot(faiss.IndexFlatIP(4), MetadataStore(VIDEO_SCHEMA))
+
+
+def add_video(snapshot, frames, paths=None):
+    video_id = allocate_video_id(snapshot)
+    start = snapshot.ntotal
+    snapshot.index.add(np.random.default_rng(video_id).standard_normal((frames, 4)).astype("float32"))
+    snapshot.metadata.append(timestamp=[float(i) for i in range(frames)], video_id=[video_id] * frames,
+                             path=paths or [f"v{video_id}_{i}.jpg" for i in range(frames)])
+    snapshot.videos.append({"video_id": video_id, "source": f"v{video_id}.mp4", "start_id": start,
+                            "end_id": snapshot.ntotal})
+    return video_id
+
+
+def library(*frames):
+    snapshot = new_snapshot()
+    for n in frames:
+        add_video(snapshot, n)
+    return snapshot
+
+
+def live_ids(snapshot):
+    return [v["video_id"] for v in snapshot.videos]
+
+
+def test_ingestion_publish_keeps_concurrent_removal():
+    handle = IndexHandle(library(3, 2))
+    base = handle.current()
+    # 摄取基于 base 追加；期间删除视频 0
+    ingested = new_snapshot()
+    copy_library(base, ingested)
+    new_id = add_video(ingested, 4)
+    assert handle.publish_if(tombstone_videos(base, [0]), expected=base)
+
+    handle.publish(ingested)
+    current = handle.current()
+    assert live_ids(current) == [1, new_id]
+    assert [v["video_id"] for v in current.tombstones] == [0]
+
+
+def test_new_library_does_not_inherit_tombstones():
+    handle = IndexHandle(library(3, 2))
+    base = handle.current()
+    handle.publish(tombstone_videos(base, [0]))
+    # 非追加建库：全新的库，编号从 0 开始
+    handle.publish(library(5))
+    assert live_ids(handle.current()) == [0]
+    assert handle.current().tombstones == []
+
+
+def test_compaction_does_not_wait_for_ingest_lock():
+    session = SessionIndexes(IndexHandle(library(3, 2)), IndexHandle(new_snapshot()))
+    base = session.visual.current()
+    session.visual.publish(tombstone_videos(base, [0]))
+    compactor = Compactor(delay=0)
+    done = threading.Event()
+
+    def compact():
+        compactor.compact(session, {"visual": new_snapshot, "audio": new_snapshot})
+        done.set()
+
+    with session.ingest_lock:
+        threading.Thread(target=compact, daemon=True).start()
+        assert done.wait(5), "compaction blocked on the ingestion lock"
+    current = session.visual.current()
+    assert current.ntotal == 2 and current.tombstones == [] and live_ids(current) == [1]
+
+
+def test_removed_assets_include_downscaled_copies(tmp_path):
+    frames = [str(tmp_path / f"frame_{i:05d}.jpg") for i in range(2)]
+    snapshot = new_snapshot()
+    add_video(snapshot, 2, paths=frames)
+    add_video(snapshot, 1, paths=[str(tmp_path / "frame_00002.jpg")])
+    for path in frames:
+        open(path, "wb").close()
+    small = str(tmp_path / "frame_00000_448_abc-10.jpg")
+    for path in (small, str(tmp_path / "frame_00002_448_abc-10.jpg"), str(tmp_path / "frame_00001_448.jpg")):
+        open(path, "wb").close()
+
+    paths = removed_assets(snapshot, {0})
+    assert sorted(paths) == sorted(frames + [small])
+    assert str(tmp_path / "frame_00002.jpg") not in paths
+    assert all(os.path.exists(p) for p in paths)
@@ -0,0 +1,111 @@
+import faiss
+import numpy as np
+import pytest
+
+from index_filters import candidate_ranges, search_ranges
+from index_state import IndexSnapshot
+from metadata_store import AUDIO_SCHEMA, VIDEO_SCHEMA, MetadataStore
+
+DIM = 8
+
+
+def audio_library(videos=2, segments=3):
+    """Each video: segments [0, 2), [2, 4), [4, 6) stored contiguously"""
+    snapshot = IndexSnapshot(faiss.IndexFlatL2(DIM), MetadataStore(AUDIO_SCHEMA))
+    for video_id in range(videos):
+        start = snapshot.ntotal
+        snapshot.index.add(np.random.default_rng(video_id).standard_normal((segments, DIM)).astype("float32"))
+        snapshot.metadata.append(start=[2.0 * i for i in range(segments)], end=[2.0 * i + 2 for i in range(segments)],
+                                 video_id=[video_id] * segments, text=[f"s{i}" for i in range(segments)])
+        snapshot.videos.append({"video_id": video_id, "source": f"v{video_id}.mp4", "start_id": start,
+                                "end_id": snapshot.ntotal})
+    return snapshot
+
+
+def audio_ranges(snapshot, time_range=None, video_ids=None):
+    return candidate_ranges(snapshot, time_range, video_ids, start_field="start", end_field="end")
+
+
+def test_no_filter_needs_no_ranges():
+    assert audio_ranges(audio_library()) is None
+
+
+@pytest.mark.parametrize("time_range, expected", [
+    ((2.5, 3.5), [(1, 2), (4, 5)]),
+    # 区间端点相接也算重叠
+    ((2.0, 4.0), [(0, 3), (3, 6)]),
+    ((None, 2.0), [(0, 2), (3, 5)]),
+    ((4.0, None), [(1, 3), (4, 6)]),
+    ((6.5, 9.0), []),
+    ((None, None), [(0, 3), (3, 6)]),
+])
+def test_time_bounds(time_range, expected):
+    assert audio_ranges(audio_library(), time_range) == expected
+
+
+def test_single_timestamp_column():
+    snapshot = IndexSnapshot(faiss.IndexFlatL2(DIM), MetadataStore(VIDEO_SCHEMA))
+    snapshot.index.add(np.zeros((4, DIM), dtype="float32"))
+    snapshot.metadata.append(timestamp=[0.0, 1.0, 2.0, 3.0], video_id=[0] * 4, frame_id=[0, 1, 2, 3],
+                             path=[f"f{i}.jpg" for i in range(4)])
+    snapshot.videos.append({"video_id": 0, "source": "v.mp4", "start_id": 0, "end_id": 4})
+    assert candidate_ranges(snapshot, (1.0, 2.0)) == [(1, 3)]
+    assert candidate_ranges(snapshot, (1.5, 1.9)) == []
+
+
+def test_video_filter_and_tombstones():
+    snapshot = audio_library(videos=3)
+    assert audio_ranges(snapshot, video_ids={2}) == [(6, 9)]
+    assert audio_ranges(snapshot, (1.0, 3.0), video_ids={0, 2}) == [(0, 2), (6, 8)]
+    snapshot.tombstones = [snapshot.videos.pop(1)]
+    # 有墓碑时即使没有过滤条件也只搜剩下的视频
+    assert audio_ranges(snapshot) == [(0, 3), (6, 9)]
+
+
+def _brute_force(vectors, queries, ids, k):
+    distances = ((queries[:, None, :] - vectors[None, ids, :]) ** 2).sum(-1)
+    order = np.argsort(distances, axis=1)[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.asarray(ids)[order]
+
+
+def test_flat_search_merges_ranges_and_pads_when_k_exceeds_candidates():
+    snapshot = audio_library(videos=3)
+    vectors = faiss.rev_swig_ptr(snapshot.index.get_xb(), snapshot.ntotal * DIM).reshape(-1, DIM).copy()
+    queries = np.random.default_rng(7).standard_normal((2, DIM)).astype("float32")
+    ranges = [(0, 2), (4, 5), (7, 9)]
+    distances, labels = search_ranges(snapshot.index, queries, 8, ranges)
+
+    assert distances.shape == labels.shape == (2, 8)
+    expected_d, expected_l = _brute_force(vectors, queries, [0, 1, 4, 7, 8], 5)
+    np.testing.assert_array_equal(labels[:, :5], expected_l)
+    np.testing.assert_allclose(distances[:, :5], expected_d, rtol=1e-4, atol=1e-4)
+    assert (labels[:, 5:] == -1).all() and np.isinf(distances[:, 5:]).all()
+
+
+def test_empty_ranges_return_no_hits():
+    distances, labels = search_ranges(audio_library().index, np.zeros((1, DIM), dtype="float32"), 3, [])
+    assert (labels == -1).all() and np.isinf(distances).all()
+
+
+@pytest.mark.parametrize("ranges", [[(2, 5)], [(0, 2), (6, 8)]])
+def test_id_selector_for_non_flat_index(ranges):
+    rng = np.random.default_rng(3)
+    vectors = rng.standard_normal((12, DIM)).astype("float32")
+    queries = rng.standard_normal((3, DIM)).astype("float32")
+    index = faiss.IndexHNSWFlat(DIM, 32)
+    index.hnsw.efSearch = 64
+    index.add(vectors)
+    ids = [i for lo, hi in ranges for i in range(lo, hi)]
+
+    distances, labels = search_ranges(index, queries, 3, ranges)
+    expected_d, expected_l = _brute_force(vectors, queries, ids, 3)
+    np.testing.assert_array_equal(labels, expected_l)
+    np.testing.assert_allclose(distances, expected_d, rtol=1e-4, atol=1e-4)
+
+
+def test_id_selector_pads_with_missing_labels_when_k_exceeds_candidates():
+    vectors = np.random.default_rng(4).standard_normal((12, DIM)).astype("float32")
+    index = faiss.IndexHNSWFlat(DIM, 32)
+    index.add(vectors)
+    _, labels = search_ranges(index, vectors[:1], 5, [(2, 4)])
+    assert sorted(labels[0, :2]) == [2, 3] and (labels[0, 2:] == -1).all()
@@ -0,0 +1,82 @@
+import os
+
+import faiss
+
+from index_state import IndexHandle, IndexRegistry, IndexSnapshot
+
+
+class StubRetriever:
+    def __init__(self):
+        self.handle = IndexHandle(self.new_snapshot())
+
+    def new_snapshot(self):
+        return IndexSnapshot(faiss.IndexFlatIP(4))
+
+
+def _registry(**kwargs):
+    return IndexRegistry(StubRetriever(), StubRetriever(), **kwargs)
+
+
+def test_lookup_does_not_create_or_evict_sessions():
+    registry = _registry(max_sessions=2)
+    real = registry.get("real")
+    for i in range(10):
+        view = registry.lookup(f"probe-{i}")
+        assert view.visual.current().ntotal == 0
+    assert len(registry) == 1
+    assert registry.lookup("real") is real
+
+
+def test_lookup_none_is_the_default_library():
+    registry = _registry()
+    assert registry.lookup(None) is registry.get(None)
+
+
+def test_dropped_session_keeps_assets_until_last_pin_released(tmp_path):
+    registry = _registry()
+    session = registry.get("s")
+    assets = tmp_path / "assets"
+    assets.mkdir()
+    (assets / "frame_00000.jpg").write_bytes(b"jpg")
+    snapshot = IndexSnapshot(faiss.IndexFlatIP(4), assets_dir=str(assets))
+    session.visual.publish(snapshot)
+
+    with session.acquire():
+        registry.drop("s")
+        assert os.path.isdir(assets)
+    assert not os.path.exists(assets)
+
+
+def test_dropped_session_without_queries_removes_assets_at_once(tmp_path):
+    registry = _registry()
+    session = registry.get("s")
+    assets = tmp_path / "assets"
+    assets.mkdir()
+    session.visual.publish(IndexSnapshot(faiss.IndexFlatIP(4), assets_dir=str(assets)))
+    registry.drop("s")
+    assert not os.path.exists(assets)
+
+
+def test_eviction_skips_sessions_with_pending_or_running_ingestion():
+    registry = _registry(max_sessions=2)
+    queued = registry.get("queued")
+    registry.hold("queued")
+    running = registry.get("running")
+    running.ingest_lock.acquire()
+    try:
+        registry.get("third")
+        registry.get("fourth")
+        assert registry.lookup("queued") is queued
+        assert registry.lookup("running") is running
+    finally:
+        running.ingest_lock.release()
+    registry.unhold("queued")
+    registry.get("fifth")
+    assert len(registry) < 5
+
+
+def test_lookup_never_evicts_the_session_it_returns():
+    registry = _registry(idle_seconds=60)
+    session = registry.get("s")
+    session.last_used -= 120
+    assert registry.lookup("s") is session
@@ -0,0 +1,26 @@
+import sqlite3
+
+from ingest_jobs import IngestJobQueue
+
+
+def test_restart_requeues_default_library_jobs_and_fails_session_jobs(tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite3")
+    IngestJobQueue(None, db_path=db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO jobs (job_id, video_path, session_id, status, submitted_at) VALUES (?, ?, ?, ?, 0)",
+            [
+                ("default", "a.mp4", None, "running"),
+                ("session", "b.mp4", "abc", "running"),
+                ("queued", "c.mp4", "abc", "queued"),
+            ],
+        )
+    conn.close()
+
+    jobs = IngestJobQueue(None, db_path=db_path)
+    assert jobs.get("default")["status"] == "queued"
+    for job_id in ("session", "queued"):
+        session_job = jobs.get(job_id)
+        assert session_job["status"] == "failed"
+        assert "restart" in session_job["error"]
@@ -0,0 +1,66 @@
+import os
+
+import profiling
+
+
+def test_profile_region_writes_cprofile_artifacts(tmp_path):
+    profiling.configure(targets="region", output_dir=str(tmp_path), torch_ops=False)
+    try:
+        with profiling.profile_region("region") as out_dir:
+            sum(range(1000))
+        assert os.path.exists(os.path.join(out_dir, "profile.txt"))
+    finally:
+        profiling.configure(targets="")
+
+
+def test_lock_released_when_writing_artifacts_fails(tmp_path, monkeypatch):
+    profiling.configure(targets="region", output_dir=str(tmp_path), torch_ops=False)
+
+    def broken(*args):
+        raise OSError("disk full")
+
+    try:
+        monkeypatch.setattr(profiling, "_write_artifacts", broken)
+        with profiling.profile_region("region") as out_dir:
+            assert out_dir is not None
+        # 上一次写文件失败后锁必须已释放，否则这里会被当作“忙”而跳过
+        with profiling.profile_region("region") as out_dir:
+            assert out_dir is not None
+    finally:
+        profiling.configure(targets="")
+
+
+def test_unselected_region_is_a_no_op(tmp_path):
+    profiling.configure(targets="other", output_dir=str(tmp_path))
+    try:
+        with profiling.profile_region("region") as out_dir:
+            assert out_dir is None
+        assert os.listdir(tmp_path) == []
+    finally:
+        profiling.configure(targets="")
+
+
+def test_torch_ops_start_failure_runs_block_unprofiled(tmp_path, monkeypatch):
+    import sys
+
+    # torch 不可用（或 torch.profiler 启动失败）时，被测代码照常运行
+    monkeypatch.setitem(sys.modules, "torch", None)
+    for mode in ("cprofile", "sampling"):
+        profiling.configure(targets="region", mode=mode, output_dir=str(tmp_path), torch_ops=True)
+        try:
+            with profiling.profile_region("region") as out_dir:
+                assert out_dir is None
+            assert not profiling._profiler_lock.locked()
+            assert os.listdir(tmp_path) == []
+        finally:
+            profiling.configure(targets="")
+
+
+def test_sampling_with_torch_ops_takes_the_profiler_lock(tmp_path):
+    profiling.configure(targets="region", mode="sampling", output_dir=str(tmp_path), torch_ops=True)
+    try:
+        with profiling._profiler_lock:
+            with profiling.profile_region("region") as out_dir:
+                assert out_dir is None
+    finally:
+        profiling.configure(targets="")
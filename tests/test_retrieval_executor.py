@@ -0,0 +1,71 @@
+import time
+
+from retrieval_executor import RetrievalExecutor
+
+
+def _sleeper(seconds, value):
+    def run():
+        time.sleep(seconds)
+        return [value]
+    return run
+
+
+def test_queue_wait_does_not_count_against_branch_timeout():
+    executor = RetrievalExecutor(max_workers=1, default_timeout=0.5)
+    try:
+        outcomes = executor.run({"visual": _sleeper(0.3, "v"), "audio": _sleeper(0.3, "a")})
+    finally:
+        executor.shutdown()
+    assert outcomes["visual"].ok and outcomes["visual"].results == ["v"]
+    assert outcomes["audio"].ok and outcomes["audio"].results == ["a"]
+    assert outcomes["audio"].queued >= 0.25
+
+
+def test_slow_branch_times_out():
+    executor = RetrievalExecutor(max_workers=2, default_timeout=0.1)
+    try:
+        outcomes = executor.run({"visual": _sleeper(0.5, "v"), "audio": _sleeper(0.0, "a")})
+    finally:
+        executor.shutdown()
+    assert not outcomes["visual"].ok and outcomes["visual"].error == "timeout"
+    assert outcomes["audio"].results == ["a"]
+
+
+def test_branch_waiting_too_long_for_a_worker_is_skipped():
+    executor = RetrievalExecutor(max_workers=1, default_timeout=1.0, queue_timeout=0.2)
+    try:
+        # visual 超时后仍占着唯一的工作线程，audio 一直排不上
+        outcomes = executor.run(
+            {"visual": _sleeper(0.6, "v"), "audio": _sleeper(0.0, "a")}, timeouts={"visual": 0.05}
+        )
+    finally:
+        executor.shutdown()
+    assert outcomes["visual"].error == "timeout"
+    assert not outcomes["audio"].ok and outcomes["audio"].error == "queue timeout"
+
+
+def test_branch_error_is_reported():
+    def boom():
+        raise RuntimeError("index missing")
+
+    executor = RetrievalExecutor(max_workers=2)
+    try:
+        outcomes = executor.run({"visual": boom})
+    finally:
+        executor.shutdown()
+    assert not outcomes["visual"].ok and "index missing" in outcomes["visual"].error
+
+
+def test_queue_wait_is_bounded_by_the_branch_timeout_by_default():
+    executor = RetrievalExecutor(max_workers=1, default_timeout=0.2)
+    try:
+        start = time.time()
+        outcomes = executor.run(
+            {"visual": _sleeper(1.0, "v"), "audio": _sleeper(0.0, "a")}, timeouts={"visual": 0.05}
+        )
+        elapsed = time.time() - start
+    finally:
+        executor.shutdown()
+    assert outcomes["visual"].error == "timeout"
+    assert outcomes["audio"].error == "queue timeout"
+    assert elapsed < 0.6
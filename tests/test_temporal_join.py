@@ -0,0 +1,57 @@
+import faiss
+import numpy as np
+
+from index_state import IndexSnapshot
+from metadata_store import AUDIO_SCHEMA, VIDEO_SCHEMA, MetadataStore
+from temporal_join import TemporalJoin, same_source
+
+
+def _index(n):
+    index = faiss.IndexFlatIP(4)
+    if n:
+        index.add(np.random.default_rng(0).standard_normal((n, 4)).astype("float32"))
+    return index
+
+
+def _visual(source, timestamps):
+    metadata = MetadataStore(VIDEO_SCHEMA)
+    metadata.append(timestamp=timestamps, video_id=[0] * len(timestamps))
+    snapshot = IndexSnapshot(_index(len(timestamps)), metadata)
+    snapshot.videos = [{"video_id": 0, "source": source, "start_id": 0, "end_id": len(timestamps)}]
+    return snapshot
+
+
+def _audio(source, spans):
+    metadata = MetadataStore(AUDIO_SCHEMA)
+    metadata.append(start=[s for s, _ in spans], end=[e for _, e in spans], video_id=[0] * len(spans))
+    snapshot = IndexSnapshot(_index(len(spans)), metadata)
+    snapshot.videos = [{"video_id": 0, "source": source, "start_id": 0, "end_id": len(spans)}]
+    return snapshot
+
+
+def test_join_maps_frames_and_segments():
+    join = TemporalJoin.build(_visual("lec.mp4", [0.0, 10.0]), _audio("lec.mp4", [(0.0, 4.0), (4.0, 12.0), (12.0, 20.0)]))
+    assert list(join.audio_for_frame(0)) == [0, 1]
+    assert list(join.audio_for_frame(1)) == [1, 2]
+    assert [join.frame_for_audio(i) for i in range(3)] == [0, 0, 1]
+
+
+def test_join_survives_transcoded_visual_source(tmp_path):
+    original = str(tmp_path / "lec.avi")
+    visual = _visual(str(tmp_path / "lec_h264.mp4"), [0.0, 10.0])
+    audio = _audio(original, [(0.0, 4.0)])
+    join = TemporalJoin.build(visual, audio)
+    assert join.frame_for_audio(0) == 0
+
+
+def test_join_skips_misaligned_videos():
+    join = TemporalJoin.build(_visual("a.mp4", [0.0]), _audio("b.mp4", [(0.0, 4.0)]))
+    assert join.frame_for_audio(0) is None
+    assert list(join.audio_for_frame(0)) == []
+
+
+def test_same_source_resolves_relative_paths(tmp_path, monkeypatch):
+    (tmp_path / "videos").mkdir()
+    monkeypatch.chdir(tmp_path / "videos")
+    assert same_source("../videos/lec.mp4", "lec.mp4")
+    assert not same_source("lec.mp4", "other.mp4")